@@ -1 +1,9 @@
-
+def main():
+    """ The proxy command. `proxy cdr ...` searches the CDR store"""
+    import sys
+    if sys.argv[1:2] == ["cdr"]:
+        from omnipcx.cdr_store import main as cdr_main
+        sys.exit(cdr_main(sys.argv[2:]))
+    from omnipcx.cli import Application
+    app = Application()
+    app.start()
@@ -1,4 +1,3 @@
 if __name__ == "__main__":
-    from omnipcx.cli import Application
-    app = Application()
-    app.start()
+    from omnipcx import main
+    main()
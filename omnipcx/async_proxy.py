@@ -0,0 +1,818 @@
+import asyncio, collections, concurrent.futures, os, socket, time
+from omnipcx.logging import Loggable
+from omnipcx.messages import MessageDetector
+from omnipcx.messages.detector import RECV_SIZE
+from omnipcx.messages.base import ControlMessage
+from omnipcx.messages.protocol import SMDR, Interogation, Reply, ReplySixDigit
+from omnipcx.messages.control import XON, XOFF
+from omnipcx.cdr_replay import CDRReplayer
+from omnipcx.proxy import ProxyBase, MAX_TIME
+from omnipcx.metrics import CDRMetrics, PBX_TO_OPERA, OPERA_TO_PBX, connection
+from omnipcx.site import cdr_leg_from_args
+from omnipcx.capture import PBX, HOTEL, CDR
+from omnipcx.upstream import HealthCheck, answer_idle, keepalive
+from omnipcx import connector
+from omnipcx.handoff import EXIT_TIMEOUT
+
+# How long we wait for the reply to a forwarded message. Same as the socket
+# timeout used by the polling engine.
+REPLY_TIMEOUT = 0.5
+# Frames that answer an Interogation instead of an ACK
+REPLIES = (Reply, ReplySixDigit)
+
+
+class AsyncStream(Loggable):
+    """ One leg of the proxy (PBX, Opera or CDR) served by an asyncio
+        StreamReader/StreamWriter pair. Received bytes are parsed as soon as
+        they arrive and the messages are queued for the proxy.
+    """
+    def __init__(self, reader, writer, wakeup=None, capture=None):
+        super(AsyncStream, self).__init__()
+        self.reader = reader
+        self.writer = writer
+        self.wakeup = wakeup
+        self.capture = capture
+        self.messages = collections.deque()
+        self.readable = asyncio.Event()
+        # the detector only uses the stream to send NACKs for corrupt frames
+        self.detector = MessageDetector(self, capture)
+        self._connected = True
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    @property
+    def connected(self):
+        return self._connected and not self.writer.is_closing()
+
+    @property
+    def closed(self):
+        """ The remote end closed the connection and all its messages were consumed"""
+        return not self._connected and not self.messages
+
+    def _notify(self):
+        self.readable.set()
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data or not self.on_data(data):
+                    break
+        except (ConnectionError, OSError):
+            self.logger.error("Remote end closed connection")
+        finally:
+            self._connected = False
+            self._notify()
+
+    def on_data(self, data):
+        """ Returns False if the stream can't be parsed anymore"""
+        for message in self.detector.feed(data):
+            self.on_message(message)
+        return not self.detector.invalid
+
+    def on_message(self, message):
+        self.messages.append(message)
+        self._notify()
+
+    def has_message(self):
+        return len(self.messages) > 0
+
+    async def get(self, timeout=None):
+        """ Returns the next message, or None on timeout or closed connection"""
+        while not self.messages:
+            if not self._connected:
+                return None
+            self.readable.clear()
+            try:
+                await asyncio.wait_for(self.readable.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.messages.popleft()
+
+    def send(self, message):
+        if not self.connected:
+            self.logger.error("Cannot send to a closed socket")
+            return False
+        data = message.serialize()
+        self.writer.write(data)
+        if self.capture is not None:
+            self.capture.sent(data)
+        return True
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            self._connected = False
+
+    def restore(self, data):
+        """ Takes back data received but not handled yet, e.g. by the
+            process that handed the connection over
+        """
+        self.detector.restore(data)
+        while self.detector.pending:
+            self.on_message(self.detector.pending.popleft())
+
+    async def detach(self):
+        """ Stops serving the connection without closing it, for the process
+            taking it over. Returns a duplicate of its file descriptor and the
+            data received on it but not handled yet.
+        """
+        transport = self.writer.transport
+        transport.pause_reading()
+        # The reader hands out what it already got, then the end of the stream
+        self.reader.feed_eof()
+        if self._reader_task is not None:
+            await self._reader_task
+            self._reader_task = None
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while transport.get_write_buffer_size() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        fd = os.dup(self.writer.get_extra_info('socket').fileno())
+        unread = b"".join(bytes(message.serialize()) for message in self.messages) + self.detector.unread()
+        self.messages.clear()
+        self.close()
+        return fd, unread
+
+    def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        self._connected = False
+        self.writer.close()
+
+
+class AsyncCDRStream(AsyncStream):
+    """ CDR collector leg. The collector only sends us XON/XOFF"""
+    file_mode = False
+    has_socket = True
+
+    def __init__(self, reader, writer, wakeup=None, site='default', capture=None, store=None):
+        super(AsyncCDRStream, self).__init__(reader, writer, wakeup, capture)
+        self.metrics = CDRMetrics(site)
+        self.store = store
+        self.flowing = asyncio.Event()
+        self.flowing.set()
+
+    def on_data(self, data):
+        if self.capture is not None:
+            self.capture.received(data)
+        xon = data.rfind(XON.get_type())
+        xoff = data.rfind(XOFF.get_type())
+        if xoff > xon:
+            self.logger.info("CDR collector paused the flow")
+            self.flowing.clear()
+        elif xon > xoff:
+            self.logger.info("CDR collector resumed the flow")
+            self.flowing.set()
+        return True
+
+    def _notify(self):
+        super(AsyncCDRStream, self)._notify()
+        if not self._connected:
+            # nobody is going to resume the flow anymore
+            self.flowing.set()
+
+    @property
+    def paused(self):
+        return not self.flowing.is_set()
+
+    def poll_flow(self):
+        pass
+
+    async def wait_flow(self):
+        await self.flowing.wait()
+        return self.connected
+
+    def send(self, message):
+        return self.send_many([message])
+
+    def send_many(self, messages):
+        started = time.monotonic()
+        if not self.connected:
+            self.logger.error("Cannot send to a closed socket")
+            self.metrics.done(started, len(messages), False)
+            return False
+        data = b"".join(message.serialize_cdr() for message in messages)
+        self.writer.write(data)
+        if self.capture is not None:
+            self.capture.sent(data)
+        self.metrics.done(started, len(messages), True)
+        if self.store is not None:
+            self.store.add_many(messages)
+        return True
+
+
+class AsyncCDRReplayer(CDRReplayer):
+    """ CDRReplayer running as a task of the event loop"""
+    def spawn(self):
+        return asyncio.ensure_future(self.run_async())
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+
+    async def run_async(self):
+        try:
+            while True:
+                if not await self.cdr.wait_flow():
+                    return self.batch_failed()
+                batch = self.next_batch()
+                if batch is None:
+                    return
+                if not self.cdr.send_many(batch):
+                    return self.batch_failed()
+                self.batch_sent(batch)
+                await self.cdr.drain()
+        except asyncio.CancelledError:
+            with self._lock:
+                self.buffer.rewind()
+                self.active = False
+            raise
+
+
+def cdr_replayer(buf, cdr):
+    """ The replayer for the CDR leg: a task for a collector connection, a
+        thread for the CDR file or the CDR fan-out
+    """
+    if isinstance(cdr, AsyncCDRStream):
+        return AsyncCDRReplayer(buf, cdr)
+    return CDRReplayer(buf, cdr)
+
+
+class Direction(object):
+    """ Frames forwarded from one leg to the other. At most `window` of them
+        wait for their reply at a time; the others wait in `pending`. The
+        replies come back in the order the frames were sent, so the oldest
+        outstanding frame is the one a reply belongs to.
+    """
+    def __init__(self, name, source, destination, window, rules):
+        self.name = name
+        self.source = source
+        self.destination = destination
+        self.window = window
+        # Rule of the frames of source, by message class (see omnipcx.rules)
+        self.rules = rules
+        self.pending = collections.deque()
+        # (frame, time.monotonic() when it was received, deadline of its reply)
+        self.outstanding = collections.deque()
+
+    def is_reply(self, message):
+        """ The message, coming from the destination, answers the oldest outstanding frame"""
+        if not self.outstanding:
+            return False
+        if isinstance(message, ControlMessage):
+            return True
+        return isinstance(message, REPLIES) and isinstance(self.outstanding[0][0], Interogation)
+
+    @property
+    def can_send(self):
+        return len(self.outstanding) < self.window
+
+    def expired(self, now):
+        return bool(self.outstanding) and now > self.outstanding[0][2]
+
+    def deadline(self):
+        return self.outstanding[0][2] if self.outstanding else None
+
+
+class AsyncProxy(ProxyBase):
+    """ Same forwarding rules as omnipcx.proxy.Proxy, but driven by the
+        event loop: a message is handled as soon as it arrives on either leg.
+
+        Up to `window` frames per direction are forwarded before their
+        replies come back. ACK, NACK and Reply frames are matched to the
+        frame they answer; anything else is a new frame to forward, even
+        when both ends send at the same time.
+    """
+    def __init__(self, pbx, hotel, cdr, default_password, buf, wakeup, site='default', window=1, rules=None,
+            keepalive_interval=0):
+        super(AsyncProxy, self).__init__(pbx, hotel, cdr, default_password, buf, cdr_replayer(buf, cdr), site, rules,
+            keepalive_interval)
+        # When Opera has to have answered our own KeepAlive, if it didn't yet, and
+        # when Opera last sent something. The KeepAlive isn't one of the frames
+        # of to_hotel: it takes no slot of the window and gets no reply to forward.
+        self.keepalive_deadline = None
+        self.opera_last_recv = time.monotonic()
+        self.wakeup = wakeup
+        self.to_hotel = Direction(PBX_TO_OPERA, pbx, hotel, window, self.rules.pbx)
+        self.to_pbx = Direction(OPERA_TO_PBX, hotel, pbx, window, self.rules.opera)
+        self.stopping = False
+
+    def stop(self):
+        """ Ends the session once no frame waits for its reply anymore. The
+            frames not forwarded yet stay in the pending queues.
+        """
+        self.stopping = True
+        if self.keepalive_deadline is not None:
+            # Its answer would reach the next session as a stray ACK, but not worth the MAX_TIME wait
+            self.keepalive_deadline = min(self.keepalive_deadline, time.monotonic() + REPLY_TIMEOUT)
+        self.wakeup.set()
+
+    async def drain(self):
+        for stream in (self.pbx, self.hotel, self.cdr):
+            if isinstance(stream, AsyncStream):
+                await stream.drain()
+
+    def reply(self, message, direction):
+        """ Sends back the reply to the oldest frame forwarded in direction"""
+        frame, started, _ = direction.outstanding.popleft()
+        reverse = OPERA_TO_PBX if direction.name == PBX_TO_OPERA else PBX_TO_OPERA
+        self.metrics.forwarded(reverse, message)
+        rule = (self.rules.opera if direction.destination is self.hotel else self.rules.pbx).get(message.__class__)
+        if rule is not None:
+            rule.rewrite(message)
+        if not direction.source.send(message):
+            if direction.source is self.pbx:
+                self.logger.error("PBX closed connection. Reseting all others")
+            else:
+                self.logger.error("Opera closed connection. Reseting all others")
+            return False
+        self.metrics.replied(direction.name, started)
+        return True
+
+    def forward_to_hotel(self, u_msg):
+        """ Forwards a frame from the PBX to Opera"""
+        self.logger.trace("Recv %s from pbx", u_msg.serialize())
+        if isinstance(u_msg, SMDR):
+            if not self.replayer.deliver(u_msg):
+                self.buffer.put(u_msg)
+                self.send_nack_to_pbx(log_msg="CDR collector closed connection. Reseting all others")
+                return False
+        self.logger.trace("Send %s to hotel", u_msg.serialize())
+        if not self.hotel.send(u_msg):
+            self.send_nack_to_pbx(log_msg="Opera closed connection. Reseting all others")
+            return False
+        return True
+
+    def forward_to_pbx(self, d_msg):
+        """ Forwards a frame from Opera to the PBX"""
+        self.logger.trace("Recv %s from hotel", d_msg.serialize())
+        self.logger.trace("Send %s to pbx", d_msg.serialize())
+        if not self.pbx.send(d_msg):
+            self.logger.error("PBX closed connection. Reseting all others")
+            return False
+        return True
+
+    def receive(self, stream, direction, reverse):
+        """ Sorts the messages received on stream, the source of direction:
+            replies to the frames of reverse are sent back at once, the
+            others wait for their turn in direction.
+        """
+        while stream.has_message():
+            message = stream.messages.popleft()
+            if stream is self.hotel and self.keepalive_deadline is not None and isinstance(message, ControlMessage):
+                # The KeepAlive went out before the frames outstanding now, its answer comes first
+                self.keepalive_deadline = None
+            elif reverse.is_reply(message):
+                if not self.reply(message, reverse):
+                    return False
+            else:
+                direction.pending.append(message)
+        return True
+
+    def pump(self, direction, forward):
+        while direction.pending and direction.can_send:
+            message = direction.pending[0]
+            rule = direction.rules.get(message.__class__)
+            if rule is not None and not rule.forward and direction.outstanding:
+                # our answer would overtake the replies to the frames forwarded before it
+                break
+            direction.pending.popleft()
+            self.metrics.forwarded(direction.name, message)
+            if rule is not None:
+                rule.rewrite(message)
+                if not rule.forward:
+                    if not self.drop(message, rule, direction.source):
+                        return False
+                    continue
+            if not forward(message):
+                return False
+            if not isinstance(message, ControlMessage):
+                # an ACK nobody waited for gets no reply
+                started = time.monotonic()
+                direction.outstanding.append((message, started, started + REPLY_TIMEOUT))
+        return True
+
+    def keep_opera_alive(self, now):
+        """ Sends a KeepAlive of our own to Opera when it was quiet for
+            keepalive_interval and nothing else waits for its answer. Returns
+            False when the session is over.
+        """
+        if not self.keepalive_interval or self.keepalive_deadline is not None or \
+                now - self.opera_last_recv < self.keepalive_interval or self.to_hotel.outstanding or self.to_hotel.pending:
+            return True
+        if not self.hotel.send(keepalive()):
+            self.logger.error("Opera closed connection. Reseting all others")
+            return False
+        # Opera has as long to answer it as to send anything (see forward())
+        self.keepalive_deadline = now + MAX_TIME
+        return True
+
+    async def run(self):
+        self.send_missing_cdr()
+        try:
+            return await self.forward()
+        finally:
+            self.replayer.stop()
+
+    async def forward(self):
+        time_last_recv = time.time()
+        while True:
+            if self.replayer.failed:
+                return self.logger.error("CDR collector closed connection. Reseting all others")
+            if self.pbx.has_message() or self.hotel.has_message():
+                time_last_recv = time.time()
+                if self.hotel.has_message():
+                    self.opera_last_recv = time.monotonic()
+                if not self.receive(self.pbx, self.to_hotel, self.to_pbx):
+                    return
+                if not self.receive(self.hotel, self.to_pbx, self.to_hotel):
+                    return
+            if not self.stopping and \
+                    (not self.pump(self.to_hotel, self.forward_to_hotel) or not self.pump(self.to_pbx, self.forward_to_pbx)):
+                return
+            await self.drain()
+            now = time.monotonic()
+            if not self.stopping and not self.keep_opera_alive(now):
+                return
+            keepalive_expired = self.keepalive_deadline is not None and now > self.keepalive_deadline
+            if keepalive_expired and not self.stopping:
+                return self.logger.error("Opera didn't answer the KeepAlive in %d s" % MAX_TIME)
+            if self.to_hotel.expired(now):
+                return self.logger.error("Timeout when waiting for message from Opera")
+            if self.to_pbx.expired(now):
+                return self.logger.error("Timeout when waiting for message from OLD/Hotel Driver")
+            if self.stopping and not self.to_hotel.outstanding and not self.to_pbx.outstanding and \
+                    (self.keepalive_deadline is None or keepalive_expired):
+                return self.logger.info("Stopping proxy operation")
+            self.wakeup.clear()
+            if self.pbx.has_message() or self.hotel.has_message():
+                continue
+            if self.pbx.closed:
+                return self.logger.error("PBX closed connection. Reseting all others")
+            if self.hotel.closed:
+                return self.logger.error("Opera closed connection. Reseting all others")
+            idle = MAX_TIME - (time.time() - time_last_recv)
+            deadlines = [deadline - now for deadline in (self.to_hotel.deadline(), self.to_pbx.deadline())
+                if deadline is not None]
+            if self.keepalive_deadline is not None:
+                deadlines.append(self.keepalive_deadline - now)
+            elif self.keepalive_interval and not (self.to_hotel.outstanding or self.to_hotel.pending):
+                # otherwise the KeepAlive waits for the replies, which wake us up
+                deadlines.append(self.opera_last_recv + self.keepalive_interval - now)
+            # A timer rather than wait_for(), which makes a task of every wait
+            timer = asyncio.get_running_loop().call_later(max(min([idle] + deadlines), 0), self.wakeup.set)
+            try:
+                await self.wakeup.wait()
+            finally:
+                timer.cancel()
+            if not (self.pbx.has_message() or self.hotel.has_message()) and time.time() - time_last_recv >= MAX_TIME:
+                return self.logger.warn("The connections were innactive for too long. We are probably disconnected ...")
+
+
+class AsyncEngine(Loggable):
+    """ Accepts Opera connections and runs an AsyncProxy for each of them.
+        Like the polling engine, only one Opera session is served at a time.
+
+        The OLD and CDR connections are opened once and kept warm between
+        the sessions by the keep_warm() task, like Upstreams does for the
+        polling engine.
+    """
+    def __init__(self, name, args, cdr_buffer, retries, capture=None, inherited=None, store=None, rules=None):
+        super(AsyncEngine, self).__init__()
+        self.name = name
+        self.capture = capture
+        self.store = store
+        self.rules = rules
+        self.args = args
+        self.cdr_buffer = cdr_buffer
+        self.retries = retries
+        self.family = socket.AF_INET6 if args.ipv6 else socket.AF_INET
+        # Reconnection of the OLD and CDR legs between the sessions
+        self.backoff = {
+            'pbx': connector.Backoff(maximum=args.retry_sleep),
+            'cdr': connector.Backoff(maximum=args.retry_sleep),
+        }
+        self.session_lock = None
+        # The CDR file or the CDR fan-out, used by all the sessions
+        self.shared_cdr = None
+        if args.cdr_file_name or args.cdr_sinks:
+            self.shared_cdr = cdr_leg_from_args(args, name)
+            self.shared_cdr.capture = self.leg_capture(CDR)
+            self.shared_cdr.store = store
+        self.old_stream = None
+        self.cdr_stream = self.shared_cdr
+        self.health = HealthCheck(args.health_check_interval)
+        self.idle_task = None
+        self.idle_stop = False
+        self.idle_wakeup = None
+        # SiteState handed over by the previous process, and to the next one
+        self.inherited = inherited
+        self.handoff = None
+        self.loop = None
+        self.server = None
+        self.proxy = None
+        self.stopped = None
+
+    def leg_capture(self, leg):
+        return self.capture.leg(leg) if self.capture is not None else None
+
+    async def open_connection(self, leg, address, port, wakeup, stream_class=AsyncStream, **options):
+        self.logger.info("Trying to open a connection to %s:%s" % (address, port))
+        try:
+            sock = await connector.connect_async(address, port, prefer_ipv6=self.args.ipv6)
+            if sock is None:
+                raise ConnectionError("No address of %s answered" % address)
+            return await self.adopt(leg, sock, wakeup, stream_class, **options)
+        except (ConnectionError, OSError):
+            connection(self.name, leg, False)
+            return None
+
+    async def adopt(self, leg, sock, wakeup, stream_class=AsyncStream, **options):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        connection(self.name, leg, True)
+        return stream_class(reader, writer, wakeup, **options)
+
+    async def connect_cdr(self):
+        if self.shared_cdr is not None:
+            # The CDR file or the fan-out, opened again after every session
+            connected = self.shared_cdr.connected or self.shared_cdr.connect()
+            if self.shared_cdr.has_socket:
+                connection(self.name, 'cdr', connected)
+            return connected
+        if self.cdr_stream is not None and self.cdr_stream.connected:
+            return True
+        if self.cdr_stream is not None:
+            self.cdr_stream.close()
+        self.cdr_stream = await self.open_connection('cdr', self.args.cdr_address, self.args.cdr_port,
+            self.idle_wakeup, AsyncCDRStream, site=self.name, capture=self.leg_capture(CDR), store=self.store)
+        return self.cdr_stream is not None
+
+    async def connect_old(self):
+        if self.old_stream is not None and self.old_stream.connected:
+            return True
+        if self.old_stream is not None:
+            self.old_stream.close()
+        self.old_stream = await self.open_connection('pbx', self.args.old_address, self.args.old_port,
+            self.idle_wakeup, capture=self.leg_capture(PBX))
+        self.health.reset()
+        return self.old_stream is not None
+
+    async def connect_upstreams(self):
+        """ Opens the OLD and CDR connections that aren't open, both at the
+            same time. Gives up after `retries` times --retry-sleep seconds.
+        """
+        deadline = time.monotonic() + self.retries * self.args.retry_sleep
+        backoff = connector.Backoff(maximum=self.args.retry_sleep)
+        while True:
+            cdr_connected, old_connected = await asyncio.gather(self.connect_cdr(), self.connect_old())
+            if old_connected and cdr_connected:
+                return True
+            delay = backoff.next_delay()
+            if time.monotonic() + delay > deadline:
+                break
+            if not old_connected:
+                self.logger.warn("Couldn't open connection to OLD. Waiting ...")
+            else:
+                self.logger.warn("Couldn't open connection to CDR. Waiting ...")
+            await asyncio.sleep(delay)
+        if self.old_stream is None:
+            self.logger.error("Couldn't connect to OLD. Giving up.")
+        else:
+            self.logger.error("Couldn't connect to CDR collector. Giving up.")
+        return False
+
+    def set_wakeup(self, wakeup):
+        """ Wakes up whoever serves the OLD and CDR connections on new data"""
+        for stream in (self.old_stream, self.cdr_stream):
+            if isinstance(stream, AsyncStream):
+                stream.wakeup = wakeup
+
+    def start_keep_warm(self):
+        self.idle_stop = False
+        self.idle_task = asyncio.ensure_future(self.keep_warm())
+
+    async def stop_keep_warm(self):
+        if self.idle_task is None:
+            return
+        # wait_for() may swallow the cancellation, the flag ends the loop anyway
+        self.idle_stop = True
+        self.idle_task.cancel()
+        try:
+            await self.idle_task
+        except asyncio.CancelledError:
+            pass
+        self.idle_task = None
+
+    async def keep_warm(self):
+        """ Serves the OLD and CDR connections between the Opera sessions.
+            They are reconnected when they drop, the PBX is answered (see
+            answer_idle) and checked with a KeepAlive when it is quiet.
+        """
+        self.idle_wakeup = asyncio.Event()
+        self.set_wakeup(self.idle_wakeup)
+        replayer = cdr_replayer(self.cdr_buffer, self.cdr_stream) if self.cdr_stream is not None else None
+        if replayer is not None and self.cdr_stream.connected:
+            replayer.start()
+        try:
+            while not self.idle_stop:
+                if replayer is not None and replayer.failed:
+                    self.cdr_stream.close()
+                    replayer = None
+                legs = []
+                now = time.monotonic()
+                if not (self.cdr_stream is not None and self.cdr_stream.connected) and self.backoff['cdr'].ready(now):
+                    legs.append(('cdr', self.connect_cdr))
+                if not (self.old_stream is not None and self.old_stream.connected) and self.backoff['pbx'].ready(now):
+                    legs.append(('pbx', self.connect_old))
+                results = await asyncio.gather(*[connect() for _, connect in legs])
+                for (leg, _), connected in zip(legs, results):
+                    if not connected:
+                        self.backoff[leg].failed(time.monotonic())
+                        continue
+                    self.backoff[leg].reset()
+                    if leg == 'cdr':
+                        self.logger.info("Reconnected to the CDR collector")
+                        replayer = cdr_replayer(self.cdr_buffer, self.cdr_stream)
+                        replayer.start()
+                    else:
+                        self.logger.info("Reconnected to OLD")
+                timeout = self.args.retry_sleep
+                for leg, stream in (('cdr', self.cdr_stream), ('pbx', self.old_stream)):
+                    if stream is None or not stream.connected:
+                        timeout = min(timeout, max(self.backoff[leg].next_attempt - time.monotonic(), 0))
+                if self.old_stream is not None and self.old_stream.connected:
+                    await self.serve_pbx(replayer)
+                    next_check = self.health.next_event(time.monotonic())
+                    if next_check is not None:
+                        timeout = min(timeout, next_check)
+                self.idle_wakeup.clear()
+                if self.old_stream is not None and self.old_stream.has_message():
+                    continue
+                try:
+                    await asyncio.wait_for(self.idle_wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if replayer is not None:
+                replayer.stop()
+
+    async def serve_pbx(self, replayer):
+        old = self.old_stream
+        while old.has_message():
+            message = old.messages.popleft()
+            self.health.received(message)
+            answer = answer_idle(message, replayer, self.cdr_buffer, self.logger)
+            if answer is not None:
+                old.send(answer)
+        now = time.monotonic()
+        if self.health.failed(now):
+            self.logger.error("OLD didn't acknowledge the KeepAlive. Reconnecting")
+            return old.close()
+        if self.health.due(now) and old.send(keepalive()):
+            self.health.sent = now
+        await old.drain()
+
+    async def handle_opera(self, reader, writer, unread=b""):
+        async with self.session_lock:
+            connection(self.name, 'opera', True)
+            if self.handoff is not None:
+                # Accepted just before the handoff
+                opera_stream = AsyncStream(reader, writer)
+                if self.handoff.done.is_set() or 'opera' in self.handoff:
+                    return opera_stream.close()
+                return self.handoff.add('opera', *await opera_stream.detach())
+            if self.capture is not None:
+                self.capture.session()
+            await self.stop_keep_warm()
+            try:
+                await self.run_session(reader, writer, unread)
+            finally:
+                if self.handoff is None:
+                    self.start_keep_warm()
+
+    async def run_session(self, reader, writer, unread=b""):
+        wakeup = asyncio.Event()
+        opera_stream = AsyncStream(reader, writer, wakeup, self.leg_capture(HOTEL))
+        opera_stream.restore(unread)
+        if not await self.connect_upstreams():
+            opera_stream.close()
+            return
+        self.set_wakeup(wakeup)
+        self.logger.info("Received Opera connection. Starting proxy operation")
+        proxy = self.proxy = AsyncProxy(self.old_stream, opera_stream, self.cdr_stream, self.args.default_password,
+            self.cdr_buffer, wakeup, site=self.name, window=self.args.window, rules=self.rules,
+            keepalive_interval=self.args.local_keepalive)
+        try:
+            await proxy.run()
+        except Exception:
+            self.logger.exception("Caught an exception in the main loop of the proxy")
+        finally:
+            self.proxy = None
+            if self.handoff is not None:
+                # Hand the frames that weren't forwarded over with their connection
+                self.old_stream.messages.extendleft(reversed(proxy.to_hotel.pending))
+                opera_stream.messages.extendleft(reversed(proxy.to_pbx.pending))
+                if opera_stream.connected:
+                    self.handoff.add('opera', *await opera_stream.detach())
+            # The OLD and CDR connections stay open for the next session
+            opera_stream.close()
+            if proxy.replayer.failed or self.cdr_stream.file_mode:
+                self.cdr_stream.close()
+            self.health.reset(check_now=True)
+            if self.capture is not None:
+                self.capture.flush()
+
+    async def take_over(self, state):
+        """ Uses the connections handed over by the previous process (see
+            omnipcx.handoff). Returns the arguments of handle_opera() for
+            the Opera session that was going on, or None.
+        """
+        sock = state.socket('pbx')
+        if sock is not None:
+            self.old_stream = await self.adopt('pbx', sock, None, capture=self.leg_capture(PBX))
+            self.old_stream.restore(state.unread('pbx'))
+        sock = state.socket('cdr')
+        if sock is not None and self.shared_cdr is None:
+            self.cdr_stream = await self.adopt('cdr', sock, None, AsyncCDRStream,
+                site=self.name, capture=self.leg_capture(CDR), store=self.store)
+            if state.info('cdr', 'paused', False):
+                self.cdr_stream.flowing.clear()
+        session = None
+        sock = state.socket('opera')
+        if sock is not None:
+            reader, writer = await asyncio.open_connection(sock=sock)
+            session = (reader, writer, state.unread('opera'))
+        state.close()
+        return session
+
+    async def hand_off(self, state):
+        """ Stops the site at a frame boundary and adds its connections to
+            the SiteState handed over to the next process
+        """
+        self.handoff = state
+        state.add('listener', os.dup(self.server.sockets[0].fileno()))
+        # Stop accepting, the connections waiting in the backlog go with the socket
+        self.server.close()
+        if self.proxy is not None:
+            self.proxy.stop()
+        async with self.session_lock:
+            await self.stop_keep_warm()
+            if self.old_stream is not None and self.old_stream.connected:
+                state.add('pbx', *await self.old_stream.detach())
+            if isinstance(self.cdr_stream, AsyncCDRStream) and self.cdr_stream.connected:
+                paused = self.cdr_stream.paused
+                fd, _ = await self.cdr_stream.detach()
+                state.add('cdr', fd, paused=paused)
+            state.done.set()
+        self.stopped.set()
+
+    def hand_off_threadsafe(self, state):
+        """ hand_off() called from another thread. Returns the SiteState"""
+        if self.loop is None or self.server is None:
+            return state
+        try:
+            asyncio.run_coroutine_threadsafe(self.hand_off(state), self.loop).result(EXIT_TIMEOUT)
+        except (RuntimeError, concurrent.futures.TimeoutError):
+            self.logger.error("Site %s couldn't hand its connections over", self.name)
+        return state
+
+    async def serve(self):
+        self.session_lock = asyncio.Lock()
+        self.stopped = asyncio.Event()
+        session = None
+        sock = None
+        if self.inherited is not None:
+            sock = self.inherited.socket('listener')
+            session = await self.take_over(self.inherited)
+        try:
+            if sock is not None:
+                server = await asyncio.start_server(self.handle_opera, sock=sock)
+            else:
+                server = await asyncio.start_server(self.handle_opera, port=self.args.opera_port,
+                    family=self.family, reuse_address=True)
+        except OSError:
+            return self.logger.error("Cannot listen on port %s. Maybe there is another process listening to that port?" % self.args.opera_port)
+        self.logger.info("Listening on port %d ...", self.args.opera_port)
+        self.server = server
+        self.loop = asyncio.get_running_loop()
+        if session is not None:
+            # The frames received for the session that was going on are its own
+            asyncio.ensure_future(self.handle_opera(*session))
+        else:
+            self.start_keep_warm()
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            await self.stop_keep_warm()
+            for stream in (self.old_stream, self.cdr_stream):
+                if isinstance(stream, AsyncStream):
+                    stream.close()
+            if self.shared_cdr is not None:
+                self.shared_cdr.shutdown()
+
+    def run(self):
+        asyncio.run(self.serve())
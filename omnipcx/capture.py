@@ -0,0 +1,120 @@
+""" Capture of the wire traffic of the proxy, to replay incidents later.
+
+    A capture file starts with MAGIC, followed by records made of a HEADER
+    (timestamp, leg, event, length of the data) and the data. Received data
+    is recorded as it came from the socket, before it is parsed, so that
+    split and invalid frames are replayed as they happened. Sent data is
+    recorded as it was written. A SESSION record marks every new Opera
+    session.
+"""
+import collections, struct, threading, time
+from omnipcx.logging import Loggable
+
+MAGIC = b"OPCXCAP1"
+HEADER = struct.Struct("<dBBI")
+
+# Legs
+PBX = 0
+HOTEL = 1
+CDR = 2
+LEG_NAMES = {PBX: 'pbx', HOTEL: 'hotel', CDR: 'cdr'}
+
+# Events
+RECEIVED = 0
+SENT = 1
+SESSION = 2
+
+BUFFER_SIZE = 64 * 1024
+# Buffered records are written at least this often (seconds)
+FLUSH_INTERVAL = 1.0
+
+Record = collections.namedtuple('Record', ['timestamp', 'leg', 'event', 'data'])
+
+
+class LegCapture(object):
+    """ Records the traffic of one leg"""
+    __slots__ = ('writer', 'leg')
+
+    def __init__(self, writer, leg):
+        self.writer = writer
+        self.leg = leg
+
+    def received(self, data):
+        self.writer.record(self.leg, RECEIVED, data)
+
+    def sent(self, data):
+        self.writer.record(self.leg, SENT, data)
+
+
+class CaptureWriter(Loggable):
+    """ Appends records to a capture file. Records are buffered and written
+        to the file when the buffer is full, when a session ends, or with the
+        first record after FLUSH_INTERVAL seconds.
+    """
+    def __init__(self, filename):
+        super(CaptureWriter, self).__init__()
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._file = open(filename, "ab", buffering=BUFFER_SIZE)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._last_flush = time.time()
+        self.logger.info("Capturing the traffic to %s", filename)
+
+    def leg(self, leg):
+        return LegCapture(self, leg)
+
+    def record(self, leg, event, data):
+        now = time.time()
+        header = HEADER.pack(now, leg, event, len(data))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(header)
+                self._file.write(data)
+                if now - self._last_flush >= FLUSH_INTERVAL:
+                    self._file.flush()
+                    self._last_flush = now
+
+    def session(self):
+        self.record(PBX, SESSION, b"")
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(filename):
+    """ Yields the records of a capture file. A record cut by a crash ends it"""
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a capture file" % filename)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            timestamp, leg, event, length = HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield Record(timestamp, leg, event, data)
+
+
+def sessions(records):
+    """ Splits the records into sessions, as lists of records"""
+    session = []
+    for record in records:
+        if record.event == SESSION:
+            if session:
+                yield session
+            session = []
+        else:
+            session.append(record)
+    if session:
+        yield session
@@ -1,58 +1,205 @@
-import os, os.path, sqlite3, queue
+import collections, os, os.path, sqlite3, threading
 from omnipcx.logging import Loggable
 from omnipcx.messages.protocol import SMDR
+from omnipcx.messages import crc
+
+# How many buffered CDRs are read from the database at once
+READ_AHEAD = 500
+
 
 class CDRBuffer(Loggable):
-    def __init__(self, file):
+    """ Durable FIFO queue of the CDRs the collector didn't get yet.
+
+        Every CDR is written to a SQLite database (in WAL mode) as soon as it
+        is buffered, so a crash doesn't lose it. get() hands them out oldest
+        first. They stay in the database until ack() confirms the collector
+        got them; rewind() hands out the unacknowledged ones again.
+    """
+    def __init__(self, file, verify_crc=False, batch_size=1):
         super(CDRBuffer, self).__init__()
-        self.queue = queue.LifoQueue()
         self.db_file = file
+        self.verify_crc = verify_crc
+        self.batch_size = max(batch_size, 1)
+        self._db = None
+        self._lock = threading.RLock()
+        self._uncommitted = 0
+        self._count = 0             # CDRs in the database, not acknowledged
+        self._read_id = 0           # id of the last CDR handed out by get()
+        self._read_ahead = collections.deque()
+        self._handed_out = collections.deque()
+        # Gets the put() and ack() of the active node of an HA pair (see omnipcx.ha)
+        self.replication = None
+        # CDRDedup of the live CDRs, saved in the database (see omnipcx.cdr_dedup)
+        self.dedup = None
 
-    def put(self, message):
-        self.queue.put(message, False)
-
-    def get(self):
-        try:
-            return self.queue.get(False)
-        except queue.Empty:
-            return None
+    def __len__(self):
+        return self._count
 
     @property
     def is_empty(self):
-        return self.queue.empty()
+        """ There is nothing more to get()"""
+        return self._count - len(self._handed_out) <= 0
+
+    def _open(self):
+        db = sqlite3.connect(self.db_file, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in db.execute("PRAGMA table_info(cdr)")]
+        if columns and "id" not in columns:
+            # Buffer saved by an older version, oldest CDR first
+            self.logger.info("Converting the buffer database to the new format")
+            with db:
+                db.execute("ALTER TABLE cdr RENAME TO cdr_old")
+                db.execute("CREATE TABLE cdr(id INTEGER PRIMARY KEY AUTOINCREMENT, payload BLOB)")
+                db.execute("INSERT INTO cdr(payload) SELECT payload FROM cdr_old ORDER BY rowid")
+                db.execute("DROP TABLE cdr_old")
+        elif not columns:
+            self.logger.debug("Creating buffer database")
+            db.execute("CREATE TABLE cdr(id INTEGER PRIMARY KEY AUTOINCREMENT, payload BLOB)")
+            db.commit()
+        return db
 
     def load(self):
-        if not os.path.exists(self.db_file):
-            return self.logger.warn("CDR buffer database doesn't exist. No need to load!")
-        self.logger.info("Loading buffer from database")
-        db_conn = sqlite3.connect(self.db_file)
-        cursor = db_conn.cursor()
-        for row in cursor.execute("SELECT * FROM cdr"):
-            self.logger.debug("Loading message : '%s'" % row[0])
-            self.queue.put(SMDR(row[0], with_ends=False))
+        with self._lock:
+            if self._db is not None:
+                return
+            if not os.path.exists(self.db_file):
+                self.logger.info("CDR buffer database doesn't exist. Creating it")
+            self._db = self._open()
+            if self.verify_crc:
+                self._quarantine_corrupt()
+            self._count = self._db.execute("SELECT COUNT(*) FROM cdr").fetchone()[0]
+            if self._count:
+                self.logger.info("Loaded %d buffered CDRs from database" % self._count)
+            if self.dedup is not None:
+                self._db.execute("CREATE TABLE IF NOT EXISTS dedup(hash BLOB PRIMARY KEY, seen REAL)")
+                self.dedup.restore(self._db.execute("SELECT hash, seen FROM dedup ORDER BY seen"))
 
-    def save(self):
-        try:
-            os.remove(self.db_file)
-        except OSError:
-            pass
-        if self.is_empty:
-            return self.logger.warn("CDR buffer is empty. No need to save!")
-        db_conn = sqlite3.connect(self.db_file)
-        cursor = db_conn.cursor()
-        self.logger.debug("Creating buffer database")
-        cursor.execute('CREATE TABLE cdr(payload text)')
-        self.logger.info("Saving buffered CDRs to database")
-        payloads=[]
-        while True:
-            item = self.get()
-            if item is None:
-                break
-            payloads.insert(0, (item.payload,))
-        cursor.executemany('INSERT INTO cdr VALUES(?)', payloads)
-        db_conn.commit()
-        db_conn.close()
+    def _quarantine_corrupt(self):
+        """ Moves the buffered CDRs with an invalid CRC to the cdr_corrupt
+            table, where they are kept but not forwarded. They may have been
+            buffered while the CRCs weren't checked.
+        """
+        rows = self._db.execute("SELECT id, payload FROM cdr ORDER BY id").fetchall()
+        valid = crc.verify_many([row[1] for row in rows])
+        corrupt = [row for row, ok in zip(rows, valid) if not ok]
+        if not corrupt:
+            return
+        for _id, payload in corrupt:
+            self.logger.warn("Buffered CDR %d has an invalid CRC: %r" % (_id, bytes(payload)))
+        self.logger.error("Moved %d buffered CDRs with invalid CRC to table cdr_corrupt of %s, they aren't forwarded"
+            % (len(corrupt), self.db_file))
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS cdr_corrupt(id INTEGER PRIMARY KEY, payload BLOB)")
+            self._db.executemany("INSERT OR REPLACE INTO cdr_corrupt(id, payload) VALUES(?, ?)", corrupt)
+            self._db.executemany("DELETE FROM cdr WHERE id = ?", [(row[0],) for row in corrupt])
+
+    def _commit(self):
+        if self._uncommitted:
+            self._db.commit()
+            self._uncommitted = 0
 
+    def is_duplicate(self, message):
+        """ Whether the PBX sent this live CDR already"""
+        return self.dedup is not None and self.dedup.seen(bytes(message.payload))
 
+    def put(self, message):
+        self.put_many([message])
+
+    def put_many(self, messages):
+        payloads = [bytes(message.payload) for message in messages]
+        with self._lock:
+            self._db.executemany("INSERT INTO cdr(payload) VALUES(?)", [(payload,) for payload in payloads])
+            self._count += len(messages)
+            self._uncommitted += len(messages)
+            if self._uncommitted >= self.batch_size:
+                self._commit()
+            if self.replication is not None and payloads:
+                # The ids are consecutive, nobody else inserts while we hold the lock
+                last_id = self._db.execute("SELECT last_insert_rowid()").fetchone()[0]
+                first_id = last_id - len(payloads) + 1
+                self.replication.put([(first_id + i, payload) for i, payload in enumerate(payloads)])
+
+    def get(self):
+        with self._lock:
+            if not self._read_ahead:
+                self._commit()
+                self._read_ahead.extend(self._db.execute(
+                    "SELECT id, payload FROM cdr WHERE id > ? ORDER BY id LIMIT ?", (self._read_id, READ_AHEAD)))
+                if not self._read_ahead:
+                    return None
+            _id, payload = self._read_ahead.popleft()
+            self._read_id = _id
+            self._handed_out.append(_id)
+            return SMDR(payload, with_ends=False)
+
+    def ack(self, count=None):
+        """ The first `count` CDRs handed out (all of them by default) reached
+            the collector. They are deleted from the database.
+        """
+        with self._lock:
+            if count is None or count > len(self._handed_out):
+                count = len(self._handed_out)
+            if count == 0:
+                return
+            for _ in range(count - 1):
+                self._handed_out.popleft()
+            last_id = self._handed_out.popleft()
+            self._db.execute("DELETE FROM cdr WHERE id <= ?", (last_id,))
+            self._db.commit()
+            self._count -= count
+            if self.replication is not None:
+                self.replication.ack(last_id)
 
+    def rewind(self):
+        """ Hand out again the CDRs that weren't acknowledged"""
+        with self._lock:
+            if self._handed_out:
+                self._read_id = self._handed_out[0] - 1
+            self._handed_out.clear()
+            self._read_ahead.clear()
 
+    def snapshot(self, callback):
+        """ Calls callback with all the (id, payload) rows of the database,
+            with no put() or ack() in between
+        """
+        with self._lock:
+            if self._db is None:
+                return
+            callback(self._db.execute("SELECT id, payload FROM cdr ORDER BY id").fetchall())
+
+    def apply_put(self, rows, reset=False):
+        """ Stores the CDRs put in the buffer of the active node, with their
+            ids. With `reset`, they replace all the buffered ones.
+        """
+        with self._lock:
+            if reset:
+                self._db.execute("DELETE FROM cdr")
+                self._count = 0
+                self._read_id = 0
+                self._read_ahead.clear()
+                self._handed_out.clear()
+            cursor = self._db.executemany("INSERT OR IGNORE INTO cdr(id, payload) VALUES(?, ?)", rows)
+            self._db.commit()
+            self._count += cursor.rowcount
+
+    def apply_ack(self, last_id):
+        """ The collector of the active node got the CDRs up to last_id"""
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM cdr WHERE id <= ?", (last_id,))
+            self._db.commit()
+            self._count -= cursor.rowcount
+
+    def save(self):
+        with self._lock:
+            if self._db is None:
+                return
+            self._commit()
+            if self._count:
+                self.logger.info("%d CDRs are still buffered in the database" % self._count)
+            if self.dedup is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM dedup")
+                    self._db.executemany("INSERT OR REPLACE INTO dedup(hash, seen) VALUES(?, ?)", self.dedup.items())
+            self._db.close()
+            self._db = None
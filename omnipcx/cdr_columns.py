@@ -0,0 +1,245 @@
+""" Bulk decoding of SMDR payloads into typed columns, and the columnar
+    export of `proxy cdr export`.
+
+    A batch of payloads is joined into one buffer of fixed-width records,
+    and struct.iter_unpack() cuts each field out of all of them in one pass,
+    at the stride of a record, into a column; every column is
+    then converted at once (int() over the whole column, one decode() per
+    text column, one mktime() per day). The fields are the ones of SMDR in
+    omnipcx.messages.protocol.
+
+    The columnar file is a sequence of row groups, each made of:
+        4 bytes    length of the header (big endian)
+        header     JSON: {"rows": n, "columns": [{"name", "type", "size"}, ...]}
+        columns    in the order of the header, `size` bytes each
+    after the MAGIC at the start of the file. Type "int64" is a little
+    endian 64 bit integer per row, -1 when the field wasn't valid. Type
+    "utf8" is rows + 1 little endian 32 bit offsets into the UTF-8 data
+    that follows them, like Arrow string arrays.
+"""
+import array, csv, datetime, gzip, itertools, json, lzma, sqlite3, struct, sys, time
+from omnipcx.messages.protocol import SMDR
+
+MAGIC = b"OMNIPCX-CDR-COLUMNS-1\n"
+HEADER = struct.Struct("!I")
+# CDRs decoded and written at once
+BATCH_SIZE = 100000
+MISSING = -1
+RECORD_SIZE = SMDR.get_size() - 2
+
+FORMAT_CSV = 'csv'
+FORMAT_COLUMNS = 'columns'
+FORMATS = [FORMAT_CSV, FORMAT_COLUMNS]
+
+# The start time is the date and the time, which follow each other
+assert SMDR.START_DATE[0] + SMDR.START_DATE[1] == SMDR.START_TIME[0]
+# (name, offset, length, type) of the fields, by offset
+FIELDS = sorted([
+    ('start', SMDR.START_DATE[0], SMDR.START_DATE[1] + SMDR.START_TIME[1], 'time'),
+    ('extension', SMDR.EXTENSION[0], SMDR.EXTENSION[1], 'utf8'),
+    ('dialled', SMDR.DIALLED[0], SMDR.DIALLED[1], 'utf8'),
+    ('duration', SMDR.DURATION[0], SMDR.DURATION[1], 'int64'),
+    ('cost', SMDR.COST[0], SMDR.COST[1], 'int64'),
+], key=lambda field: field[1])
+COLUMNS = ('start', 'extension', 'dialled', 'duration', 'cost')
+
+
+# Cuts a field out of every record of a buffer
+FIELD_STRUCTS = [struct.Struct("%dx%ds%dx" % (offset, length, RECORD_SIZE - offset - length))
+    for _, offset, length, _ in FIELDS]
+
+
+def _day(date):
+    """ The local midnight of a DDMMYY date, in seconds since the epoch, and
+        whether the day lasts 24 hours (the clock isn't moved that day), or
+        None if the date isn't valid
+    """
+    year = int(date[4:6])
+    try:
+        day = datetime.date(year + (2000 if year < 70 else 1900), int(date[2:4]), int(date[0:2]))
+    except ValueError:
+        return None
+    midnight = time.mktime(day.timetuple())
+    return int(midnight), time.mktime((day + datetime.timedelta(days=1)).timetuple()) - midnight == 86400
+
+
+def start_time(value, days=None):
+    """ Seconds since the epoch of a DDMMYYHHMM start time, in local time, or
+        None. `days` caches the days by date.
+    """
+    if len(value) != 10 or not value.isdigit():
+        return None
+    days = {} if days is None else days
+    day = days.get(value[:6], False)
+    if day is False:
+        day = days[value[:6]] = _day(value[:6])
+    hour, minute = int(value[6:8]), int(value[8:10])
+    if day is None or hour > 23 or minute > 59:
+        return None
+    midnight, regular = day
+    if regular:
+        return midnight + hour * 3600 + minute * 60
+    start = datetime.datetime.fromtimestamp(midnight).replace(hour=hour, minute=minute)
+    return int(time.mktime(start.timetuple()))
+
+
+def _times(column):
+    days = {}
+    starts = dict((value, start_time(value, days)) for value in set(column))
+    return [starts[value] for value in column]
+
+
+def _strings(column):
+    values = b"\n".join(column).decode('ascii', 'replace').split("\n")
+    if len(values) != len(column):
+        # a field had a newline in it
+        values = [value.decode('ascii', 'replace') for value in column]
+    return list(map(str.strip, values))
+
+
+def _numbers(column):
+    try:
+        return list(map(int, column))
+    except ValueError:
+        return [int(value) if value.strip().isdigit() else None for value in column]
+
+
+DECODERS = {'time': _times, 'utf8': _strings, 'int64': _numbers}
+
+
+def decode(payloads):
+    """ The columns of a batch of SMDR payloads, as a dict of lists by
+        column name. A field that isn't valid is None.
+    """
+    if set(map(len, payloads)) == {RECORD_SIZE}:
+        data = b"".join(payloads)
+    else:
+        data = b"".join(bytes(payload[:RECORD_SIZE]).ljust(RECORD_SIZE) for payload in payloads)
+    if not data:
+        return dict((name, []) for name in COLUMNS)
+    return dict((name, DECODERS[kind]([value for value, in field.iter_unpack(data)]))
+        for (name, _, _, kind), field in zip(FIELDS, FIELD_STRUCTS))
+
+
+def read_payloads(filename):
+    """ The SMDR payloads of a CDR buffer or store database (.db), or of a
+        CDR file or its archives (.gz and .xz are decompressed), by batch
+    """
+    if filename.endswith(".db"):
+        db = sqlite3.connect("file:%s?mode=ro" % filename, uri=True)
+        try:
+            cursor = db.execute("SELECT payload FROM cdr ORDER BY id")
+            while True:
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if not rows:
+                    return
+                yield [row[0] for row in rows]
+        finally:
+            db.close()
+    opener = gzip.open if filename.endswith(".gz") else lzma.open if filename.endswith(".xz") else open
+    with opener(filename, "rb") as f:
+        rest = b""
+        while True:
+            chunk = f.read(BATCH_SIZE * (RECORD_SIZE + 2))
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop() if chunk else b""
+            batch = [line for line in (line.rstrip(b"\r") for line in lines) if line]
+            if batch:
+                yield batch
+            if not chunk:
+                return
+
+
+class CSVWriter(object):
+    def __init__(self, f):
+        self.f = f
+        self.writer = csv.writer(f)
+        self.writer.writerow(COLUMNS)
+        self._times = {}
+
+    def _format(self, start):
+        text = self._times.get(start, None)
+        if text is None:
+            text = self._times[start] = "" if start is None else \
+                time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start))
+        return text
+
+    def write(self, columns):
+        columns = dict(columns, start=[self._format(start) for start in columns['start']])
+        self.writer.writerows(zip(*[columns[name] for name in COLUMNS]))
+
+
+class ColumnWriter(object):
+    """ Writes the columns in the format described at the top"""
+    TYPES = {'start': 'int64', 'extension': 'utf8', 'dialled': 'utf8', 'duration': 'int64', 'cost': 'int64'}
+
+    def __init__(self, f):
+        self.f = f
+        self.f.write(MAGIC)
+
+    @staticmethod
+    def _little_endian(values):
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values.tobytes()
+
+    def _int64(self, column):
+        return self._little_endian(array.array('q', [MISSING if value is None else value for value in column]))
+
+    def _utf8(self, column):
+        data = "".join(column).encode('utf-8')
+        if len(data) == sum(map(len, column)):
+            lengths = map(len, column)
+        else:
+            lengths = (len(value.encode('utf-8')) for value in column)
+        offsets = array.array('i', itertools.accumulate(lengths, initial=0))
+        return self._little_endian(offsets) + data
+
+    def write(self, columns):
+        blobs = [(name, self.TYPES[name], getattr(self, "_" + self.TYPES[name])(columns[name])) for name in COLUMNS]
+        header = json.dumps({'rows': len(columns['start']),
+            'columns': [{'name': name, 'type': kind, 'size': len(blob)} for name, kind, blob in blobs]}).encode()
+        self.f.write(HEADER.pack(len(header)) + header)
+        for _, _, blob in blobs:
+            self.f.write(blob)
+
+
+def read_columns(f):
+    """ The row groups of a columnar file, as dicts of lists by column name"""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a CDR columns file")
+    while True:
+        size = f.read(HEADER.size)
+        if not size:
+            return
+        header = json.loads(f.read(HEADER.unpack(size)[0]).decode())
+        rows = header['rows']
+        columns = {}
+        for column in header['columns']:
+            blob = f.read(column['size'])
+            if column['type'] == 'int64':
+                values = array.array('q')
+                values.frombytes(blob)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                columns[column['name']] = [None if value == MISSING else value for value in values]
+            else:
+                offsets = array.array('i')
+                offsets.frombytes(blob[:4 * (rows + 1)])
+                if sys.byteorder == 'big':
+                    offsets.byteswap()
+                data = blob[4 * (rows + 1):]
+                columns[column['name']] = [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(rows)]
+        yield columns
+
+
+def export(inputs, output, output_format=FORMAT_CSV):
+    """ Writes the CDRs of the input files to output. Returns how many"""
+    count = 0
+    with open(output, "w", newline="") if output_format == FORMAT_CSV else open(output, "wb") as f:
+        writer = CSVWriter(f) if output_format == FORMAT_CSV else ColumnWriter(f)
+        for filename in inputs:
+            for payloads in read_payloads(filename):
+                writer.write(decode(payloads))
+                count += len(payloads)
+    return count
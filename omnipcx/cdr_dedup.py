@@ -0,0 +1,70 @@
+""" Suppression of the CDRs the PBX sends twice.
+
+    When the collector is gone the proxy buffers the CDR and NACKs it, and
+    the PBX sends it again; when our ACK is lost the PBX sends again a CDR
+    the collector already got. Without this, the collector gets both copies.
+
+    The recent CDRs are remembered by a hash of their payload, in the order
+    they were first seen: a lookup is a dict lookup, and the oldest hashes
+    are dropped once there are more than `size` of them or they are older
+    than `window` seconds. The hashes are saved with the CDR buffer, so a
+    restart doesn't forget them.
+"""
+import collections, hashlib, threading, time
+from omnipcx import metrics
+
+DEFAULT_SIZE = 10000
+DEFAULT_WINDOW = 3600.0
+DIGEST_SIZE = 16
+
+
+def digest(payload):
+    return hashlib.blake2b(payload, digest_size=DIGEST_SIZE).digest()
+
+
+class CDRDedup(object):
+    """ The hashes of at most `size` CDRs seen in the last `window` seconds"""
+    def __init__(self, size=DEFAULT_SIZE, window=DEFAULT_WINDOW, site='default'):
+        self.size = size
+        self.window = window
+        self._seen = collections.OrderedDict()    # hash -> time.time() it was first seen, oldest first
+        self._lock = threading.Lock()
+        self._duplicates = metrics.CDR_DUPLICATES.labels(site)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _expire(self, now):
+        while self._seen:
+            key, seen = next(iter(self._seen.items()))
+            if len(self._seen) <= self.size and now - seen < self.window:
+                return
+            del self._seen[key]
+
+    def seen(self, payload):
+        """ Whether the CDR was already seen. Remembers it if it wasn't."""
+        key = digest(payload)
+        now = time.time()
+        with self._lock:
+            first = self._seen.get(key)
+            if first is not None and now - first < self.window:
+                self._duplicates.inc()
+                return True
+            self._seen.pop(key, None)
+            self._seen[key] = now
+            self._expire(now)
+            return False
+
+    def items(self):
+        """ The (hash, time) of the remembered CDRs, oldest first"""
+        with self._lock:
+            self._expire(time.time())
+            return list(self._seen.items())
+
+    def restore(self, items):
+        """ Remembers the (hash, time) saved by items(), oldest first"""
+        with self._lock:
+            for key, seen in items:
+                self._seen.pop(key, None)
+                self._seen[key] = seen
+            self._expire(time.time())
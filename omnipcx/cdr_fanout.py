@@ -0,0 +1,204 @@
+""" Delivery of the CDRs to several collectors and files at once.
+
+    Every sink has its own durable buffer and its own delivery thread. The
+    proxy only appends the CDRs to the buffers, so a slow or dead sink
+    doesn't hold back the others or the PBX/Opera traffic; it catches up
+    from its buffer when it comes back.
+"""
+import collections, os.path, re, threading, time
+from omnipcx.logging import Loggable
+from omnipcx.cdr_buffer import CDRBuffer
+from omnipcx.cdr_replay import REPLAY_BATCH
+from omnipcx.streams import CDRStream
+from omnipcx.connector import Backoff
+from omnipcx.messages import crc
+from omnipcx import metrics
+
+# Seconds between two connection attempts to a sink, doubled after every failure
+# (with jitter, see connector.Backoff)
+BACKOFF_MIN = 1.0
+BACKOFF_MAX = 60.0
+
+SinkSpec = collections.namedtuple('SinkSpec', ['name', 'scheme', 'address', 'port', 'path'])
+
+
+def parse_sink(spec):
+    """ Parses [name=]tcp://host:port or [name=]file:///path. Without a name
+        the sink is named after the host and port or the file name.
+    """
+    name, sep, url = spec.partition("=")
+    if not sep or "://" in name:
+        name, url = "", spec
+    scheme, sep, rest = url.partition("://")
+    if scheme == "tcp" and sep:
+        address, _, port = rest.rpartition(":")
+        address = address.strip("[]")
+        if not address or not port.isdigit():
+            raise ValueError("CDR sink '%s' needs tcp://host:port" % spec)
+        name = name or "%s_%s" % (address, port)
+        sink = SinkSpec(name, scheme, address, int(port), None)
+    elif scheme == "file" and sep and rest:
+        sink = SinkSpec(name or os.path.basename(rest), scheme, None, None, rest)
+    else:
+        raise ValueError("Unknown CDR sink '%s'. Use tcp://host:port or file:///path" % spec)
+    return sink._replace(name=re.sub(r'[^A-Za-z0-9_.-]', '_', sink.name))
+
+
+def parse_sinks(value):
+    """ The sinks of a site table entry, separated by spaces"""
+    return [parse_sink(spec) for spec in value.split()]
+
+
+class CDRSink(Loggable):
+    """ One destination of the CDRs, fed from its own buffer by its own thread"""
+    def __init__(self, name, stream, buf, site='default'):
+        super(CDRSink, self).__init__()
+        self.name = name
+        self.stream = stream
+        self.buffer = buf
+        self.last_delivery = 0.0
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+        metrics.SINK_LAG.labels(site, name).set_function(self.buffer.__len__)
+        metrics.SINK_CONNECTED.labels(site, name).set_function(lambda: int(self.stream.connected))
+        metrics.SINK_LAST_DELIVERY.labels(site, name).set_function(lambda: self.last_delivery)
+
+    def put_many(self, messages):
+        self.buffer.put_many(messages)
+        self._wake.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="cdr-sink-%s" % self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.stream.connected and self.stream.has_socket:
+            self.stream.close()
+        self.stream.shutdown()
+        self.buffer.save()
+
+    def connect(self):
+        backoff = Backoff(BACKOFF_MIN, BACKOFF_MAX)
+        while not self._stop_event.is_set():
+            if self.stream.connect():
+                self.logger.info("CDR sink %s connected, %d CDRs to deliver", self.name, len(self.buffer))
+                return True
+            delay = backoff.next_delay()
+            self.logger.warn("Cannot connect to CDR sink %s, %d CDRs waiting. Retrying in %.1f s",
+                self.name, len(self.buffer), delay)
+            self._stop_event.wait(delay)
+        return False
+
+    def next_batch(self):
+        batch = []
+        while len(batch) < REPLAY_BATCH:
+            message = self.buffer.get()
+            if message is None:
+                break
+            batch.append(message)
+        return batch
+
+    def run(self):
+        while not self._stop_event.is_set():
+            if not self.stream.connected and not self.connect():
+                break
+            if not self.stream.wait_flow(self._stop_event):
+                break
+            self._wake.clear()
+            batch = self.next_batch()
+            if not batch:
+                self._wake.wait()
+                continue
+            if self.stream.send_many(batch):
+                self.buffer.ack(len(batch))
+                self.last_delivery = time.time()
+                continue
+            self.logger.error("Sending to CDR sink %s failed, %d CDRs waiting", self.name, len(self.buffer))
+            self.buffer.rewind()
+            if self.stream.has_socket:
+                # the batch goes again from the buffer, not from the queue of the old connection
+                self.stream.abort()
+            self._stop_event.wait(BACKOFF_MIN)
+        self.buffer.rewind()
+
+
+class CDRFanout(Loggable):
+    """ Takes the place of the CDR stream when the CDRs go to several sinks.
+        It is always connected and never paused: sending a CDR appends it to
+        the buffer of every sink. The sinks have the connections, the
+        fan-out has none of its own.
+    """
+    file_mode = False
+    has_socket = False
+
+    def __init__(self, sinks):
+        super(CDRFanout, self).__init__()
+        self.sinks = sinks
+        self.capture = None
+        self.store = None
+        for sink in self.sinks:
+            sink.start()
+
+    @property
+    def connected(self):
+        return True
+
+    @property
+    def paused(self):
+        return False
+
+    def connect(self):
+        return True
+
+    def poll_flow(self, timeout=0):
+        pass
+
+    def wait_flow(self, stop_event=None, timeout=0.5):
+        return True
+
+    def send(self, message):
+        return self.send_many([message])
+
+    def send_many(self, messages):
+        for sink in self.sinks:
+            sink.put_many(messages)
+        if self.capture is not None:
+            self.capture.sent(b"".join(message.serialize_cdr() for message in messages))
+        if self.store is not None:
+            self.store.add_many(messages)
+        return True
+
+    def close(self):
+        # The sinks keep delivering between sessions
+        pass
+
+    def shutdown(self):
+        for sink in self.sinks:
+            sink.stop()
+
+
+def fanout_from_args(args, site='default'):
+    """ The CDR fan-out for the --cdr-sink arguments. Every sink buffers its
+        CDRs in <buffer db file>.<sink name>
+    """
+    sinks = []
+    for spec in args.cdr_sinks:
+        if spec.scheme == "tcp":
+            stream = CDRStream(spec.address, spec.port, ipv6=args.ipv6, site=site, sink=spec.name)
+        else:
+            stream = CDRStream(None, None, spec.path, ipv6=args.ipv6,
+                flush_records=args.cdr_flush_records, flush_interval=args.cdr_flush_interval / 1000.0,
+                durability=args.cdr_durability, site=site, sink=spec.name)
+            stream.start_rotation(archive=args.cdr_archive, max_size=args.cdr_rotate_size,
+                interval=args.cdr_rotate_interval, compress=args.cdr_compress, keep=args.cdr_keep)
+        buf = CDRBuffer("%s.%s" % (args.buffer_db_file, spec.name),
+            verify_crc=args.crc_policy in (crc.POLICY_REJECT, crc.POLICY_NACK))
+        buf.load()
+        sinks.append(CDRSink(spec.name, stream, buf, site))
+    return CDRFanout(sinks)
@@ -0,0 +1,110 @@
+import threading, time
+from omnipcx.logging import Loggable
+
+# How many buffered CDRs are sent with a single write
+REPLAY_BATCH = 100
+# Seconds between two progress messages
+PROGRESS_INTERVAL = 5.0
+
+
+class CDRReplayer(Loggable):
+    """ Sends the buffered CDRs to the collector in the background, in
+        batches, while the proxy keeps forwarding live traffic. It pauses
+        while the collector sent XOFF, until it sends XON.
+
+        While a replay runs, live CDRs go to the end of the buffer instead
+        of straight to the collector, so the collector gets them in order.
+    """
+    def __init__(self, buf, cdr, batch_size=REPLAY_BATCH):
+        super(CDRReplayer, self).__init__()
+        self.buffer = buf
+        self.cdr = cdr
+        self.batch_size = batch_size
+        self.active = False
+        self.failed = False
+        self.sent = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._worker = None
+        self._last_progress = 0
+
+    def start(self):
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        if self.active or self.buffer.is_empty:
+            return
+        self.logger.info("Sending %d buffered CDRs in the background" % len(self.buffer))
+        self.active = True
+        self.sent = 0
+        self._last_progress = time.time()
+        self._worker = self.spawn()
+
+    def spawn(self):
+        worker = threading.Thread(target=self.run, name="cdr-replay", daemon=True)
+        worker.start()
+        return worker
+
+    def stop(self):
+        self._stop_event.set()
+        if self._worker is not None and self._worker is not threading.current_thread():
+            self._worker.join()
+
+    def deliver(self, message):
+        """ Sends a live CDR, or queues it behind the buffered ones. A CDR the
+            PBX sent already is dropped.
+        """
+        if self.buffer.is_duplicate(message):
+            return True
+        with self._lock:
+            if not self.active:
+                self.cdr.poll_flow()
+                if not self.cdr.paused:
+                    return self.cdr.send(message)
+            self.buffer.put(message)
+            self._start()
+            return True
+
+    def next_batch(self):
+        """ Returns the next CDRs to send, or None when the buffer is empty"""
+        with self._lock:
+            batch = []
+            while len(batch) < self.batch_size:
+                message = self.buffer.get()
+                if message is None:
+                    break
+                batch.append(message)
+            if not batch:
+                self.active = False
+                self.logger.info("Sent all %d buffered CDRs to the collector" % self.sent)
+                return None
+            return batch
+
+    def batch_sent(self, batch):
+        self.buffer.ack(len(batch))
+        self.sent += len(batch)
+        if time.time() - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = time.time()
+            self.logger.info("Sent %d buffered CDRs, %d left" % (self.sent, len(self.buffer)))
+
+    def batch_failed(self):
+        self.logger.error("CDR sending failed")
+        with self._lock:
+            self.buffer.rewind()
+            self.failed = True
+            self.active = False
+
+    def run(self):
+        while not self._stop_event.is_set():
+            if not self.cdr.wait_flow(self._stop_event):
+                break
+            batch = self.next_batch()
+            if batch is None:
+                return
+            if not self.cdr.send_many(batch):
+                return self.batch_failed()
+            self.batch_sent(batch)
+        with self._lock:
+            self.buffer.rewind()
+            self.active = False
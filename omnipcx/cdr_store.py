@@ -0,0 +1,255 @@
+""" Local store of the CDRs handed to the collector (--cdr-store), to search
+    them without going through the collector or the CDR files.
+
+    The fields of every SMDR (see SMDR in omnipcx.messages.protocol) are
+    written to a SQLite database, indexed on the start time and on the
+    extension, by a thread of their own so that the forwarding loops don't
+    wait for the disk. The `cdr query` subcommand lists or sums them up,
+    e.g. the calls from room 1234 in the last week:
+
+        proxy cdr query --store cdr_store.db --extension 1234 --since 7d
+        proxy cdr query --store cdr_store.db --since 2024-05-01 --group-by day
+
+    The `cdr export` subcommand writes the CDRs of CDR files, buffers or
+    stores to a CSV or columnar file (see omnipcx.cdr_columns):
+
+        proxy cdr export --format columns --output may.cdrc cdr.txt.2024*.gz
+"""
+import argparse, csv, datetime, os.path, queue, re, sqlite3, sys, threading, time
+from omnipcx.logging import Loggable
+from omnipcx import cdr_columns
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cdr(
+    id INTEGER PRIMARY KEY,
+    start INTEGER,
+    extension TEXT,
+    dialled TEXT,
+    duration INTEGER,
+    cost INTEGER,
+    payload BLOB
+);
+CREATE INDEX IF NOT EXISTS cdr_start ON cdr(start);
+CREATE INDEX IF NOT EXISTS cdr_extension ON cdr(extension, start);
+"""
+COLUMNS = cdr_columns.COLUMNS
+# Expressions the records are grouped by, with --group-by
+GROUPS = {
+    'extension': "extension",
+    'dialled': "dialled",
+    'hour': "strftime('%Y-%m-%d %H:00', start, 'unixepoch', 'localtime')",
+    'day': "date(start, 'unixepoch', 'localtime')",
+    'month': "strftime('%Y-%m', start, 'unixepoch', 'localtime')",
+    'all': "'all'",
+}
+DEFAULT_LIMIT = 100
+RELATIVE_TIME = re.compile(r"^(\d+)([smhdw])$")
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+class CDRStore(object):
+    """ The CDR database. With `readonly`, it has to exist already and
+        nothing is written to it.
+    """
+    def __init__(self, filename, readonly=False):
+        self.filename = filename
+        if readonly:
+            self._db = sqlite3.connect("file:%s?mode=ro" % filename, uri=True, check_same_thread=False)
+            return
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def add_many(self, payloads):
+        columns = cdr_columns.decode(payloads)
+        with self._db:
+            self._db.executemany("INSERT INTO cdr(start, extension, dialled, duration, cost, payload) "
+                "VALUES(?, ?, ?, ?, ?, ?)", zip(*[columns[name] for name in COLUMNS] + [payloads]))
+
+    @staticmethod
+    def _where(since=None, until=None, extension=None, dialled=None):
+        conditions, params = [], []
+        if extension is not None:
+            conditions.append("extension = ?")
+            params.append(extension)
+        if since is not None:
+            conditions.append("start >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("start < ?")
+            params.append(until)
+        if dialled is not None:
+            conditions.append("dialled LIKE ? ESCAPE '\\'")
+            params.append(dialled.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+    def query(self, limit=DEFAULT_LIMIT, **filters):
+        """ The matching records, oldest first, as (start, extension,
+            dialled, duration, cost) tuples
+        """
+        where, params = self._where(**filters)
+        return self._db.execute("SELECT %s FROM cdr%s ORDER BY start, id LIMIT ?" % (", ".join(COLUMNS), where),
+            params + [limit if limit else -1]).fetchall()
+
+    def aggregate(self, group_by, **filters):
+        """ (group, calls, total duration, total cost) of the matching
+            records, by one of GROUPS
+        """
+        where, params = self._where(**filters)
+        return self._db.execute("SELECT %s AS grp, COUNT(*), TOTAL(duration), TOTAL(cost) FROM cdr%s "
+            "GROUP BY grp ORDER BY grp" % (GROUPS[group_by], where), params).fetchall()
+
+    def close(self):
+        self._db.close()
+
+
+class CDRStoreWriter(Loggable):
+    """ Writes the CDRs to the store from a thread of its own. The CDRs
+        queued while it writes are written together.
+    """
+    def __init__(self, filename):
+        super(CDRStoreWriter, self).__init__()
+        self.filename = filename
+        self._queue = queue.Queue()
+        self._store = None
+        try:
+            self._store = CDRStore(filename)
+        except sqlite3.Error as e:
+            self.logger.error("Cannot open the CDR store %s: %s", filename, e)
+            return
+        self._thread = threading.Thread(target=self.run, name="cdr-store", daemon=True)
+        self._thread.start()
+
+    def add_many(self, messages):
+        if self._store is not None:
+            self._queue.put([bytes(message.payload) for message in messages])
+
+    def run(self):
+        while True:
+            batch = self._queue.get()
+            stop = batch is None
+            batch = batch or []
+            while not stop:
+                try:
+                    more = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    stop = True
+                else:
+                    batch.extend(more)
+            if batch:
+                try:
+                    self._store.add_many(batch)
+                except sqlite3.Error as e:
+                    self.logger.error("Cannot store %d CDRs in %s: %s", len(batch), self.filename, e)
+            if stop:
+                return
+
+    def close(self):
+        if self._store is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._store.close()
+        self._store = None
+
+
+def parse_time(value):
+    """ Seconds since the epoch of a local date ('2024-05-01', '2024-05-01
+        14:30'), or of a time ago ('90m', '12h', '7d', '2w')
+    """
+    match = RELATIVE_TIME.match(value)
+    if match:
+        return int(time.time()) - int(match.group(1)) * UNITS[match.group(2)]
+    for layout in ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return int(time.mktime(datetime.datetime.strptime(value, layout).timetuple()))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("Invalid time '%s', use YYYY-MM-DD[ HH:MM[:SS]] or a time ago like 7d" % value)
+
+
+def format_time(start):
+    if start is None:
+        return "-"
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(start))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="proxy cdr", description="Search the CDR store written with --cdr-store, or export CDRs")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    query = commands.add_parser('query', help='List the matching CDRs, or sum them up with --group-by')
+    query.add_argument('--store', dest='store', required=True, help='CDR store database file')
+    query.add_argument('--since', type=parse_time, dest='since', default=None,
+        help='Calls started at or after this time: YYYY-MM-DD[ HH:MM[:SS]], or a time ago like 90m, 12h, 7d, 2w')
+    query.add_argument('--until', type=parse_time, dest='until', default=None,
+        help='Calls started before this time, like --since')
+    query.add_argument('--extension', dest='extension', default=None, help='Calls from this extension (room)')
+    query.add_argument('--dialled', dest='dialled', default=None, help='Calls to numbers starting with this')
+    query.add_argument('--group-by', dest='group_by', choices=sorted(GROUPS), default=None,
+        help='Print the number of calls, their duration and cost by group instead of the calls')
+    query.add_argument('--limit', type=int, dest='limit', default=DEFAULT_LIMIT,
+        help='Print at most this many calls (0 prints all of them)')
+    query.add_argument('--csv', dest='csv', action='store_true', help='Print CSV')
+    export = commands.add_parser('export', help='Write the CDRs of CDR files, buffers or stores to one file')
+    export.add_argument('inputs', nargs='+', metavar='INPUT',
+        help='CDR file or archive (.gz and .xz are decompressed), or CDR buffer or store database (.db)')
+    export.add_argument('--output', dest='output', required=True, help='File to write')
+    export.add_argument('--format', dest='format', choices=cdr_columns.FORMATS, default=cdr_columns.FORMAT_CSV,
+        help='"csv" writes a CSV file, "columns" a compact binary file with a column per field')
+    return parser.parse_args(argv)
+
+
+def export(args):
+    started = time.monotonic()
+    try:
+        count = cdr_columns.export(args.inputs, args.output, args.format)
+    except (OSError, sqlite3.Error) as e:
+        print("Export failed: %s" % e, file=sys.stderr)
+        return 1
+    print("%d CDRs exported in %.1f s" % (count, time.monotonic() - started), file=sys.stderr)
+    return 0
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.command == 'export':
+        return export(args)
+    if not os.path.isfile(args.store):
+        print("CDR store %s doesn't exist" % args.store, file=sys.stderr)
+        return 1
+    try:
+        store = CDRStore(args.store, readonly=True)
+    except sqlite3.Error as e:
+        print("Cannot open the CDR store %s: %s" % (args.store, e), file=sys.stderr)
+        return 1
+    filters = dict(since=args.since, until=args.until, extension=args.extension, dialled=args.dialled)
+    started = time.monotonic()
+    try:
+        if args.group_by:
+            header = (args.group_by, 'calls', 'duration', 'cost')
+            rows = [(group, calls, int(duration), int(cost))
+                for group, calls, duration, cost in store.aggregate(args.group_by, **filters)]
+        else:
+            header = COLUMNS
+            rows = [(format_time(start),) + tuple(row) for start, *row in store.query(limit=args.limit, **filters)]
+    except sqlite3.Error as e:
+        print("Cannot read the CDR store %s: %s" % (args.store, e), file=sys.stderr)
+        return 1
+    finally:
+        store.close()
+    elapsed = time.monotonic() - started
+    if args.csv:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(header)
+        writer.writerows(rows)
+        return 0
+    rows = [tuple("-" if value is None else str(value) for value in row) for row in rows]
+    widths = [max([len(header[i])] + [len(row[i]) for row in rows]) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+    print("%d rows in %.1f ms" % (len(rows), elapsed * 1000), file=sys.stderr)
+    return 0
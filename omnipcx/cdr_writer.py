@@ -0,0 +1,88 @@
+import os, threading, time
+from omnipcx.logging import Loggable
+
+DURABILITY_NONE = 'none'    # leave the data in our buffers, the OS writes it when it wants
+DURABILITY_FLUSH = 'flush'  # hand the data to the OS at every commit
+DURABILITY_FSYNC = 'fsync'  # flush and wait for the data to reach the disk at every commit
+DURABILITIES = [DURABILITY_NONE, DURABILITY_FLUSH, DURABILITY_FSYNC]
+
+
+class CDRFileWriter(Loggable):
+    """ Keeps the CDR file open and commits the written records in groups:
+        every `flush_records` records, or every `flush_interval` seconds if
+        there is something pending. What a commit does is set by `durability`.
+    """
+    def __init__(self, filename, flush_records=1, flush_interval=0.0, durability=DURABILITY_FLUSH):
+        super(CDRFileWriter, self).__init__()
+        if durability not in DURABILITIES:
+            raise ValueError("Unknown durability mode '%s'" % durability)
+        self.filename = filename
+        self.flush_records = max(flush_records, 1)
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self._file = None
+        self._pending = 0
+        # bytes in the file, so that it can be rotated by size without stat'ing it
+        self.size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="cdr-flusher", daemon=True)
+            self._flusher.start()
+
+    @property
+    def is_open(self):
+        return self._file is not None
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            with self._lock:
+                if self._pending:
+                    self._commit()
+
+    def _commit(self):
+        if self.durability != DURABILITY_NONE:
+            self._file.flush()
+            if self.durability == DURABILITY_FSYNC:
+                os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def write(self, data, records=1):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.filename, "ab")
+            self._file.write(data)
+            self.size += len(data)
+            self._pending += records
+            if self._pending >= self.flush_records:
+                self._commit()
+
+    def commit(self):
+        with self._lock:
+            if self._file is not None and self._pending:
+                self._commit()
+
+    def _close(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        if self.durability == DURABILITY_FSYNC:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        self._pending = 0
+
+    def rotate(self, target):
+        """ Closes the file and moves it to target. Writers wait until the
+            file is moved, and the next record opens a new file.
+        """
+        with self._lock:
+            self._close()
+            os.replace(self.filename, target)
+            self.size = 0
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self._close()
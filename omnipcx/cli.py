@@ -1,19 +1,29 @@
-import argparse, logging, sys, traceback, time
-from omnipcx.messages import MessageDetector, MessageBase
-from omnipcx.proxy import Proxy
-from omnipcx.logging import ColorStreamHandler, Loggable, LogWrapper
-from omnipcx.streams import CDRStream, ClientStream, ServerStream
-from omnipcx.cdr_buffer import CDRBuffer
+import argparse, logging, signal, sys
+from omnipcx.logging import ColorStreamHandler, JSONFormatter, Loggable, LogWrapper, start_queue_logging
+from omnipcx.site import MultiSite, Site, load_site_table
+from omnipcx.messages import MessageDetector
+from omnipcx.messages.crc import POLICIES as CRC_POLICIES, POLICY_OFF
+from omnipcx.cdr_writer import DURABILITIES, DURABILITY_FLUSH
+from omnipcx.rotation import ARCHIVES, ARCHIVE_HANDOFF, COMPRESSIONS, COMPRESS_NONE
+from omnipcx.metrics import DEFAULT_METRICS_ADDRESS, MetricsServer
+from omnipcx.cdr_fanout import parse_sink
+from omnipcx.cdr_dedup import DEFAULT_SIZE as DEFAULT_DEDUP_SIZE, DEFAULT_WINDOW as DEFAULT_DEDUP_WINDOW
+from omnipcx.upstream import DEFAULT_HEALTH_CHECK_INTERVAL
+from omnipcx.connector import DEFAULT_DNS_TTL, set_dns_ttl
+from omnipcx.handoff import HandoffServer, TakeOver
+from omnipcx import rules
+from omnipcx.ha import DEFAULT_FAILOVER_TIMEOUT, DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_MAX_LAG, HighAvailability, \
+    parse_peer
 
 DEFAULT_OLD_PORT = 5010
 DEFAULT_OPERA_PORT = 2561
 DEFAULT_CDR_PORT = 6666
 DEFAULT_PASSWORD = '8756'
 DEFAULT_RETRY_TIMEOUT = 2.0
-DEFAULT_LISTEN_TIMEOUT = 5.0
-DEFAULT_RETRIES = 5
 DEFAULT_BUFFER_FILE = 'cdr_buffer.db'
-DEFAULT_FORMAT = '{"timestamp": %(timestamp)s, "file": "%(file)s", "line_no": "%(line_no)s", "function": "%(function)s", "message": "%(message)s"}'
+DEFAULT_ENGINE = 'poll'
+DEFAULT_WINDOW = 1
+ENGINES = ['poll', 'asyncio']
 
 
 class Application(Loggable):
@@ -36,113 +46,241 @@ class Application(Loggable):
         except KeyError:
             raise ArgumentTypeError(choices_msg)
 
+    @staticmethod
+    def cdr_sink(spec):
+        from argparse import ArgumentTypeError
+        try:
+            return parse_sink(spec)
+        except ValueError as e:
+            raise ArgumentTypeError(str(e))
+
+    @staticmethod
+    def ha_peer(spec):
+        from argparse import ArgumentTypeError
+        try:
+            return parse_peer(spec)
+        except ValueError as e:
+            raise ArgumentTypeError(str(e))
+
     def parse_args(self):
         parser = argparse.ArgumentParser(prog="proxy", description='Proxy between OLD and Opera')
         parser.add_argument("--log-level", type=Application.log_levels, default="INFO",
             help="Log level", dest="log_level")
         parser.add_argument('--old-port', type=int, dest='old_port', default=DEFAULT_OLD_PORT,
             help='Office Link Driver port (connect)')
-        parser.add_argument('--old-address', dest='old_address', required=True,
+        parser.add_argument('--old-address', dest='old_address',
             help='Office Link Driver address (connect)')
         parser.add_argument('--opera-port', type=int, dest='opera_port', default=DEFAULT_OPERA_PORT,
             help='Opera port (listen)')
         parser.add_argument('--cdr-file', type=str, dest='cdr_file_name', default=None,
             help='Save CDRs to a file instead of sending them over the network. If set, other CDR settings are ignored.')
+        parser.add_argument('--cdr-flush-records', type=int, dest='cdr_flush_records', default=1,
+            help='Commit the CDR file every N records')
+        parser.add_argument('--cdr-flush-interval', type=float, dest='cdr_flush_interval', default=0,
+            help='Also commit the CDR file every T milliseconds if there are uncommitted records (0 disables it)')
+        parser.add_argument('--cdr-durability', dest='cdr_durability', choices=DURABILITIES, default=DURABILITY_FLUSH,
+            help='What a commit of the CDR file does: "none" leaves it to the OS, "flush" writes the data to the OS, '
+                '"fsync" also waits for it to reach the disk')
+        parser.add_argument('--cdr-archive', dest='cdr_archive', choices=ARCHIVES, default=ARCHIVE_HANDOFF,
+            help='How the CDR file is rotated: "handoff" moves it to <file>.1 once the collector took the previous one, '
+                '"numbered" and "timestamp" archive it by size or time')
+        parser.add_argument('--cdr-rotate-size', type=int, dest='cdr_rotate_size', default=0,
+            help='Archive the CDR file when it reaches this many bytes')
+        parser.add_argument('--cdr-rotate-interval', type=float, dest='cdr_rotate_interval', default=0,
+            help='Archive the CDR file every this many seconds')
+        parser.add_argument('--cdr-compress', dest='cdr_compress', choices=COMPRESSIONS, default=COMPRESS_NONE,
+            help='Compress the CDR archives')
+        parser.add_argument('--cdr-keep', type=int, dest='cdr_keep', default=0,
+            help='Keep only this many CDR archives (0 keeps all of them)')
         parser.add_argument('--cdr-port', type=int, dest='cdr_port', default=DEFAULT_CDR_PORT,
             help='CDR collection port (connect)')
         parser.add_argument('--cdr-address', dest='cdr_address',
             help='CDR collection address (connect)')
+        parser.add_argument('--cdr-sink', type=Application.cdr_sink, dest='cdr_sinks', action='append', default=[],
+            help='Send the CDRs to this sink, [name=]tcp://host:port or [name=]file:///path. Repeat it to send them '
+                'to several sinks; every sink has its own buffer (<buffer db file>.<name>), so a dead sink doesn\'t '
+                'hold back the others. Replaces --cdr-file and --cdr-address')
+        parser.add_argument('--cdr-store', dest='cdr_store', default=None,
+            help='Also write the CDRs handed to the collector to this database, indexed by time and extension, '
+                'to search them with "proxy cdr query"')
         parser.add_argument('--cdr-buffer-db-file', dest='buffer_db_file', default=DEFAULT_BUFFER_FILE,
             help='Default CDR buffer database file')
-        parser.add_argument('--ipv6', type=bool, dest='ipv6', help='Use IPv6')
+        parser.add_argument('--cdr-dedup-size', type=int, dest='cdr_dedup_size', default=DEFAULT_DEDUP_SIZE,
+            help='Remember this many of the last CDRs, so that a CDR the PBX sends again (after a NACK or a lost ACK) '
+                'isn\'t handed to the collector twice. They are saved in the buffer database (0 disables it)')
+        parser.add_argument('--cdr-dedup-window', type=float, dest='cdr_dedup_window', default=DEFAULT_DEDUP_WINDOW,
+            help='Seconds a CDR is remembered by --cdr-dedup-size')
+        parser.add_argument('--ipv6', type=bool, dest='ipv6',
+            help='Listen on IPv6, and try the IPv6 addresses of OLD and the CDR collectors before the IPv4 ones')
+        parser.add_argument('--dns-ttl', type=float, dest='dns_ttl', default=DEFAULT_DNS_TTL,
+            help='Seconds the addresses of OLD and the CDR collectors are cached')
         parser.add_argument('--default-password', dest='default_password', default=DEFAULT_PASSWORD,
             help='Default voice mail password')
-        parser.add_argument('--retry-sleep', dest='retry_sleep', default=5,
-            help='Default sleep between connection attempts')
+        parser.add_argument('--rules', dest='rules_file', default=None,
+            help='Rules file: frames to rewrite or to keep from the other end, by message type (see omnipcx.rules)')
+        parser.add_argument('--local-keepalive', type=float, dest='local_keepalive', default=0,
+            help='Acknowledge the KeepAlive and TCPConnection frames of the PBX instead of forwarding them to Opera, '
+                'and send Opera a KeepAlive of our own when it was quiet for this many seconds (0 forwards them)')
+        parser.add_argument('--retry-sleep', type=float, dest='retry_sleep', default=5,
+            help='Longest sleep between connection attempts. The sleep starts short and doubles after every failure')
+        parser.add_argument('--health-check-interval', type=float, dest='health_check_interval',
+            default=DEFAULT_HEALTH_CHECK_INTERVAL,
+            help='Between Opera sessions, send a KeepAlive to OLD when it was quiet for this many seconds, and '
+                'reconnect if it doesn\'t acknowledge it (0 disables it)')
+        parser.add_argument('--engine', dest='engine', choices=ENGINES, default=DEFAULT_ENGINE,
+            help='Forwarding engine: "poll" polls the sockets, "asyncio" reacts as soon as data arrives')
+        parser.add_argument('--window', type=int, dest='window', default=DEFAULT_WINDOW,
+            help='Frames forwarded in each direction before their replies come back (asyncio engine only)')
+        parser.add_argument('--crc-policy', dest='crc_policy', choices=CRC_POLICIES, default=POLICY_OFF,
+            help='What to do with received frames having a wrong CRC: "off" doesn\'t check, "pass" logs and forwards them, '
+                '"reject" drops them, "nack" drops them and asks the sender to resend')
+        parser.add_argument('--site-table', dest='site_table', default=None,
+            help='Serve all the sites listed in this INI file (one section per site) from this process')
+        parser.add_argument('--capture', dest='capture_file', default=None,
+            help='Record the traffic of all the legs to this file, to replay it with "python -m test_proxy replay"')
+        parser.add_argument('--handoff-socket', dest='handoff_socket', default=None,
+            help='Hand the connections over to a new process started with --takeover through this Unix socket, so '
+                'that it restarts without dropping them')
+        parser.add_argument('--takeover', dest='takeover', action='store_true',
+            help='Take the connections over from the process serving --handoff-socket, then serve the next handoff')
+        parser.add_argument('--ha-peer', type=Application.ha_peer, dest='ha_peer', default=None,
+            help='Run as one node of an active/standby pair with the node listening on this host:port. The active '
+                'node replicates its CDR buffers to the standby, which takes over when the active node fails')
+        parser.add_argument('--ha-port', type=int, dest='ha_port', default=0,
+            help='Port this node listens on for its HA peer')
+        parser.add_argument('--ha-standby', dest='ha_standby', action='store_true',
+            help='Start as the standby node. Otherwise the node stands by only if its peer is active already')
+        parser.add_argument('--ha-heartbeat-interval', type=float, dest='ha_heartbeat_interval',
+            default=DEFAULT_HEARTBEAT_INTERVAL,
+            help='Seconds between the heartbeats the active node sends when it has no CDRs to replicate')
+        parser.add_argument('--ha-failover-timeout', type=float, dest='ha_failover_timeout',
+            default=DEFAULT_FAILOVER_TIMEOUT,
+            help='Seconds without hearing from the active node before the standby takes over')
+        parser.add_argument('--ha-max-lag', type=int, dest='ha_max_lag', default=DEFAULT_MAX_LAG,
+            help='Most CDRs the standby may not have confirmed yet. Buffering a CDR waits for the standby beyond that')
+        parser.add_argument('--metrics-port', type=int, dest='metrics_port', default=0,
+            help='Serve the metrics in the Prometheus text format on this port (0 disables it)')
+        parser.add_argument('--metrics-address', dest='metrics_address', default=DEFAULT_METRICS_ADDRESS,
+            help='Address the metrics are served on')
         self.args = parser.parse_args()
-        if not self.args.cdr_file_name and (not self.args.cdr_port or not self.args.cdr_address):
-            parser.error("Either specify --cdr-file or both --cdr-address and --cdr-port")
+        if self.args.cdr_archive == ARCHIVE_HANDOFF:
+            if self.args.cdr_rotate_size or self.args.cdr_rotate_interval or self.args.cdr_keep or \
+                    self.args.cdr_compress != COMPRESS_NONE:
+                parser.error("The handoff CDR file can't be compressed or rotated by size or time")
+        elif not self.args.cdr_rotate_size and not self.args.cdr_rotate_interval:
+            parser.error("--cdr-archive %s needs --cdr-rotate-size or --cdr-rotate-interval" % self.args.cdr_archive)
+        if self.args.local_keepalive < 0:
+            parser.error("--local-keepalive can't be negative")
+        if self.args.window < 1:
+            parser.error("--window needs to be at least 1")
+        if self.args.window > 1 and self.args.engine != 'asyncio':
+            parser.error("--window needs --engine asyncio")
+        if self.args.takeover and not self.args.handoff_socket:
+            parser.error("--takeover needs --handoff-socket")
+        if bool(self.args.ha_peer) != bool(self.args.ha_port):
+            parser.error("--ha-peer and --ha-port go together")
+        if self.args.ha_standby and not self.args.ha_peer:
+            parser.error("--ha-standby needs --ha-peer and --ha-port")
+        if self.args.ha_heartbeat_interval <= 0 or self.args.ha_failover_timeout <= self.args.ha_heartbeat_interval:
+            parser.error("--ha-failover-timeout needs to be longer than --ha-heartbeat-interval")
+        if self.args.cdr_dedup_size < 0 or self.args.cdr_dedup_window <= 0:
+            parser.error("--cdr-dedup-size can't be negative and --cdr-dedup-window needs to be positive")
+        if self.args.ha_max_lag < 1:
+            parser.error("--ha-max-lag needs to be at least 1")
+        names = [sink.name for sink in self.args.cdr_sinks]
+        if len(set(names)) != len(names):
+            parser.error("Every --cdr-sink needs its own name")
+        if self.args.site_table:
+            return
+        if not self.args.old_address:
+            parser.error("Either specify --old-address or --site-table")
+        if not self.args.cdr_sinks and not self.args.cdr_file_name and \
+                (not self.args.cdr_port or not self.args.cdr_address):
+            parser.error("Either specify --cdr-sink, --cdr-file or both --cdr-address and --cdr-port")
 
     def __init__(self):
         self.parse_args()
         self.init_logging()
-        self.init_cdr_buffer()
-
-    def init_cdr_buffer(self):
-        self.cdr_buffer = CDRBuffer(file=self.args.buffer_db_file)
-        self.cdr_buffer.load()
+        MessageDetector.set_crc_policy(self.args.crc_policy)
+        set_dns_ttl(self.args.dns_ttl)
 
-    def init_logging(self, level=logging.DEBUG):
-        logging.basicConfig(level=level)
-        formatter = logging.Formatter(fmt=DEFAULT_FORMAT)
+    def init_logging(self):
+        level = self.args.log_level
         streamHandler = logging.StreamHandler(sys.stderr)
-        streamHandler.setFormatter(formatter)
+        streamHandler.setFormatter(JSONFormatter())
         handler = ColorStreamHandler(streamHandler)
         lgr = logging.getLogger('omnipcx')
-        lgr.addHandler(handler)
         lgr.setLevel(level)
         lgr.propagate = False
+        # stderr is written from the listener thread, never from the forwarding loops
+        self.log_listener = start_queue_logging(lgr, handler)
         Loggable.set_logger(logger=LogWrapper(lgr))
         self.logger.info("Initialized logging")
 
-    def socket_tuples(self):
-        opera_listener = ServerStream(self.args.opera_port, listen_timeout=DEFAULT_LISTEN_TIMEOUT, ipv6=self.args.ipv6)
-        cdr_stream = CDRStream(self.args.cdr_address, self.args.cdr_port, self.args.cdr_file_name, ipv6=self.args.ipv6)
-        old_stream = ClientStream(self.args.old_address, self.args.old_port, ipv6=self.args.ipv6)
-        for opera_stream in opera_listener.listen():
-            if opera_stream is None:
-                # This was a timeout, so let's just rotate the CDR file, and continue
-                cdr_stream.rotate()
-                continue
-            retries = DEFAULT_RETRIES
-            old_connected = False
-            cdr_connected = False
-            while retries > 0:
-                if not cdr_connected:
-                    cdr_connected = cdr_stream.connect()
-                if not old_connected:
-                    old_connected = old_stream.connect()
-
-                if not old_connected:
-                    retries -= 1
-                    self.logger.warn("Couldn't open connection to OLD. Waiting ...")
-                    time.sleep(self.args.retry_sleep)
-                    continue
-                elif not cdr_connected:
-                    retries -= 1
-                    self.logger.warn("Couldn't open connection to CDR. Waiting ...")
-                    time.sleep(self.args.retry_sleep)
-                    continue
-                else:
-                    break
-            if not old_connected or not cdr_connected:
-                if old_connected:
-                    self.logger.trace("Closing connection to Opera")
-                    self.logger.error("Couldn't connect to CDR collector. Giving up.")
-                    old_stream.close()
-                if cdr_connected:
-                    self.logger.trace("Closing connection to CDR collector")
-                    self.logger.error("Couldn't connect to OLD. Giving up.")
-                    cdr_stream.close()
-                opera_stream.close()
-                continue
-            yield old_stream, opera_stream, cdr_stream
-
+    @staticmethod
+    def on_sigterm(signum, frame):
+        # Shut down like on Ctrl+C, so that the buffer and the capture are saved
+        raise KeyboardInterrupt()
 
     def start(self):
+        signal.signal(signal.SIGTERM, self.on_sigterm)
+        inherited = {}
+        if self.args.takeover:
+            # Before the metrics server, the previous process releases its port when it exits
+            inherited = TakeOver(self.args.handoff_socket).run() or {}
+        metrics_server = None
+        if self.args.metrics_port:
+            metrics_server = MetricsServer(self.args.metrics_port, self.args.metrics_address)
+            metrics_server.start()
+        self.handoff_server = None
+        self.ha = None
+        try:
+            return self._start(inherited)
+        finally:
+            if metrics_server is not None:
+                metrics_server.stop()
+            if self.handoff_server is not None:
+                self.handoff_server.close()
+            if self.ha is not None:
+                self.ha.stop()
+            self.log_listener.stop()
+
+    def _start(self, inherited):
         self.logger.info("Starting application")
-        for old_stream, opera_stream, cdr_stream in self.socket_tuples():
-            self.logger.info("Received Opera connection. Starting proxy operation")
-            proxy = Proxy(old_stream, opera_stream, cdr_stream, self.args.default_password, self.cdr_buffer)
-            try:
-                proxy.run()
-            except KeyboardInterrupt:
-                self.logger.warn("Stopped by Ctrl+C / Ctrl+Break")
-                break
-            except Exception:
-                self.logger.exception("Caught an exception in the main loop of the proxy")
-                traceback.print_exc()
-            finally:
-                for stream in [opera_stream, old_stream, cdr_stream]:
-                    stream.close()
-        self.cdr_buffer.save()
+        try:
+            if self.args.site_table:
+                sites = load_site_table(self.args.site_table, self.args)
+            else:
+                sites = [("default", self.args)]
+            site_rules = [rules.load(args.rules_file, args.default_password, bool(args.local_keepalive))
+                for _, args in sites]
+        except ValueError as e:
+            return self.logger.error(str(e))
+        sites = [Site(name, args, inherited.pop(name, None), table) for (name, args), table in zip(sites, site_rules)]
+        for state in inherited.values():
+            self.logger.warn("Site %s isn't served anymore, closing its connections", state.name)
+            state.close()
+        if self.args.ha_peer and not self.become_active(sites):
+            return
+        if self.args.handoff_socket:
+            self.handoff_server = HandoffServer(self.args.handoff_socket, sites)
+            self.handoff_server.start()
+        if self.args.site_table or self.args.engine == 'asyncio':
+            return MultiSite(sites, self.args.engine).run()
+        sites[0].run()
+
+    def become_active(self, sites):
+        """ Waits until this node is the active one of the HA pair. Returns
+            False if it stopped before
+        """
+        self.ha = HighAvailability(self.args, dict((site.name, site.cdr_buffer) for site in sites))
+        try:
+            if self.ha.start():
+                return True
+        except KeyboardInterrupt:
+            self.logger.warn("Stopped by Ctrl+C / Ctrl+Break")
+        for site in sites:
+            if site.inherited is not None:
+                site.inherited.close()
+            site.close()
+        return False
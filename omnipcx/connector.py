@@ -0,0 +1,252 @@
+""" Opening the connections to OLD and to the CDR collectors.
+
+    The names are resolved once per DNS TTL, all the addresses of a name are
+    raced against each other, IPv6 and IPv4 interleaved, a new attempt
+    starting every ATTEMPT_DELAY seconds while the previous ones are pending
+    ("happy eyeballs", RFC 8305). Failed connections are retried after a
+    jittered exponential backoff, so that a short network blip is recovered
+    from in a fraction of a second without hammering a dead host.
+"""
+import asyncio, errno, random, select, socket, threading, time
+from omnipcx.logging import Loggable
+
+DEFAULT_DNS_TTL = 60.0
+# Seconds an address has to accept the connection
+CONNECT_TIMEOUT = 2.0
+# Seconds before the next address is tried while the previous one is pending
+ATTEMPT_DELAY = 0.25
+# First delay between two connection attempts. It doubles after every
+# failure, up to the --retry-sleep argument
+BACKOFF_MIN = 0.1
+
+
+class Backoff(object):
+    """ Exponential backoff with jitter: the n-th delay is taken at random
+        between half and all of min(minimum * 2^n, maximum), so that the legs
+        and the sites that lost their connection together don't retry in
+        lockstep.
+    """
+    def __init__(self, minimum=BACKOFF_MIN, maximum=5.0):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.attempts = 0
+        self.next_attempt = 0.0
+
+    def reset(self):
+        self.attempts = 0
+        self.next_attempt = 0.0
+
+    def next_delay(self):
+        ceiling = min(self.maximum, self.minimum * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return random.uniform(ceiling / 2, ceiling)
+
+    def ready(self, now):
+        """ Tells if the next attempt is due"""
+        return now >= self.next_attempt
+
+    def failed(self, now):
+        """ Schedules the next attempt after a failed one"""
+        self.next_attempt = now + self.next_delay()
+
+
+def interleave(addresses, prefer_ipv6=False):
+    """ Orders the getaddrinfo() results alternating the address families,
+        starting with the preferred one
+    """
+    first = socket.AF_INET6 if prefer_ipv6 else socket.AF_INET
+    preferred = [address for address in addresses if address[0] == first]
+    others = [address for address in addresses if address[0] != first]
+    ordered = []
+    for i in range(max(len(preferred), len(others))):
+        ordered.extend(preferred[i:i + 1])
+        ordered.extend(others[i:i + 1])
+    return ordered
+
+
+class Resolver(Loggable):
+    """ getaddrinfo() with a cache. getaddrinfo() doesn't tell the TTL of the
+        records, so all of them are kept for the same time. When the name
+        server can't be reached the expired addresses are used.
+    """
+    def __init__(self, ttl=DEFAULT_DNS_TTL):
+        super(Resolver, self).__init__()
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, host, port, stale=False):
+        with self._lock:
+            entry = self._cache.get((host, port), None)
+        if entry is None:
+            return None
+        expires, addresses = entry
+        if stale or time.monotonic() < expires:
+            return addresses
+        return None
+
+    def _store(self, host, port, infos):
+        addresses = [(family, sockaddr) for family, _, _, _, sockaddr in infos]
+        with self._lock:
+            self._cache[(host, port)] = (time.monotonic() + self.ttl, addresses)
+        return addresses
+
+    def _failed(self, host, port, error):
+        addresses = self._cached(host, port, stale=True)
+        if addresses is None:
+            self.logger.error("Cannot resolve %s: %s", host, error)
+            return []
+        self.logger.warn("Cannot resolve %s (%s), using the expired addresses", host, error)
+        return addresses
+
+    def forget(self, host, port):
+        """ Resolve again next time, e.g. because none of the addresses answered"""
+        with self._lock:
+            entry = self._cache.get((host, port), None)
+            if entry is not None:
+                self._cache[(host, port)] = (0.0, entry[1])
+
+    def resolve(self, host, port, prefer_ipv6=False):
+        """ The (family, sockaddr) tuples to try, in order"""
+        addresses = self._cached(host, port)
+        if addresses is None:
+            try:
+                addresses = self._store(host, port, socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM))
+            except socket.gaierror as e:
+                addresses = self._failed(host, port, e)
+        return interleave(addresses, prefer_ipv6)
+
+    async def resolve_async(self, host, port, prefer_ipv6=False):
+        addresses = self._cached(host, port)
+        if addresses is None:
+            loop = asyncio.get_running_loop()
+            try:
+                addresses = self._store(host, port,
+                    await loop.getaddrinfo(host, port, family=socket.AF_UNSPEC, type=socket.SOCK_STREAM))
+            except socket.gaierror as e:
+                addresses = self._failed(host, port, e)
+        return interleave(addresses, prefer_ipv6)
+
+
+RESOLVER = Resolver()
+
+
+def set_dns_ttl(ttl):
+    RESOLVER.ttl = ttl
+
+
+def _socket(family):
+    """ A TCP socket that sends the frames as they are written: the proxy
+        writes an ACK and the next frame back to back, and Nagle's algorithm
+        would hold the frame until the peer's delayed ACK (40 ms on Linux).
+        asyncio only disables it for the sockets it creates itself.
+    """
+    skt = socket.socket(family, socket.SOCK_STREAM)
+    skt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return skt
+
+
+def connect(host, port, prefer_ipv6=False, timeout=CONNECT_TIMEOUT, resolver=RESOLVER):
+    """ Races the addresses of host. Returns the first socket that got
+        connected (in blocking mode), or None.
+    """
+    addresses = resolver.resolve(host, port, prefer_ipv6)
+    pending = {}    # socket -> deadline
+    winner = None
+    next_start = 0.0
+    try:
+        while winner is None and (addresses or pending):
+            now = time.monotonic()
+            if addresses and (now >= next_start or not pending):
+                family, sockaddr = addresses.pop(0)
+                skt = _socket(family)
+                skt.setblocking(False)
+                err = skt.connect_ex(sockaddr)
+                if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    skt.close()
+                    continue
+                pending[skt] = now + timeout
+                next_start = now + ATTEMPT_DELAY
+            for skt, deadline in list(pending.items()):
+                if now >= deadline:
+                    del pending[skt]
+                    skt.close()
+            if not pending:
+                continue
+            wait = min(pending.values()) - now
+            if addresses:
+                wait = min(wait, next_start - now)
+            for skt in select.select([], list(pending), [], max(wait, 0))[1]:
+                del pending[skt]
+                if winner is None and skt.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    winner = skt
+                else:
+                    skt.close()
+    finally:
+        for skt in pending:
+            skt.close()
+    if winner is None:
+        resolver.forget(host, port)
+        return None
+    winner.setblocking(True)
+    return winner
+
+
+async def _attempt(loop, family, sockaddr, timeout):
+    skt = _socket(family)
+    skt.setblocking(False)
+    try:
+        await asyncio.wait_for(loop.sock_connect(skt, sockaddr), timeout)
+    except BaseException:
+        skt.close()
+        raise
+    return skt
+
+
+async def connect_async(host, port, prefer_ipv6=False, timeout=CONNECT_TIMEOUT, resolver=RESOLVER):
+    """ Like connect(), for the asyncio engine. The socket is non-blocking"""
+    loop = asyncio.get_running_loop()
+    addresses = await resolver.resolve_async(host, port, prefer_ipv6)
+    pending = set()
+    winner = None
+    try:
+        while winner is None and (addresses or pending):
+            if addresses:
+                pending.add(asyncio.ensure_future(_attempt(loop, *addresses.pop(0), timeout)))
+            done, pending = await asyncio.wait(pending, timeout=ATTEMPT_DELAY if addresses else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    continue
+                if winner is None:
+                    winner = task.result()
+                else:
+                    task.result().close()
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, socket.socket):
+                result.close()
+    if winner is None:
+        resolver.forget(host, port)
+    return winner
+
+
+def connect_all(connects):
+    """ Calls the connect functions at the same time, each on its own
+        thread. Returns their results.
+    """
+    if len(connects) < 2:
+        return [connect() for connect in connects]
+    results = [False] * len(connects)
+
+    def run(i, connect):
+        results[i] = connect()
+
+    threads = [threading.Thread(target=run, args=(i, connect), daemon=True) for i, connect in enumerate(connects)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,472 @@
+""" Active/standby pair of proxies (--ha-peer).
+
+    Both nodes listen for their peer on --ha-port. The active node serves
+    the sites and streams the mutations of their CDR buffers to the standby:
+    the CDRs put in a buffer, with their database ids, and the ids up to
+    which the collector acknowledged them, so that the buffers of the
+    standby are copies of its own. A thread sends the mutations in batches;
+    put() waits for the standby only when more than --ha-max-lag CDRs aren't
+    confirmed yet, which bounds what a failover can lose. The asyncio engine
+    can't wait, its event loop serves all the sites: a standby that stays
+    that far behind for --ha-failover-timeout seconds is dropped instead. A
+    standby that (re)connects first gets a snapshot of the buffers.
+
+    The active node sends a heartbeat every --ha-heartbeat-interval seconds
+    when it has nothing else to send. When the standby didn't hear from it
+    for --ha-failover-timeout seconds, it takes over: it starts the sites,
+    which listen on the Opera port and connect to OLD and the CDR
+    collectors, and replicates its buffers to its peer in turn. A node
+    started without --ha-standby asks its peer first, and stands by if the
+    peer is active already. If both turn out to be active, the one that
+    became active last stops.
+
+    Every message is a line of JSON, the CDR payloads are hex encoded.
+"""
+import asyncio, collections, json, os, signal, socket, threading, time
+from omnipcx.logging import Loggable
+from omnipcx import connector
+
+DEFAULT_HEARTBEAT_INTERVAL = 1.0
+DEFAULT_FAILOVER_TIMEOUT = 3.0
+DEFAULT_MAX_LAG = 1000
+# Most CDRs in a message
+BATCH_SIZE = 500
+
+ACTIVE = 'active'
+STANDBY = 'standby'
+
+
+def parse_peer(spec):
+    """ host:port, or [address]:port for an IPv6 address"""
+    host, sep, port = spec.rpartition(":")
+    if not sep or not host or not port.isdigit():
+        raise ValueError("Invalid HA peer '%s', use host:port" % spec)
+    return host.strip("[]"), int(port)
+
+
+def on_event_loop():
+    """ Whether the caller runs an asyncio event loop, which must not block"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def send_lines(sock, documents):
+    sock.sendall(b"".join(json.dumps(document).encode() + b"\n" for document in documents))
+
+
+class LineReader(object):
+    """ Reads the JSON lines received on a socket"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.data = b""
+
+    @property
+    def has_line(self):
+        """ A complete line is buffered already"""
+        return b"\n" in self.data
+
+    def read(self):
+        """ The next document, or None at EOF"""
+        while b"\n" not in self.data:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return None
+            self.data += chunk
+        line, self.data = self.data.split(b"\n", 1)
+        return json.loads(line.decode())
+
+
+def close_socket(sock):
+    try:
+        # wakes up the thread reading it
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+class SiteReplication(object):
+    """ CDRBuffer.replication of a site on the active node"""
+    def __init__(self, replicator, site):
+        self.replicator = replicator
+        self.site = site
+
+    def put(self, rows, wait=True):
+        for i in range(0, len(rows), BATCH_SIZE):
+            chunk = rows[i:i + BATCH_SIZE]
+            self.replicator.record({'op': 'put', 'site': self.site,
+                'rows': [[_id, payload.hex()] for _id, payload in chunk]}, len(chunk), wait)
+
+    def ack(self, last_id):
+        self.replicator.record({'op': 'ack', 'site': self.site, 'id': last_id}, 0)
+
+    def snapshot(self, rows):
+        self.replicator.record({'op': 'reset', 'site': self.site}, 0, wait=False)
+        self.put(rows, wait=False)
+
+
+class Replicator(Loggable):
+    """ Streams the mutations of the CDR buffers to the standby node"""
+    def __init__(self, peer, buffers, since, heartbeat_interval, failover_timeout, max_lag):
+        super(Replicator, self).__init__()
+        self.peer = peer
+        self.buffers = buffers
+        self.since = since
+        self.heartbeat_interval = heartbeat_interval
+        self.failover_timeout = failover_timeout
+        self.max_lag = max_lag
+        self._cond = threading.Condition()
+        self._sock = None
+        self._queue = []
+        self._sent = collections.deque()    # (seq, CDRs) waiting for the confirmation of the standby
+        self._seq = 0
+        self._lag = 0                       # CDRs queued or sent, not confirmed
+        self._behind_since = None           # when the lag went over max_lag, for the event loop
+        self._stop = False
+        # Well below the failover timeout, so that a new standby doesn't take over
+        self._backoff = connector.Backoff(maximum=heartbeat_interval)
+        self._thread = None
+        self._replications = {}
+        for name, buf in buffers.items():
+            buf.replication = self._replications[name] = SiteReplication(self, name)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="ha-replicator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        for buf in self.buffers.values():
+            buf.replication = None
+        self._disconnect(self._sock)
+        if self._thread is not None:
+            self._thread.join()
+
+    def record(self, document, cdrs, wait=True):
+        """ Queues a mutation. Waits while the standby lags behind by more
+            than max_lag CDRs, up to the failover timeout; a standby that slow
+            is dropped, it gets a snapshot when it connects again. On an event
+            loop, the standby is dropped once it lagged that long, without
+            waiting.
+        """
+        with self._cond:
+            if self._sock is None:
+                return
+            self._seq += 1
+            document['seq'] = self._seq
+            self._queue.append((document, cdrs))
+            self._lag += cdrs
+            self._cond.notify_all()
+            if self._lag <= self.max_lag:
+                self._behind_since = None
+                return
+            if not wait:
+                return
+            sock = self._sock
+            now = time.monotonic()
+            if on_event_loop():
+                # waiting here would stop every site the loop serves
+                if self._behind_since is None:
+                    self._behind_since = now
+                if now - self._behind_since < self.failover_timeout:
+                    return
+            else:
+                deadline = now + self.failover_timeout
+                while self._sock is sock and self._lag > self.max_lag:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._sock is not sock or self._lag <= self.max_lag:
+                    return
+        self.logger.error("The standby is more than %d CDRs behind. Dropping it", self.max_lag)
+        self._disconnect(sock)
+
+    def _disconnect(self, sock):
+        with self._cond:
+            if sock is None or self._sock is not sock:
+                return
+            self._sock = None
+            self._queue = []
+            self._sent.clear()
+            self._lag = 0
+            self._behind_since = None
+            self._cond.notify_all()
+        close_socket(sock)
+
+    def _connect(self):
+        """ Connects to the standby. Returns the socket and its reader, or
+            None. Stops this node if the peer is active since earlier.
+        """
+        sock = connector.connect(*self.peer, timeout=self.failover_timeout)
+        if sock is None:
+            return None
+        reader = LineReader(sock)
+        try:
+            sock.settimeout(self.failover_timeout)
+            send_lines(sock, [{'op': 'hello', 'role': ACTIVE, 'since': self.since}])
+            hello = reader.read()
+        except (OSError, ValueError):
+            hello = None
+        if hello is None or hello.get('role') not in (ACTIVE, STANDBY):
+            sock.close()
+            return None
+        if hello['role'] == ACTIVE:
+            sock.close()
+            if hello.get('since', 0) < self.since:
+                self.logger.error("The peer is active since before this node. Stopping, restart this node to make "
+                    "it the standby")
+                with self._cond:
+                    self._stop = True
+                os.kill(os.getpid(), signal.SIGTERM)
+            return None
+        return sock, reader
+
+    def run(self):
+        while True:
+            with self._cond:
+                if self._stop:
+                    return
+            connection = self._connect()
+            if connection is None:
+                with self._cond:
+                    self._cond.wait(self._backoff.next_delay())
+                continue
+            self._backoff.reset()
+            sock, reader = connection
+            self.logger.info("Replicating the CDR buffers to the standby at %s:%d", *self.peer)
+            with self._cond:
+                self._sock = sock
+            threading.Thread(target=self.read_confirmations, args=(sock, reader), name="ha-confirmations",
+                daemon=True).start()
+            for name, buf in self.buffers.items():
+                buf.snapshot(self._replications[name].snapshot)
+            self.send(sock)
+            self.logger.warn("Lost the connection to the standby")
+
+    def send(self, sock):
+        """ Sends the queued mutations until the connection drops"""
+        while True:
+            with self._cond:
+                if not self._queue and self._sock is sock and not self._stop:
+                    self._cond.wait(self.heartbeat_interval)
+                if self._sock is not sock or self._stop:
+                    return
+                batch, self._queue = self._queue, []
+                self._sent.extend((document['seq'], cdrs) for document, cdrs in batch)
+            documents = [document for document, _ in batch] or [{'op': 'heartbeat'}]
+            try:
+                send_lines(sock, documents)
+            except OSError as e:
+                self.logger.error("Cannot replicate to the standby: %s", e)
+                return self._disconnect(sock)
+
+    def read_confirmations(self, sock, reader):
+        """ The standby confirms the mutations it stored and answers the
+            heartbeats. Nothing for failover_timeout seconds means it's gone.
+        """
+        try:
+            while True:
+                document = reader.read()
+                if document is None:
+                    break
+                with self._cond:
+                    if self._sock is not sock:
+                        return
+                    while self._sent and self._sent[0][0] <= document.get('seq', 0):
+                        self._lag -= self._sent.popleft()[1]
+                    if self._lag <= self.max_lag:
+                        self._behind_since = None
+                    self._cond.notify_all()
+        except (OSError, ValueError) as e:
+            with self._cond:
+                if self._sock is not sock:
+                    return
+            self.logger.error("The standby doesn't answer: %s", e)
+        self._disconnect(sock)
+
+
+class HAListener(Loggable):
+    """ Answers the peer on --ha-port. While this node stands by, stores the
+        mutations sent by the active node into the CDR buffers.
+    """
+    def __init__(self, port, buffers, ipv6, failover_timeout, grace):
+        super(HAListener, self).__init__()
+        self.port = port
+        self.buffers = buffers
+        self.family = socket.AF_INET6 if ipv6 else socket.AF_INET
+        self.failover_timeout = failover_timeout
+        self.role = STANDBY
+        self.since = 0.0        # time.time() this node became active
+        self._cond = threading.Condition()
+        self._stream = None     # socket of the active node
+        # The active node may need a little while to connect to a new standby
+        self._last_heard = time.monotonic() + grace
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        try:
+            server = socket.socket(self.family, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(("", self.port))
+            server.listen(4)
+        except OSError as e:
+            self.logger.error("Cannot listen for the HA peer on port %d: %s", self.port, e)
+            return False
+        self._server = server
+        self._thread = threading.Thread(target=self.run, name="ha-listener", daemon=True)
+        self._thread.start()
+        self.logger.info("Listening for the HA peer on port %d", self.port)
+        return True
+
+    def stop(self):
+        if self._server is not None:
+            close_socket(self._server)
+            self._thread.join()
+        with self._cond:
+            if self._stream is not None:
+                close_socket(self._stream)
+
+    def run(self):
+        while True:
+            try:
+                conn, address = self._server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn, address), name="ha-peer", daemon=True).start()
+
+    def become_active(self):
+        with self._cond:
+            self.role = ACTIVE
+            self.since = time.time()
+            if self._stream is not None:
+                close_socket(self._stream)
+                self._stream = None
+
+    def wait_for_failover(self):
+        """ Returns when the active node has been silent for the failover timeout"""
+        with self._cond:
+            while True:
+                remaining = self._last_heard + self.failover_timeout - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        self.logger.warn("The active node has been silent for %.1f seconds. Taking over", self.failover_timeout)
+        self.become_active()
+
+    def serve(self, conn, address):
+        reader = LineReader(conn)
+        try:
+            conn.settimeout(self.failover_timeout)
+            hello = reader.read()
+            if hello is None or hello.get('op') != 'hello':
+                return conn.close()
+            with self._cond:
+                send_lines(conn, [{'op': 'hello', 'role': self.role, 'since': self.since}])
+                if self.role != STANDBY or hello.get('role') != ACTIVE:
+                    return conn.close()
+                if self._stream is not None:
+                    close_socket(self._stream)
+                self._stream = conn
+                self._last_heard = time.monotonic()
+            self.logger.info("Replicating the CDR buffers of the active node at %s", address[0])
+            self.replicate(conn, reader)
+        except (OSError, ValueError) as e:
+            with self._cond:
+                if self._stream is not conn:
+                    return conn.close()
+            self.logger.error("Lost the connection to the active node: %s", e)
+        with self._cond:
+            if self._stream is conn:
+                self._stream = None
+        conn.close()
+
+    def replicate(self, conn, reader):
+        seq = 0
+        while True:
+            document = reader.read()
+            if document is None:
+                return self.logger.warn("The active node closed the replication connection")
+            with self._cond:
+                if self._stream is not conn:
+                    return
+                self._last_heard = time.monotonic()
+                self.apply(document)
+            seq = document.get('seq', seq)
+            if not reader.has_line:
+                # one confirmation per batch, the buffers are committed by then
+                send_lines(conn, [{'op': 'ok', 'seq': seq}])
+
+    def apply(self, document):
+        op = document['op']
+        if op == 'heartbeat':
+            return
+        buf = self.buffers.get(document['site'], None)
+        if buf is None:
+            return self.logger.debug("Ignoring the CDRs of site %s, it isn't served here", document['site'])
+        if op == 'reset':
+            buf.apply_put([], reset=True)
+        elif op == 'put':
+            buf.apply_put([(_id, bytes.fromhex(payload)) for _id, payload in document['rows']])
+        elif op == 'ack':
+            buf.apply_ack(document['id'])
+
+
+class HighAvailability(Loggable):
+    """ The HA role of this process. start() returns once this node is
+        the active one.
+    """
+    def __init__(self, args, buffers):
+        super(HighAvailability, self).__init__()
+        self.args = args
+        self.buffers = buffers
+        self.peer = args.ha_peer
+        self.listener = HAListener(args.ha_port, buffers, args.ipv6, args.ha_failover_timeout,
+            grace=args.ha_heartbeat_interval)
+        self.replicator = None
+
+    def probe(self):
+        """ The role of the peer, or None if it doesn't answer"""
+        sock = connector.connect(*self.peer, timeout=self.args.ha_failover_timeout)
+        if sock is None:
+            return None
+        try:
+            sock.settimeout(self.args.ha_failover_timeout)
+            send_lines(sock, [{'op': 'hello', 'role': STANDBY}])
+            hello = LineReader(sock).read()
+        except (OSError, ValueError):
+            hello = None
+        finally:
+            sock.close()
+        return hello.get('role') if hello is not None else None
+
+    def start(self):
+        """ Returns False if this node stopped before becoming active"""
+        if not self.listener.start():
+            return False
+        if self.args.ha_standby:
+            self.logger.info("Standing by")
+            self.listener.wait_for_failover()
+        else:
+            role = self.probe()
+            if role == ACTIVE:
+                self.logger.info("The peer is active. Standing by")
+                self.listener.wait_for_failover()
+            else:
+                self.logger.info("The peer is %s. Becoming active", role or "unreachable")
+                self.listener.become_active()
+        self.replicator = Replicator(self.peer, self.buffers, self.listener.since, self.args.ha_heartbeat_interval,
+            self.args.ha_failover_timeout, self.args.ha_max_lag)
+        self.replicator.start()
+        return True
+
+    def stop(self):
+        if self.replicator is not None:
+            self.replicator.stop()
+        self.listener.stop()
@@ -0,0 +1,216 @@
+""" Restart without dropping the connections.
+
+    The running process serves handoff requests on a Unix socket
+    (--handoff-socket). A new process started with --takeover connects to
+    it; the running process then stops every site at a frame boundary and
+    passes it over: the listening socket, the connections to OLD, Opera and
+    the CDR collector (as file descriptors, with SCM_RIGHTS) and the bytes
+    received on them that weren't handled yet. Once it has exited, which
+    also closes its CDR buffers and files, the new process goes on where it
+    stopped. The peers don't see a reconnection.
+
+    Every message is a 4 byte length and a JSON document, the file
+    descriptors are attached to its first byte.
+"""
+import json, os, socket, struct, threading
+from omnipcx.logging import Loggable
+
+HANDOFF_REQUEST = b"TAKEOVER\n"
+# Seconds the new process waits for the running one to exit
+EXIT_TIMEOUT = 30.0
+MAX_FDS = 16
+HEADER = struct.Struct("!I")
+
+
+class SiteState(object):
+    """ What a site hands over: its sockets and the bytes received on them
+        that weren't handled yet, per leg ('listener', 'pbx', 'opera', 'cdr')
+    """
+    def __init__(self, name, legs=None, fds=None):
+        self.name = name
+        self.legs = legs if legs is not None else {}
+        self.fds = fds if fds is not None else []
+        self.done = threading.Event()
+
+    def add(self, leg, fd, unread=b"", **info):
+        """ Hands over a duplicate `fd` of the socket of leg"""
+        self.legs[leg] = dict(info, fd=len(self.fds), unread=bytes(unread).hex())
+        self.fds.append(fd)
+
+    def __contains__(self, leg):
+        return leg in self.legs
+
+    def socket(self, leg):
+        """ The socket of leg, or None. It can be taken only once"""
+        if leg not in self.legs:
+            return None
+        fd, self.fds[self.legs[leg]['fd']] = self.fds[self.legs[leg]['fd']], None
+        return socket.socket(fileno=fd) if fd is not None else None
+
+    def unread(self, leg):
+        return bytes.fromhex(self.legs[leg]['unread']) if leg in self.legs else b""
+
+    def info(self, leg, key, default=None):
+        return self.legs.get(leg, {}).get(key, default)
+
+    def close(self):
+        """ Closes the file descriptors nobody took"""
+        for i, fd in enumerate(self.fds):
+            if fd is not None:
+                os.close(fd)
+                self.fds[i] = None
+
+    def serialize(self):
+        return json.dumps({'site': self.name, 'legs': self.legs}).encode()
+
+    @classmethod
+    def deserialize(cls, data, fds):
+        document = json.loads(data.decode())
+        return cls(document['site'], document['legs'], list(fds))
+
+
+def send_message(sock, document, fds=()):
+    data = HEADER.pack(len(document)) + document
+    sent = socket.send_fds(sock, [data], list(fds)) if fds else sock.send(data)
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def recv_message(sock):
+    """ Returns the document and its file descriptors, or (None, []) at EOF"""
+    header, fds, _, _ = socket.recv_fds(sock, HEADER.size, MAX_FDS)
+    while header and len(header) < HEADER.size:
+        header += sock.recv(HEADER.size - len(header))
+    if len(header) < HEADER.size:
+        return None, fds
+    size = HEADER.unpack(header)[0]
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff message cut short")
+        data += chunk
+    return data, fds
+
+
+class HandoffServer(Loggable):
+    """ Serves the handoff requests of the running process. hand_off() of
+        every site stops the site and returns its SiteState.
+    """
+    def __init__(self, path, sites):
+        super(HandoffServer, self).__init__()
+        self.path = path
+        self.sites = sites
+        self._server = None
+        self._conn = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        try:
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(self.path)
+            self._server.listen(1)
+        except OSError as e:
+            self._server = None
+            return self.logger.error("Cannot serve handoff requests on %s: %s", self.path, e)
+        self._thread = threading.Thread(target=self.run, name="handoff", daemon=True)
+        self._thread.start()
+        self.logger.info("Serving handoff requests on %s", self.path)
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            try:
+                request = conn.recv(len(HANDOFF_REQUEST))
+            except OSError:
+                request = b""
+            if request != HANDOFF_REQUEST:
+                self.logger.warn("Ignoring invalid handoff request")
+                conn.close()
+                continue
+            self.hand_off(conn)
+            return
+
+    def hand_off(self, conn):
+        self.logger.warn("Handing the connections over to a new process")
+        self._conn = conn
+        # No new process may connect until we are done
+        self._server.close()
+        for site in self.sites:
+            state = site.hand_off()
+            try:
+                send_message(conn, state.serialize(), state.fds)
+            except OSError as e:
+                self.logger.error("Cannot hand site %s over: %s", state.name, e)
+            finally:
+                state.close()
+        try:
+            send_message(conn, b"{}")
+        except OSError:
+            pass
+
+    def close(self):
+        """ The new process waits for this before using the CDR buffers and
+            files, as they are closed by then
+        """
+        if self._server is None:
+            return
+        try:
+            # wakes up accept()
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        self._thread.join()
+        if self._conn is not None:
+            self._conn.close()
+        elif os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class TakeOver(Loggable):
+    """ Takes the sites over from the process serving handoff requests on path"""
+    def __init__(self, path):
+        super(TakeOver, self).__init__()
+        self.path = path
+
+    def run(self):
+        """ Returns the SiteStates by site name, or None if there is no
+            process to take over from
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            self.logger.warn("No process to take over from on %s (%s). Starting afresh", self.path, e)
+            return None
+        states = {}
+        try:
+            sock.sendall(HANDOFF_REQUEST)
+            while True:
+                data, fds = recv_message(sock)
+                if data is None:
+                    raise ConnectionError("The running process closed the handoff connection")
+                if data == b"{}":
+                    break
+                state = SiteState.deserialize(data, fds)
+                self.logger.info("Took over site %s: %s", state.name, ", ".join(sorted(state.legs)))
+                states[state.name] = state
+            # Wait until it exited, its CDR buffers and files are closed by then
+            sock.settimeout(EXIT_TIMEOUT)
+            try:
+                while sock.recv(4096):
+                    pass
+            except socket.timeout:
+                self.logger.warn("The previous process is still running")
+        except (OSError, ValueError) as e:
+            self.logger.error("Handoff failed: %s", e)
+        finally:
+            sock.close()
+        return states
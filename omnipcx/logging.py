@@ -1,6 +1,7 @@
-import time
+import json
 import logging
-import inspect
+import logging.handlers
+import queue
 
 import platform
 if platform.system() != 'Windows':
@@ -108,50 +109,89 @@ else:
 
 
 class LogWrapper(object):
+    """ Thin wrapper over a logging.Logger. The level is checked before
+        anything else, so a disabled call costs a method call and a dict
+        lookup. The message is only formatted by the handler, with the
+        arguments given here, and logging finds the caller with
+        sys._getframe (stacklevel skips this wrapper).
+    """
+    __slots__ = ('_logger',)
+
     def __init__(self, logger):
         self._logger = logger
 
-    @property
-    def _logging_extra(self):
-        frame = inspect.currentframe()
-        try:
-            frame_info = inspect.getouterframes(frame)[2]
-            try:
-                return {
-                    'file': str(frame_info[1]),
-                    'line_no': str(frame_info[2]),
-                    'function': frame_info[3],
-                    'timestamp': int(time.time()),
-                }
-            finally:
-                del frame_info
-        finally:
-            del frame
+    def _log(self, level, message, args, **kwargs):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, message, *args, stacklevel=3, **kwargs)
 
     def trace(self, message, *args):
-        self._logger.debug(message, *args, extra=self._logging_extra)
+        self._log(logging.DEBUG, message, args)
 
     def debug(self, message, *args):
-        self._logger.debug(message, *args, extra=self._logging_extra)
+        self._log(logging.DEBUG, message, args)
 
     def info(self, message, *args):
-        self._logger.info(message, *args, extra=self._logging_extra)
+        self._log(logging.INFO, message, args)
 
     def warn(self, message, *args):
-        self._logger.warn(message, *args, extra=self._logging_extra)
+        self._log(logging.WARNING, message, args)
+
+    warning = warn
 
     def error(self, message, *args):
-        self._logger.error(message, *args, extra=self._logging_extra)
+        self._log(logging.ERROR, message, args)
 
     def exception(self, message, *args):
-        import sys, os, os.path
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        self.error(message)
-        self.error("Exception %s in file %s, line %s" % (exc_type.__name__, fname, exc_tb.tb_lineno))
+        self._log(logging.ERROR, message, args, exc_info=True)
+
+
+class JSONFormatter(logging.Formatter):
+    """ One JSON object per record"""
+    def format(self, record):
+        entry = {
+            'timestamp': record.created,
+            'level': record.levelname,
+            'file': record.pathname,
+            'line_no': record.lineno,
+            'function': record.funcName,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ Puts the records on a queue without formatting them; the
+        QueueListener thread formats and writes them. Only the traceback is
+        rendered here, as it can't be kept around.
+    """
+    _exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def start_queue_logging(logger, handler):
+    """ Sends the records of logger through a queue to handler, which runs
+        in the returned listener's thread. Stop the listener to flush it.
+    """
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
 
 
 class Loggable(object):
+    __slots__ = ()
+
     @property
     def logger(self):
         return self._logger
@@ -1,7 +1,10 @@
 from omnipcx.logging import Loggable
+from omnipcx.messages import crc
 
 
 class MessageBase(Loggable):
+    __slots__ = ()
+
     @classmethod
     def get_size(cls):
         raise NotImplementedError
@@ -23,6 +26,8 @@ class MessageBase(Loggable):
 
 
 class ControlMessage(MessageBase):
+    __slots__ = ()
+
     @classmethod
     def get_size(self):
         return 1
@@ -36,6 +41,12 @@ class ControlMessage(MessageBase):
 
 
 class ProtocolMessage(MessageBase):
+    """ A framed message. The wire bytes (STX + payload + ETX) are the only
+        state: serialize() returns them as they are, and fields are sliced
+        out of them only when they are asked for.
+    """
+    __slots__ = ('_frame',)
+
     STX = b'\x02'
     ETX = b'\x03'
 
@@ -43,19 +54,43 @@ class ProtocolMessage(MessageBase):
         # Not valid anymore
         # assert len(payload) == self.get_payload_size()
         if with_ends:
-            self.payload = payload[1:-1]
+            self._frame = bytes(payload)
         else:
-            self.payload = payload
+            self._frame = b"".join((ProtocolMessage.STX, payload, ProtocolMessage.ETX))
+
+    @property
+    def payload(self):
+        """ Read only view of the payload, without copying it"""
+        return memoryview(self._frame)[1:-1]
+
+    @payload.setter
+    def payload(self, value):
+        self._frame = b"".join((ProtocolMessage.STX, value, ProtocolMessage.ETX))
+
+    def field(self, offset, length):
+        """ The bytes at the given offset of the payload"""
+        return self._frame[1 + offset:1 + offset + length]
+
+    def set_field(self, offset, value):
+        """ Overwrites the bytes at the given offset of the payload, and the
+            CRC if the message has one.
+        """
+        start = 1 + offset
+        end = start + len(value)
+        if self.has_crc():
+            data = b"".join((self._frame[1:start], value, self._frame[end:-3]))
+            self.payload = data + self.crc(data)
+        else:
+            self._frame = b"".join((self._frame[:start], value, self._frame[end:]))
 
     @classmethod
     def crc(cls, string):
-        hexa = '0123456789ABCDEF'
-        if string == b"":
-            return b""
-        result = string[0]
-        for c in string[1:]:
-            result = result ^ c
-        return hexa[(result >> 4) & 0xF] + hexa[result & 0xF]
+        return crc.crc(string)
+
+    @property
+    def crc_valid(self):
+        """ Messages without a checksum are always valid"""
+        return not self.has_crc() or crc.is_valid(self.payload)
 
     def serialize(self):
-        return ProtocolMessage.STX + self.payload + ProtocolMessage.ETX
+        return self._frame
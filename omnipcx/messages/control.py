@@ -1,24 +1,32 @@
 from omnipcx.messages.base import ControlMessage
 
 class ACK(ControlMessage):
+    __slots__ = ()
+
     @classmethod
     def get_type(cls):
         return b'\x06'
 
 
 class NACK(ControlMessage):
+    __slots__ = ()
+
     @classmethod
     def get_type(cls):
         return b'\x15'
 
 
 class XON(ControlMessage):
+    __slots__ = ()
+
     @classmethod
     def get_type(cls):
         return b'\x13'
 
 
 class XOFF(ControlMessage):
+    __slots__ = ()
+
     @classmethod
     def get_type(cls):
         return b'\x11'
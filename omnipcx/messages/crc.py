@@ -0,0 +1,64 @@
+""" Checksum of the protocol messages: the XOR of all the payload bytes,
+    sent as two uppercase hex digits at the end of the payload.
+"""
+import functools, operator
+
+# checksum value -> the two hex digits sent on the wire
+HEX = tuple(b'%02X' % value for value in range(256))
+# two hex digits -> checksum value. Lower case digits are accepted too.
+_VALUES = dict((digits, value) for value, digits in enumerate(HEX))
+_VALUES.update((digits.lower(), value) for value, digits in enumerate(HEX))
+
+# What to do with a frame having a wrong checksum
+POLICY_OFF = 'off'          # don't check
+POLICY_PASS = 'pass'        # check, log and forward it anyway
+POLICY_REJECT = 'reject'    # drop it
+POLICY_NACK = 'nack'        # drop it and send NACK to the sender so it resends
+POLICIES = [POLICY_OFF, POLICY_PASS, POLICY_REJECT, POLICY_NACK]
+
+
+def checksum(data):
+    return functools.reduce(operator.xor, data, 0)
+
+
+def crc(data):
+    """ The two hex digits of the checksum of data"""
+    if len(data) == 0:
+        return b""
+    return HEX[checksum(data)]
+
+
+def checksums(items):
+    """ Checksums of many byte strings at once. Strings of the same length
+        are concatenated and XORed column by column as big integers, so the
+        loop runs once per byte position instead of once per byte.
+    """
+    by_length = {}
+    for index, data in enumerate(items):
+        by_length.setdefault(len(data), []).append(index)
+    result = [0] * len(items)
+    for length, indexes in by_length.items():
+        if length == 0:
+            continue
+        data = b"".join(items[index] for index in indexes)
+        value = 0
+        for column in range(length):
+            value ^= int.from_bytes(data[column::length], "little")
+        for index, check in zip(indexes, value.to_bytes(len(indexes), "little")):
+            result[index] = check
+    return result
+
+
+def is_valid(payload):
+    """ Checks the two hex digits at the end of the payload"""
+    if len(payload) < 3:
+        return False
+    return _VALUES.get(bytes(payload[-2:]), None) == checksum(payload[:-2])
+
+
+def verify_many(payloads):
+    """ Returns a list of booleans, telling which payloads have a valid checksum"""
+    payloads = [bytes(payload) for payload in payloads]
+    computed = checksums([payload[:-2] for payload in payloads])
+    return [len(payload) >= 3 and _VALUES.get(payload[-2:], None) == check
+        for payload, check in zip(payloads, computed)]
@@ -1,10 +1,19 @@
 def MessageParameters(_type, size, _has_crc=True):
-    """ Decorator for simplifying the definition of protocol messages
+    """ Decorator for simplifying the definition of protocol messages.
+        `size` is the length of the whole frame, STX and ETX included.
     """
     def get_type(cls):
         return bytearray(_type, "ascii")
 
+    def get_size(cls):
+        return size
+
+    def has_crc(cls):
+        return _has_crc
+
     def _wrapper(cls):
         cls.get_type = classmethod(get_type)
+        cls.get_size = classmethod(get_size)
+        cls.has_crc = classmethod(has_crc)
         return cls
     return _wrapper
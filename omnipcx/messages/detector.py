@@ -1,18 +1,26 @@
+import collections
 from omnipcx.logging import Loggable
 from omnipcx.messages.control import CLASSES as _CONTROL_MSG_CLS
 from omnipcx.messages.protocol import CLASSES as _PROTOCOL_MSG_CLS
 
 from omnipcx.messages.base import ControlMessage, ProtocolMessage
+from omnipcx.messages.control import NACK
+from omnipcx.messages import crc
 
-RECV_SIZE = 150
+RECV_SIZE = 4096
 
 class MessageDetector(Loggable):
     is_initialized = False
+    crc_policy = crc.POLICY_OFF
 
-    def __init__(self, socket):
+    def __init__(self, socket, capture=None):
         self.init_message_classes()
         self.socket = socket
-        self.remainder = b""
+        self.capture = capture
+        self.remainder = bytearray()
+        # parsed messages nobody took yet. They outlive the messages() generators
+        self.pending = collections.deque()
+        self.invalid = False
 
     @classmethod
     def init_message_classes(cls):
@@ -20,32 +28,118 @@ class MessageDetector(Loggable):
             return
         cls.ctrl_msg_classes = dict( (clss.get_type()[0],clss) for clss in _CONTROL_MSG_CLS)
         cls.proto_classes = dict( (clss.get_type()[0],clss) for clss in _PROTOCOL_MSG_CLS)
+        # Some message types (e.g. full and partial reinit) share the type
+        # byte and can only be told apart by their size
+        cls.sized_proto_classes = {}
+        for clss in _PROTOCOL_MSG_CLS:
+            cls.sized_proto_classes.setdefault(clss.get_type()[0], {})[clss.get_size()] = clss
+        cls.max_frame_size = max(clss.get_size() for clss in _PROTOCOL_MSG_CLS)
         cls.is_initialized = True
 
+    @classmethod
+    def set_crc_policy(cls, policy):
+        if policy not in crc.POLICIES:
+            raise ValueError("Unknown CRC policy '%s'" % policy)
+        cls.crc_policy = policy
+
+    def check_crc(self, message):
+        """ Applies the CRC policy to a received message. Returns False if
+            the message needs to be dropped.
+        """
+        if crc.is_valid(message.payload):
+            return True
+        if self.crc_policy == crc.POLICY_PASS:
+            self.logger.warn("Forwarding %s with invalid CRC", message.serialize())
+            return True
+        self.logger.error("Dropping %s with invalid CRC", message.serialize())
+        if self.crc_policy == crc.POLICY_NACK and self.socket is not None:
+            if not self.socket.send(NACK()):
+                self.logger.error("Failed sending NACK for message with invalid CRC")
+        return False
+
+    def proto_class(self, _type, size):
+        sized = self.sized_proto_classes.get(_type, None)
+        if sized is None:
+            return None
+        ProtoClass = sized.get(size, None)
+        if ProtoClass is None:
+            # Remember the unexpected size so that we only warn once about it
+            ProtoClass = sized[size] = self.proto_classes[_type]
+            self.logger.warn("Frame of type %s has %d bytes instead of %d", chr(_type), size, ProtoClass.get_size())
+        return ProtoClass
+
+    def feed(self, data):
+        """ Parse all the complete messages found in the received data.
+            Returns the messages as a list. An incomplete frame stays in the
+            buffer until the rest of it arrives.
+        """
+        buf = self.remainder
+        if data:
+            if self.capture is not None:
+                self.capture.received(data)
+            buf += data
+        messages = []
+        pos = 0
+        end = len(buf)
+        stx = ProtocolMessage.STX[0]
+        etx = ProtocolMessage.ETX[0]
+        check_crc = self.crc_policy != crc.POLICY_OFF
+        with memoryview(buf) as view:
+            while pos < end:
+                first = buf[pos]
+                if first == stx:
+                    i = buf.find(etx, pos + 1, pos + self.max_frame_size)
+                    if i < 0:
+                        if end - pos >= self.max_frame_size:
+                            self.logger.error("Frame longer than %d bytes without ETX", self.max_frame_size)
+                            self.invalid = True
+                        break
+                    sized = self.sized_proto_classes.get(buf[pos + 1], None) if i > pos + 1 else None
+                    ProtoClass = sized.get(i + 1 - pos, None) if sized is not None else None
+                    if ProtoClass is None and sized is not None:
+                        ProtoClass = self.proto_class(buf[pos + 1], i + 1 - pos)
+                    if ProtoClass is None:
+                        self.logger.error("Invalid message type")
+                        self.invalid = True
+                        break
+                    message = ProtoClass(bytes(view[pos:i + 1]))
+                    pos = i + 1
+                    if check_crc and ProtoClass.has_crc() and not self.check_crc(message):
+                        continue
+                    messages.append(message)
+                else:
+                    CtrlMsgClass = self.ctrl_msg_classes.get(first, None)
+                    if CtrlMsgClass is None:
+                        self.logger.error("Invalid character in stream ord(%s)", first)
+                        self.invalid = True
+                        break
+                    messages.append(CtrlMsgClass())
+                    pos += 1
+        del buf[:pos]
+        return messages
+
+    def restore(self, data):
+        """ Takes back data received but not handled yet, e.g. by the
+            process that handed the connection over
+        """
+        self.remainder += data
+        self.pending.extend(self.feed(b""))
+
+    def unread(self):
+        """ The received data that wasn't handled yet, as it was received"""
+        return b"".join(bytes(message.serialize()) for message in self.pending) + bytes(self.remainder)
+
     def messages(self):
+        pending = self.pending
         while True:
-            message = self.socket.recv(RECV_SIZE)
-            self.remainder += message
-            if len(self.remainder) == 0:
-                yield None
-                continue
-            if self.remainder[0] == ProtocolMessage.STX[0]:
-                # eat up all the message until ProtocolMessage.ETX
-                i = 1
-                while self.remainder[i] != ProtocolMessage.ETX[0]:
-                    i += 1
-                # TODO: here we should probably check if we arrived at the end of remainder and read more :(
-                payload = self.remainder[:i+1]
-                self.remainder = self.remainder[i+1:]
-                ProtoClass = self.proto_classes.get(payload[1], None)
-                if ProtoClass is None:
-                    self.logger.error("Invalid message type")
-                    return
-                yield ProtoClass(payload)
-            elif self.ctrl_msg_classes.get(self.remainder[0], None) is not None:
-                CtrlMsgClass = self.ctrl_msg_classes[self.remainder[0]]
-                self.remainder = self.remainder[1:]
-                yield CtrlMsgClass()
-            else:
-                self.logger.error("Invalid character in stream ord(%s)" % self.remainder[0])
+            if not pending:
+                pending.extend(self.feed(self.socket.recv(RECV_SIZE)))
+                if not pending:
+                    if self.invalid:
+                        return
+                    yield None
+                    continue
+            while pending:
+                yield pending.popleft()
+            if self.invalid:
                 return
@@ -3,123 +3,145 @@ from omnipcx.messages.base import ProtocolMessage
 
 @MessageParameters('@', 7, False)
 class TCPConnection(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('$', 7, False)
 class KeepAlive(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('J', 74)
 class SMDR(ProtocolMessage):
+    """ Call record of the PBX.
+
+        The field offsets aren't taken from the PBX documentation, they are
+        inferred from the SMDR frames seen on the link. The CDR store and
+        export (omnipcx.cdr_store, omnipcx.cdr_columns) read the fields at
+        these offsets: check them against the SMDR layout of the PBX before
+        relying on the durations and costs they report.
+    """
+    __slots__ = ()
+
+    # (offset, length) of the fields of the payload
+    COST = (10, 6)          # charge units
+    START_DATE = (18, 6)    # DDMMYY
+    START_TIME = (24, 4)    # HHMM
+    EXTENSION = (28, 5)
+    DIALLED = (33, 20)
+    DURATION = (53, 6)      # seconds
+
     def serialize_cdr(self):
-        return self.payload + b'\x0d\x0a'
+        return b"".join((self.payload, b'\x0d\x0a'))
 
 
 class CheckInBase(ProtocolMessage):
+    __slots__ = ()
+
     PASSWORD_OFFSET = 35 # TODO: check with PBX
 
     @property
     def password(self):
-        return self.payload[self.PASSWORD_OFFSET:self.PASSWORD_OFFSET + self.PASSWORD_LEN]
+        return self.field(self.PASSWORD_OFFSET, self.PASSWORD_LEN)
 
     @password.setter
     def password(self, value):
         if len(value) > self.PASSWORD_LEN:
             raise ValueError("'password' needs to be less than %d characters long" % self.PASSWORD_LEN)
-        password = bytearray(" " * (self.PASSWORD_LEN - len(value)) + value, "ascii")
-        new_payload = self.payload[:self.PASSWORD_OFFSET] + password + self.payload[self.PASSWORD_OFFSET + self.PASSWORD_LEN:-2]
-        self.payload = new_payload + bytearray(self.crc(new_payload), "ascii")
+        self.set_field(self.PASSWORD_OFFSET, bytearray(" " * (self.PASSWORD_LEN - len(value)) + value, "ascii"))
 
 
 @MessageParameters('A', 61)
 class CheckIn(CheckInBase):
+    __slots__ = ()
+
     PASSWORD_LEN = 4
 
 
 @MessageParameters('H', 22)
 class PhoneAllocation(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('M', 61)
 class VoiceMailAttribution(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('D', 13)
 class CheckOut(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('C', 17)
 class RoomStatusChange(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('T', 44)
 class GuestTelephoneAccount(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('P', 49)
 class WakeUpEvent(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('U', 96)
 class FullReinit(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('U', 26)
 class PartialReinit(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('R', 19)
 class Reply(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 # Hotel Aplication to Hotel Driver messages
 
 @MessageParameters('I', 13)
 class Interogation(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('Z', 14)
 class ReinitRequest(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 # New messages for support of 6 digits password
 
 @MessageParameters('B', 63)
 class CheckinSixDigit(CheckInBase):
+    __slots__ = ()
+
     PASSWORD_LEN = 6
 
 
 @MessageParameters('N', 63)
 class ModificationSixDigit(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('V', 98)
 class FullReinitSixDigit(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('V', 28)
 class PartialReinitSixDigit(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 @MessageParameters('S', 21)
 class ReplySixDigit(ProtocolMessage):
-    pass
+    __slots__ = ()
 
 
 CLASSES = [
@@ -0,0 +1,244 @@
+""" Counters and histograms of the proxy, served over HTTP in the Prometheus
+    text format. Every metric has a `site` label, so that the sites of a
+    site table can be told apart.
+
+    The forwarding loops update them for every message. A counter update is
+    an uncontended lock and an addition; the label lookups are done once per
+    session and kept by the callers.
+"""
+import bisect, http.server, threading, time
+from omnipcx.logging import Loggable
+
+DEFAULT_METRICS_ADDRESS = '127.0.0.1'
+# seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Sink label of the CDR metrics without a CDR fan-out
+DEFAULT_SINK = 'cdr'
+
+# Directions of the forwarded frames
+PBX_TO_OPERA = 'pbx_to_opera'
+OPERA_TO_PBX = 'opera_to_pbx'
+
+
+class Counter(object):
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(object):
+    """ Value read when the metrics are collected"""
+    __slots__ = ('_function',)
+
+    def __init__(self):
+        self._function = lambda: 0
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self, name, labels):
+        yield name, labels, self._function()
+
+
+class Histogram(object):
+    __slots__ = ('_lock', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, value in zip(self.buckets + (float("inf"),), counts):
+            cumulative += value
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield name + "_bucket", labels + (("le", le),), cumulative
+        yield name + "_sum", labels, total
+        yield name + "_count", labels, count
+
+
+class Metric(object):
+    """ A metric with labels. labels() returns the child (Counter, Gauge or
+        Histogram) holding the value for the given label values.
+    """
+    def __init__(self, name, documentation, labelnames, kind, child_class):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.kind = kind
+        self.child_class = child_class
+        self._children = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values, None)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self.child_class())
+        return child
+
+    def expose(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+        for values, child in list(self._children.items()):
+            for name, labels, value in child.samples(self.name, tuple(zip(self.labelnames, values))):
+                text = ",".join('%s="%s"' % (label, _escape(str(text))) for label, text in labels)
+                lines.append("%s{%s} %s" % (name, text, _format_value(value)))
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = []
+
+FRAMES = Metric('omnipcx_frames_total', 'Frames forwarded, by direction and message class',
+    ('site', 'direction', 'type'), 'counter', Counter)
+BYTES = Metric('omnipcx_bytes_total', 'Bytes of the forwarded frames, by direction and message class',
+    ('site', 'direction', 'type'), 'counter', Counter)
+ROUNDTRIP = Metric('omnipcx_roundtrip_seconds', 'Time from receiving a message to sending back the reply '
+    'of the other end, by the leg that sent the message', ('site', 'origin'), 'histogram', Histogram)
+CDR_SEND = Metric('omnipcx_cdr_send_seconds', 'Time spent handing CDRs to the collector or the CDR file, by sink',
+    ('site', 'sink'), 'histogram', Histogram)
+CDR_SENT = Metric('omnipcx_cdr_sent_total', 'CDRs handed to the collector or the CDR file, by sink',
+    ('site', 'sink'), 'counter', Counter)
+CDR_FAILURES = Metric('omnipcx_cdr_send_failures_total', 'Failed attempts to send CDRs, by sink',
+    ('site', 'sink'), 'counter', Counter)
+CDR_DUPLICATES = Metric('omnipcx_cdr_duplicates_total', 'CDRs the PBX sent again, not handed to the collector',
+    ('site',), 'counter', Counter)
+BUFFER_DEPTH = Metric('omnipcx_cdr_buffer_depth', 'CDRs waiting in the buffer database',
+    ('site',), 'gauge', Gauge)
+SINK_LAG = Metric('omnipcx_cdr_sink_lag', 'CDRs a sink of the CDR fan-out didn\'t get yet',
+    ('site', 'sink'), 'gauge', Gauge)
+SINK_CONNECTED = Metric('omnipcx_cdr_sink_connected', 'Whether a sink of the CDR fan-out is connected',
+    ('site', 'sink'), 'gauge', Gauge)
+SINK_LAST_DELIVERY = Metric('omnipcx_cdr_sink_last_delivery_timestamp_seconds',
+    'When a sink of the CDR fan-out last got CDRs (0 if it never did)', ('site', 'sink'), 'gauge', Gauge)
+CONNECTIONS = Metric('omnipcx_connections_total', 'Connections opened or accepted, by leg',
+    ('site', 'leg'), 'counter', Counter)
+CONNECTION_FAILURES = Metric('omnipcx_connection_failures_total', 'Failed connection attempts, by leg',
+    ('site', 'leg'), 'counter', Counter)
+
+
+def expose():
+    """ All the metrics in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+def connection(site, leg, connected):
+    """ Counts a connection attempt"""
+    (CONNECTIONS if connected else CONNECTION_FAILURES).labels(site, leg).inc()
+
+
+class ProxyMetrics(object):
+    """ Metrics of a proxy session, with the label lookups cached"""
+    def __init__(self, site):
+        self.site = site
+        self._frames = {}
+        self.roundtrip = {
+            PBX_TO_OPERA: ROUNDTRIP.labels(site, 'pbx'),
+            OPERA_TO_PBX: ROUNDTRIP.labels(site, 'opera'),
+        }
+
+    def forwarded(self, direction, message):
+        key = (direction, message.__class__)
+        counters = self._frames.get(key, None)
+        if counters is None:
+            name = message.__class__.__name__
+            counters = self._frames[key] = (FRAMES.labels(self.site, direction, name),
+                BYTES.labels(self.site, direction, name))
+        counters[0].inc()
+        counters[1].inc(len(message.serialize()))
+
+    def replied(self, direction, started):
+        """ The reply to a message received in `direction` at `started` (time.monotonic) was sent"""
+        self.roundtrip[direction].observe(time.monotonic() - started)
+
+
+class CDRMetrics(object):
+    __slots__ = ('send', 'sent', 'failures')
+
+    def __init__(self, site, sink=DEFAULT_SINK):
+        self.send = CDR_SEND.labels(site, sink)
+        self.sent = CDR_SENT.labels(site, sink)
+        self.failures = CDR_FAILURES.labels(site, sink)
+
+    def done(self, started, count, ok):
+        if ok:
+            self.send.observe(time.monotonic() - started)
+            self.sent.inc(count)
+        else:
+            self.failures.inc()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(Loggable):
+    """ Serves the metrics from a background thread"""
+    def __init__(self, port, address=DEFAULT_METRICS_ADDRESS):
+        super(MetricsServer, self).__init__()
+        self.address = address
+        self.port = port
+        self._server = None
+
+    def start(self):
+        try:
+            self._server = http.server.ThreadingHTTPServer((self.address, self.port), MetricsHandler)
+        except OSError as e:
+            return self.logger.error("Cannot serve metrics on %s:%s: %s", self.address, self.port, e)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        thread.start()
+        self.logger.info("Serving metrics on http://%s:%d/metrics", self.address, self.port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
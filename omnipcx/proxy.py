@@ -2,39 +2,38 @@ import threading
 import time
 from omnipcx.logging import Loggable
 from omnipcx.messages import MessageDetector
-from omnipcx.messages.protocol import SMDR, CheckInBase
+from omnipcx.messages.base import ControlMessage
+from omnipcx.messages.protocol import SMDR
 from omnipcx.messages.control import NACK
+from omnipcx.cdr_replay import CDRReplayer
+from omnipcx.upstream import keepalive
+from omnipcx import rules as _rules
+from omnipcx.metrics import ProxyMetrics, PBX_TO_OPERA, OPERA_TO_PBX
 
 MAX_TIME = 60.0
 
-class Proxy(Loggable):
-    def __init__(self, pbx, hotel, cdr, default_password, buf):
-        super(Proxy, self).__init__()
+class ProxyBase(Loggable):
+    """ What the forwarding of both engines shares: the legs, the rules, the
+        CDR delivery and the answers the proxy sends itself
+    """
+    def __init__(self, pbx, hotel, cdr, default_password, buf, replayer, site='default', rules=None,
+            keepalive_interval=0):
+        super(ProxyBase, self).__init__()
         self.pbx = pbx
         self.hotel = hotel
         self.cdr = cdr
-        self.upstream = MessageDetector(self.pbx)
-        self.downstream = MessageDetector(self.hotel)
         self.default_password = default_password
+        # Compiled Rules of the site (see omnipcx.rules)
+        self.rules = rules if rules is not None else _rules.compile_rules([], default_password)
+        # Send our own KeepAlive to Opera when it was quiet this long (--local-keepalive)
+        self.keepalive_interval = keepalive_interval
         self.buffer = buf
+        self.replayer = replayer
+        self.metrics = ProxyMetrics(site)
 
     def send_missing_cdr(self):
-        if self.buffer.is_empty:
-            return True
-        self.logger.info("Sending buffered CDRs")
-        count = 0
-        while True:
-            # TODO: try to do some kind of flow control ...
-            message = self.buffer.get()
-            if not self.cdr.send(message):
-                self.logger.error("CDR sending failed")
-                self.buffer.put(message)
-                return False
-            count += 1
-            if self.buffer.is_empty:
-                break
-        self.logger.info("Sent all CDRs to the collector")
-        return True
+        """ Starts sending the buffered CDRs in the background"""
+        self.replayer.start()
 
     def send_nack_to_pbx(self, log_msg):
         if not self.pbx.send(NACK()):
@@ -44,52 +43,155 @@ class Proxy(Loggable):
         if log_msg != "":
             self.logger.error(log_msg)
 
+    def drop(self, message, rule, source):
+        """ Answers, in place of the other end, a frame a rule doesn't
+            forward. A CDR still goes to the collector. Returns False when
+            the session is over.
+        """
+        if isinstance(message, SMDR) and not self.replayer.deliver(message):
+            self.buffer.put(message)
+            self.send_nack_to_pbx(log_msg="CDR collector closed connection. Reseting all others")
+            return False
+        if rule.answer is not None and not source.send(rule.answer()):
+            if source is self.pbx:
+                self.logger.error("PBX closed connection. Reseting all others")
+            else:
+                self.logger.error("Opera closed connection. Reseting all others")
+            return False
+        return True
+
+
+class Proxy(ProxyBase):
+    """ Forwarding of the polling engine: reads each leg in turn and waits
+        for the reply to a frame before reading the next one
+    """
+    def __init__(self, pbx, hotel, cdr, default_password, buf, stop_event=None, site='default', pbx_detector=None,
+            rules=None, keepalive_interval=0):
+        super(Proxy, self).__init__(pbx, hotel, cdr, default_password, buf, CDRReplayer(buf, cdr), site, rules,
+            keepalive_interval)
+        # The PBX connection may outlive the session, and its detector with it
+        self.upstream = pbx_detector if pbx_detector is not None else MessageDetector(self.pbx, pbx.capture)
+        self.downstream = MessageDetector(self.hotel, hotel.capture)
+        self.stop_event = stop_event
+
+    def keep_opera_alive(self):
+        """ Sends a KeepAlive of our own to Opera. forward() takes the next
+            ACK or NACK of Opera as its answer. Returns False when the
+            session is over.
+        """
+        if not self.hotel.send(keepalive()):
+            self.logger.error("Opera closed connection. Reseting all others")
+            return False
+        return True
+
     def run(self):
+        self.send_missing_cdr()
+        try:
+            return self.forward()
+        finally:
+            self.replayer.stop()
+
+    def forward(self):
         time_last_recv =  {
             "upstream": time.time(),
             "downstream": time.time()
         }
         upstream_g = self.upstream.messages()
         downstream_g = self.downstream.messages()
-        if not self.send_missing_cdr():
-            return
+        # When Opera has to have answered our own KeepAlive, if it didn't yet
+        keepalive_deadline = None
         while True:
+            if self.stop_event is not None and self.stop_event.is_set():
+                return self.logger.info("Stopping proxy operation")
+            if self.replayer.failed:
+                return self.logger.error("CDR collector closed connection. Reseting all others")
             # Try to read from PBX
             u_msg = next(upstream_g)
             if u_msg:
                 time_last_recv["upstream"] = time.time()
-                self.logger.trace("Recv %s from pbx" % u_msg.serialize())
-                if isinstance(u_msg, SMDR):
-                    if not self.cdr.send(u_msg):
-                        self.buffer.put(u_msg)
-                        return self.send_nack_to_pbx(log_msg="CDR collector closed connection. Reseting all others")
-                self.logger.trace("Send %s to hotel" % u_msg.serialize())
-                if not self.hotel.send(u_msg):
-                    return self.send_nack_to_pbx(log_msg="Opera closed connection. Reseting all others")
-                d_msg = next(downstream_g)
-                if not d_msg:
-                    return self.logger.error("Timeout when waiting for message from Opera")
-                time_last_recv["downstream"] = time.time()
-                if not self.pbx.send(d_msg):
-                    return self.logger.error("PBX closed connection. Reseting all others")
+                started = time.monotonic()
+                self.metrics.forwarded(PBX_TO_OPERA, u_msg)
+                self.logger.trace("Recv %s from pbx", u_msg.serialize())
+                rule = self.rules.pbx.get(u_msg.__class__)
+                if rule is not None:
+                    rule.rewrite(u_msg)
+                if rule is not None and not rule.forward:
+                    if not self.drop(u_msg, rule, self.pbx):
+                        return
+                else:
+                    if isinstance(u_msg, SMDR):
+                        if not self.replayer.deliver(u_msg):
+                            self.buffer.put(u_msg)
+                            return self.send_nack_to_pbx(log_msg="CDR collector closed connection. Reseting all others")
+                    self.logger.trace("Send %s to hotel", u_msg.serialize())
+                    if not self.hotel.send(u_msg):
+                        return self.send_nack_to_pbx(log_msg="Opera closed connection. Reseting all others")
+                    d_msg = next(downstream_g)
+                    if keepalive_deadline is not None and isinstance(d_msg, ControlMessage):
+                        # the answer to our KeepAlive comes first
+                        keepalive_deadline = None
+                        d_msg = next(downstream_g)
+                    if not d_msg:
+                        if not self.hotel.connected:
+                            return self.send_nack_to_pbx(log_msg="Opera closed connection. Reseting all others")
+                        return self.logger.error("Timeout when waiting for message from Opera")
+                    time_last_recv["downstream"] = time.time()
+                    self.metrics.forwarded(OPERA_TO_PBX, d_msg)
+                    rule = self.rules.opera.get(d_msg.__class__)
+                    if rule is not None:
+                        rule.rewrite(d_msg)
+                    if not self.pbx.send(d_msg):
+                        return self.logger.error("PBX closed connection. Reseting all others")
+                    self.metrics.replied(PBX_TO_OPERA, started)
             # Try to read from Hotel
             d_msg = next(downstream_g)
+            if keepalive_deadline is not None and isinstance(d_msg, ControlMessage):
+                time_last_recv["downstream"] = time.time()
+                keepalive_deadline = None
+                d_msg = None
             if d_msg:
                 time_last_recv["downstream"] = time.time()
-                self.logger.trace("Recv %s from hotel" % d_msg.serialize())
-                if isinstance(d_msg, CheckInBase):
-                    if d_msg.password == b"    ":
-                        d_msg.password = self.default_password
-                self.logger.trace("Send %s to pbx" % d_msg.serialize())
-                if not self.pbx.send(d_msg):
-                    return self.logger.error("PBX closed connection. Reseting all others")
-                u_msg = next(upstream_g)
-                if not u_msg:
-                    return self.logger.error("Timeout when waiting for message from OLD/Hotel Driver")
-                time_last_recv["upstream"] = time.time()
-                if not self.hotel.send(u_msg):
-                    return self.logger.error("Opera closed connection. Reseting all others")
+                started = time.monotonic()
+                self.metrics.forwarded(OPERA_TO_PBX, d_msg)
+                self.logger.trace("Recv %s from hotel", d_msg.serialize())
+                rule = self.rules.opera.get(d_msg.__class__)
+                if rule is not None:
+                    rule.rewrite(d_msg)
+                if rule is not None and not rule.forward:
+                    if not self.drop(d_msg, rule, self.hotel):
+                        return
+                else:
+                    self.logger.trace("Send %s to pbx", d_msg.serialize())
+                    if not self.pbx.send(d_msg):
+                        return self.logger.error("PBX closed connection. Reseting all others")
+                    u_msg = next(upstream_g)
+                    if not u_msg:
+                        if not self.pbx.connected:
+                            return self.logger.error("PBX closed connection. Reseting all others")
+                        return self.logger.error("Timeout when waiting for message from OLD/Hotel Driver")
+                    time_last_recv["upstream"] = time.time()
+                    rule = self.rules.pbx.get(u_msg.__class__)
+                    if rule is not None:
+                        rule.rewrite(u_msg)
+                    if isinstance(u_msg, SMDR) and not self.replayer.deliver(u_msg):
+                        # The PBX sent a CDR instead of replying
+                        self.buffer.put(u_msg)
+                        return self.send_nack_to_pbx(log_msg="CDR collector closed connection. Reseting all others")
+                    self.metrics.forwarded(PBX_TO_OPERA, u_msg)
+                    if not self.hotel.send(u_msg):
+                        return self.logger.error("Opera closed connection. Reseting all others")
+                    self.metrics.replied(OPERA_TO_PBX, started)
+            if not self.pbx.connected:
+                return self.logger.error("PBX closed connection. Reseting all others")
+            if not self.hotel.connected:
+                return self.logger.error("Opera closed connection. Reseting all others")
+            if keepalive_deadline is not None and time.time() > keepalive_deadline:
+                return self.logger.error("Opera didn't answer the KeepAlive in %d s" % MAX_TIME)
+            if self.keepalive_interval and keepalive_deadline is None and \
+                    time.time() - time_last_recv["downstream"] >= self.keepalive_interval:
+                if not self.keep_opera_alive():
+                    return
+                # Opera has as long to answer it as to send anything
+                keepalive_deadline = time.time() + MAX_TIME
             if time.time() - max(time_last_recv.values()) > MAX_TIME:
                 return self.logger.warn("The connections were innactive for too long. We are probably disconnected ...")
-            # rotate the CDR file
-            self.cdr.rotate()
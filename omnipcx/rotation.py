@@ -0,0 +1,178 @@
+import collections, glob, gzip, lzma, os, os.path, queue, re, shutil, threading, time
+from omnipcx.logging import Loggable
+
+# How archives are named
+ARCHIVE_HANDOFF = 'handoff'       # <file>.1, only when the collector took the previous one
+ARCHIVE_NUMBERED = 'numbered'     # <file>.1, <file>.2, ... the newest one has the highest number
+ARCHIVE_TIMESTAMP = 'timestamp'   # <file>.YYYYmmdd-HHMMSS
+ARCHIVES = [ARCHIVE_HANDOFF, ARCHIVE_NUMBERED, ARCHIVE_TIMESTAMP]
+
+COMPRESS_NONE = 'none'
+COMPRESSORS = {
+    'gzip': ('.gz', gzip.open),
+    'xz': ('.xz', lzma.open),
+}
+COMPRESSIONS = [COMPRESS_NONE] + sorted(COMPRESSORS.keys())
+
+DEFAULT_CHECK_INTERVAL = 1.0
+TIMESTAMP_FORMAT = '%Y%m%d-%H%M%S'
+
+
+class CDRRotator(Loggable):
+    """ Rotates the CDR file from its own thread, so that forwarding never
+        touches the file system for it.
+
+        In `handoff` mode the file is moved to <file>.1 as soon as the
+        collector took the previous <file>.1 away. In the other modes the
+        file is archived when it reaches `max_size` bytes or every `interval`
+        seconds. Archives are compressed and the ones above `keep` are removed
+        by a separate worker thread.
+    """
+    def __init__(self, writer, archive=ARCHIVE_HANDOFF, max_size=0, interval=0, compress=COMPRESS_NONE,
+            keep=0, check_interval=DEFAULT_CHECK_INTERVAL):
+        super(CDRRotator, self).__init__()
+        if archive not in ARCHIVES:
+            raise ValueError("Unknown archive naming '%s'" % archive)
+        if compress not in COMPRESSIONS:
+            raise ValueError("Unknown compression '%s'" % compress)
+        if archive == ARCHIVE_HANDOFF and (max_size or interval or keep or compress != COMPRESS_NONE):
+            raise ValueError("The handoff CDR file can't be compressed or rotated by size or time")
+        if archive != ARCHIVE_HANDOFF and not max_size and not interval:
+            raise ValueError("Rotating to %s archives needs a size or an interval" % archive)
+        self.writer = writer
+        self.filename = writer.filename
+        self.archive = archive
+        self.max_size = max_size
+        self.interval = interval
+        self.compress = compress
+        self.keep = keep
+        self.check_interval = check_interval
+        self.last_rotation = time.time()
+        self.archives = collections.deque(self.existing_archives())
+        self._sequence = self._last_sequence()
+        self._last_archive = self.archives[-1] if self.archives else ""
+        self._stop_event = threading.Event()
+        self._jobs = queue.Queue()
+        self._threads = []
+
+    @property
+    def handoff_file(self):
+        return self.filename + ".1"
+
+    def _suffix(self, path):
+        """ The part of an archive name between the CDR file name and the compression extension"""
+        suffix = path[len(self.filename) + 1:]
+        for extension, _ in COMPRESSORS.values():
+            if suffix.endswith(extension):
+                return suffix[:-len(extension)]
+        return suffix
+
+    def existing_archives(self):
+        """ Archives left by previous runs, oldest first, without compression extension"""
+        if self.archive == ARCHIVE_NUMBERED:
+            pattern, key = re.compile(r'^\d+$'), int
+        elif self.archive == ARCHIVE_TIMESTAMP:
+            pattern, key = re.compile(r'^\d{8}-\d{6}(-\d+)?$'), str
+        else:
+            return []
+        suffixes = set()
+        for path in glob.glob(glob.escape(self.filename) + ".*"):
+            suffix = self._suffix(path)
+            if pattern.match(suffix):
+                suffixes.add(suffix)
+        return ["%s.%s" % (self.filename, suffix) for suffix in sorted(suffixes, key=key)]
+
+    def _last_sequence(self):
+        if self.archive != ARCHIVE_NUMBERED or not self.archives:
+            return 0
+        return int(self._suffix(self.archives[-1]))
+
+    def next_archive(self):
+        if self.archive == ARCHIVE_HANDOFF:
+            return self.handoff_file
+        if self.archive == ARCHIVE_NUMBERED:
+            self._sequence += 1
+            return "%s.%d" % (self.filename, self._sequence)
+        name = "%s.%s" % (self.filename, time.strftime(TIMESTAMP_FORMAT))
+        target, count = name, 0
+        while target <= self._last_archive:
+            count += 1
+            target = "%s-%d" % (name, count)
+        self._last_archive = target
+        return target
+
+    def is_due(self):
+        if self.writer.size == 0:
+            return False
+        if self.archive == ARCHIVE_HANDOFF:
+            return not os.path.exists(self.handoff_file)
+        if self.max_size and self.writer.size >= self.max_size:
+            return True
+        return bool(self.interval) and time.time() - self.last_rotation >= self.interval
+
+    def rotate(self):
+        if not self.is_due():
+            if self.archive == ARCHIVE_HANDOFF and self.writer.size:
+                self.logger.debug("CDR collecter didn't gather CDRs. Not replacing CDR file yet")
+            elif self.interval and time.time() - self.last_rotation >= self.interval:
+                # Nothing was written during this interval, start a new one
+                self.last_rotation = time.time()
+            return
+        target = self.next_archive()
+        try:
+            self.writer.rotate(target)
+        except OSError as e:
+            self.logger.exception(("Cannot rename CDR temp file %s to CDR file %s: " % (self.filename, target)) + str(e))
+            return
+        self.logger.info("Moved CDR file to %s" % target)
+        self.last_rotation = time.time()
+        if self.archive != ARCHIVE_HANDOFF:
+            self._jobs.put(target)
+
+    def _rotate_loop(self):
+        while not self._stop_event.wait(self.check_interval):
+            self.rotate()
+
+    def _archive_loop(self):
+        while True:
+            path = self._jobs.get()
+            if path is None:
+                return
+            if self.compress != COMPRESS_NONE:
+                self.compress_file(path)
+            self.archives.append(path)
+            while self.keep and len(self.archives) > self.keep:
+                self.remove_archive(self.archives.popleft())
+
+    def compress_file(self, path):
+        extension, _open = COMPRESSORS[self.compress]
+        try:
+            with open(path, "rb") as src, _open(path + extension + ".tmp", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(path + extension + ".tmp", path + extension)
+            os.remove(path)
+        except OSError as e:
+            self.logger.error("Cannot compress CDR archive %s: %s" % (path, e))
+
+    def remove_archive(self, path):
+        for candidate in [path] + [path + extension for extension, _ in COMPRESSORS.values()]:
+            try:
+                os.remove(candidate)
+                self.logger.info("Removed old CDR archive %s" % candidate)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.error("Cannot remove old CDR archive %s: %s" % (candidate, e))
+
+    def start(self):
+        for target, name in [(self._rotate_loop, "cdr-rotate"), (self._archive_loop, "cdr-archive")]:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop_event.set()
+        self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
@@ -0,0 +1,192 @@
+""" Rules rewriting the frames of given types, or keeping them from the
+    other end (--rules, or `rules` in the site table). The rules file is an
+    INI file with a section per rule, applied in the order of the file:
+
+        [no-opera-keepalives]
+        from = opera
+        types = $
+        action = drop
+
+        [room-prefix]
+        from = opera
+        types = A B D
+        offset = 1
+        match = 12
+        value = 45
+
+        [cdrs-to-the-collector-only]
+        from = pbx
+        types = J
+        action = drop
+
+    `from` is the leg sending the frames: pbx, opera or any (the default).
+    `types` are the type bytes of the frames, the first byte of the
+    payload. With `value`, the bytes at `offset` of the payload (the type
+    byte is at offset 0) are overwritten with it, if they are `match` (or
+    always, without `match`), and the checksum is recomputed. Put a value
+    between double quotes to keep its spaces.
+
+    The `forward` action (the default) forwards the frames, `drop` doesn't:
+    the proxy answers the sender with `answer` (ack, the default, nack or
+    none) instead of the other end. The CDRs of the PBX still go to the
+    collector. Replies aren't dropped, the other end waits for them; only
+    their fields are rewritten.
+
+    The rules are compiled at startup into a table per leg, keyed by the
+    message classes of the type bytes (the ones of
+    MessageDetector.proto_classes): the rules of a frame are one dict lookup
+    away, and a frame without rules costs that lookup only. The rules of
+    --default-password and --local-keepalive come first.
+"""
+import collections, configparser
+from omnipcx.messages import crc
+from omnipcx.messages.control import ACK, NACK
+from omnipcx.messages.protocol import CLASSES, CheckInBase
+
+# Legs the rules apply to
+PBX = 'pbx'
+OPERA = 'opera'
+ANY = 'any'
+LEGS = {PBX: (PBX,), OPERA: (OPERA,), ANY: (PBX, OPERA)}
+
+ACTION_FORWARD = 'forward'
+ACTION_DROP = 'drop'
+ACTIONS = [ACTION_FORWARD, ACTION_DROP]
+ANSWERS = {'ack': ACK, 'nack': NACK, 'none': None}
+
+KEYS = {'from', 'types', 'action', 'answer', 'offset', 'match', 'value'}
+
+# The rules of the frames sent by the PBX and by Opera, by message class
+Rules = collections.namedtuple('Rules', ['pbx', 'opera'])
+
+
+class Rule(object):
+    """ What happens to the frames of a message class"""
+    __slots__ = ('forward', 'answer', 'rewrites', 'size', 'has_crc')
+
+    def __init__(self, message_class):
+        self.forward = True
+        self.answer = None
+        self.rewrites = ()          # (offset, match or None, value, end of both), in order
+        self.size = message_class.get_size() - 2
+        self.has_crc = message_class.has_crc()
+
+    def add_rewrite(self, name, message_class, offset, match, value):
+        end = self.size - (2 if self.has_crc else 0)
+        stop = offset + max(len(value), len(match or b""))
+        if offset < 0 or stop > end:
+            raise ValueError("Rule '%s' writes past the %d bytes of the %s payload"
+                % (name, end, message_class.__name__))
+        self.rewrites += ((offset, match, value, stop),)
+
+    def rewrite(self, message):
+        """ Overwrites the fields of the message, and its checksum once.
+            The fields past the end of a frame shorter than usual are left
+            alone.
+        """
+        if not self.rewrites:
+            return
+        payload = message.payload
+        end = len(payload) - (2 if self.has_crc else 0)
+        data = bytearray(payload)
+        for offset, match, value, stop in self.rewrites:
+            if stop > end:
+                continue
+            if match is None or data[offset:offset + len(match)] == match:
+                data[offset:offset + len(value)] = value
+        if data != payload:
+            if self.has_crc:
+                data[-2:] = crc.crc(data[:-2])
+            message.payload = data
+
+
+def _bytes(value):
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        value = value[1:-1]
+    return value.encode('ascii')
+
+
+def _classes(name, type_byte):
+    classes = [cls for cls in CLASSES if cls.get_type() == type_byte]
+    if not classes:
+        raise ValueError("Rule '%s' has the unknown message type '%s'" % (name, type_byte.decode('ascii', 'replace')))
+    return classes
+
+
+def _rule(table, message_class):
+    rule = table.get(message_class, None)
+    if rule is None:
+        rule = table[message_class] = Rule(message_class)
+    return rule
+
+
+def compile_rules(sections, default_password=None, local_keepalive=False):
+    """ Compiles the (name, options) rules, after the ones of the default
+        password and of `local_keepalive`, into Rules. Raises ValueError if
+        a rule isn't valid.
+    """
+    tables = Rules({}, {})
+    if local_keepalive:
+        # The proxy acknowledges the link maintenance frames of the PBX itself
+        sections = [('local-keepalive', {'from': PBX, 'types': '$ @', 'action': ACTION_DROP})] + list(sections)
+    if default_password:
+        password = default_password.encode('ascii')
+        for cls in CLASSES:
+            # A blank password of Opera is replaced
+            if issubclass(cls, CheckInBase) and len(password) <= cls.PASSWORD_LEN:
+                _rule(tables.opera, cls).add_rewrite('default-password', cls, cls.PASSWORD_OFFSET,
+                    b" " * cls.PASSWORD_LEN, password.rjust(cls.PASSWORD_LEN))
+    for name, options in sections:
+        unknown = set(options) - KEYS
+        if unknown:
+            raise ValueError("Unknown key '%s' for rule '%s'" % (sorted(unknown)[0], name))
+        leg = options.get('from', ANY)
+        action = options.get('action', ACTION_FORWARD)
+        answer = options.get('answer', 'ack')
+        if leg not in LEGS:
+            raise ValueError("Rule '%s' needs 'from' to be one of %s" % (name, ", ".join(sorted(LEGS))))
+        if action not in ACTIONS:
+            raise ValueError("Rule '%s' needs 'action' to be one of %s" % (name, ", ".join(ACTIONS)))
+        if answer not in ANSWERS:
+            raise ValueError("Rule '%s' needs 'answer' to be one of %s" % (name, ", ".join(sorted(ANSWERS))))
+        types = options.get('types', '').split()
+        if not types or any(len(_type) != 1 for _type in types):
+            raise ValueError("Rule '%s' needs 'types', type bytes separated by spaces" % name)
+        value = options.get('value', None)
+        match = options.get('match', None)
+        if value is None and (match is not None or 'offset' in options):
+            raise ValueError("Rule '%s' has 'offset' or 'match' but no 'value'" % name)
+        if value is None and action == ACTION_FORWARD:
+            raise ValueError("Rule '%s' neither rewrites nor drops" % name)
+        if value is not None:
+            try:
+                offset = int(options.get('offset', ''))
+            except ValueError:
+                raise ValueError("Rule '%s' needs 'offset', the offset of 'value' in the payload" % name)
+        for _type in types:
+            for cls in _classes(name, _type.encode('ascii')):
+                for side in LEGS[leg]:
+                    rule = _rule(getattr(tables, side), cls)
+                    if value is not None:
+                        rule.add_rewrite(name, cls, offset, None if match is None else _bytes(match), _bytes(value))
+                    if action == ACTION_DROP:
+                        rule.forward = False
+                        rule.answer = ANSWERS[answer]
+    return tables
+
+
+def load(filename, default_password=None, local_keepalive=False):
+    """ The Rules of a rules file (or of the default password and the local
+        keepalives alone without one). Raises ValueError if the file or a
+        rule isn't valid.
+    """
+    if not filename:
+        return compile_rules([], default_password, local_keepalive)
+    config = configparser.ConfigParser(interpolation=None)
+    try:
+        if not config.read(filename):
+            raise ValueError("Cannot read rules file '%s'" % filename)
+    except configparser.Error as e:
+        raise ValueError("Invalid rules file '%s': %s" % (filename, e))
+    return compile_rules([(name, dict(config[name])) for name in config.sections()], default_password,
+        local_keepalive)
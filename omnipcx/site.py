@@ -0,0 +1,280 @@
+import argparse, configparser, os, threading, traceback
+from omnipcx.logging import Loggable
+from omnipcx.proxy import Proxy
+from omnipcx.streams import SEND_TIMEOUT, CDRStream, ClientStream, ServerStream
+from omnipcx.cdr_buffer import CDRBuffer
+from omnipcx.cdr_dedup import CDRDedup
+from omnipcx.messages import crc
+from omnipcx import metrics
+from omnipcx.capture import CaptureWriter, PBX, HOTEL, CDR
+from omnipcx.cdr_fanout import fanout_from_args, parse_sinks
+from omnipcx.upstream import Upstreams
+from omnipcx.handoff import SiteState
+from omnipcx.cdr_store import CDRStoreWriter
+
+DEFAULT_LISTEN_TIMEOUT = 5.0
+DEFAULT_RETRIES = 5
+
+# Site table keys, with the argument they override and the type of their values
+SITE_KEYS = {
+    'old_address': ('old_address', str),
+    'old_port': ('old_port', int),
+    'opera_port': ('opera_port', int),
+    'cdr_address': ('cdr_address', str),
+    'cdr_port': ('cdr_port', int),
+    'cdr_file': ('cdr_file_name', str),
+    'cdr_sink': ('cdr_sinks', parse_sinks),
+    'buffer_file': ('buffer_db_file', str),
+    'default_password': ('default_password', str),
+    'capture_file': ('capture_file', str),
+    'cdr_store': ('cdr_store', str),
+    'rules': ('rules_file', str),
+    'local_keepalive': ('local_keepalive', float),
+}
+
+
+def load_site_table(filename, defaults):
+    """ Reads the site table. Every section of the INI file is a site, e.g.:
+
+        [hotel-a]
+        old_address = 10.0.0.10
+        opera_port = 2561
+        cdr_address = 10.0.0.20
+        buffer_file = hotel-a.db
+
+        Missing keys are taken from the [DEFAULT] section, then from the
+        command line arguments. Returns a list of (name, args) tuples.
+    """
+    config = configparser.ConfigParser()
+    if not config.read(filename):
+        raise ValueError("Cannot read site table '%s'" % filename)
+    sites = []
+    for name in config.sections():
+        args = argparse.Namespace(**vars(defaults))
+        if args.capture_file:
+            # The sites can't share the capture file given on the command line
+            args.capture_file = "%s.%s" % (args.capture_file, name)
+        section = config[name]
+        for key, value in section.items():
+            if key not in SITE_KEYS:
+                raise ValueError("Unknown key '%s' for site '%s'" % (key, name))
+            dest, _type = SITE_KEYS[key]
+            setattr(args, dest, _type(value))
+        if not args.old_address:
+            raise ValueError("Site '%s' has no old_address" % name)
+        if not args.cdr_sinks and not args.cdr_file_name and (not args.cdr_port or not args.cdr_address):
+            raise ValueError("Site '%s' needs either cdr_sink, cdr_file or both cdr_address and cdr_port" % name)
+        sites.append((name, args))
+    ports = [args.opera_port for _, args in sites]
+    if len(set(ports)) != len(ports):
+        raise ValueError("Every site needs its own Opera port")
+    buffers = [args.buffer_db_file for _, args in sites]
+    if len(set(buffers)) != len(buffers):
+        raise ValueError("Every site needs its own CDR buffer file")
+    captures = [args.capture_file for _, args in sites if args.capture_file]
+    if len(set(captures)) != len(captures):
+        raise ValueError("Every site needs its own capture file")
+    stores = [args.cdr_store for _, args in sites if args.cdr_store]
+    if len(set(stores)) != len(stores):
+        raise ValueError("Every site needs its own CDR store")
+    return sites
+
+
+def cdr_stream_from_args(args, site='default'):
+    stream = CDRStream(args.cdr_address, args.cdr_port, args.cdr_file_name, ipv6=args.ipv6,
+        flush_records=args.cdr_flush_records, flush_interval=args.cdr_flush_interval / 1000.0,
+        durability=args.cdr_durability, site=site)
+    stream.start_rotation(archive=args.cdr_archive, max_size=args.cdr_rotate_size,
+        interval=args.cdr_rotate_interval, compress=args.cdr_compress, keep=args.cdr_keep)
+    return stream
+
+
+def cdr_leg_from_args(args, site='default'):
+    """ The CDR fan-out if CDR sinks are given, the CDR stream otherwise"""
+    if args.cdr_sinks:
+        return fanout_from_args(args, site)
+    return cdr_stream_from_args(args, site)
+
+
+class Site(Loggable):
+    """ One PBX / Opera / CDR collector triplet, with its own CDR buffer"""
+    def __init__(self, name, args, inherited=None, rules=None):
+        super(Site, self).__init__()
+        self.name = name
+        self.args = args
+        # Compiled omnipcx.rules.Rules, the default password only without them
+        self.rules = rules
+        self.stop_event = threading.Event()
+        self.stopped = threading.Event()
+        # SiteState handed over by the previous process, and to the next one
+        self.inherited = inherited
+        self.handoff = None
+        self.engine = None
+        self.cdr_buffer = CDRBuffer(file=args.buffer_db_file,
+            verify_crc=args.crc_policy in (crc.POLICY_REJECT, crc.POLICY_NACK))
+        if args.cdr_dedup_size:
+            self.cdr_buffer.dedup = CDRDedup(args.cdr_dedup_size, args.cdr_dedup_window, name)
+        self.cdr_buffer.load()
+        metrics.BUFFER_DEPTH.labels(name).set_function(self.cdr_buffer.__len__)
+        self.capture = CaptureWriter(args.capture_file) if args.capture_file else None
+        self.cdr_store = CDRStoreWriter(args.cdr_store) if args.cdr_store else None
+
+    def stop(self):
+        self.stop_event.set()
+
+    def hand_off(self):
+        """ Stops the site at a frame boundary and returns the SiteState to
+            hand over to the next process
+        """
+        state = SiteState(self.name)
+        if self.engine is not None:
+            return self.engine.hand_off_threadsafe(state)
+        self.handoff = state
+        self.stop_event.set()
+        self.stopped.wait()
+        return state
+
+    def socket_tuples(self):
+        inherited = self.inherited or SiteState(self.name)
+        opera_listener = ServerStream(self.args.opera_port, listen_timeout=DEFAULT_LISTEN_TIMEOUT, ipv6=self.args.ipv6,
+            sock=inherited.socket('listener'))
+        cdr_stream = cdr_leg_from_args(self.args, self.name)
+        old_stream = ClientStream(self.args.old_address, self.args.old_port, ipv6=self.args.ipv6)
+        if self.capture is not None:
+            old_stream.capture = self.capture.leg(PBX)
+            cdr_stream.capture = self.capture.leg(CDR)
+        cdr_stream.store = self.cdr_store
+        upstreams = Upstreams(self.name, self.args, old_stream, cdr_stream, self.cdr_buffer, DEFAULT_RETRIES)
+        upstreams.take_over(inherited)
+        inherited_opera = None
+        skt = inherited.socket('opera')
+        if skt is not None:
+            inherited_opera = ServerStream.SocketWrapper(skt, opera_listener.timeout)
+            inherited_opera.unread = inherited.unread('opera')
+        inherited.close()
+        # The frames received for the session that was going on are its own
+        upstreams.start(session=inherited_opera is not None)
+        try:
+            for opera_stream in self._opera_streams(opera_listener, inherited_opera):
+                if not upstreams.acquire():
+                    opera_stream.close()
+                    continue
+                yield upstreams, opera_stream
+                if self.stop_event.is_set():
+                    break
+        finally:
+            if self.handoff is not None:
+                if opera_listener.listening:
+                    self.handoff.add('listener', os.dup(opera_listener.fileno()))
+                upstreams.hand_off(self.handoff)
+            upstreams.stop()
+
+    def _opera_streams(self, opera_listener, inherited_opera=None):
+        if inherited_opera is not None:
+            metrics.connection(self.name, 'opera', True)
+            yield inherited_opera
+        for opera_stream in opera_listener.listen():
+            if self.stop_event.is_set():
+                if opera_stream is not None:
+                    if self.handoff is not None:
+                        self.handoff.add('opera', os.dup(opera_stream.fileno()))
+                    opera_stream.close()
+                return
+            if opera_stream is None:
+                # This was a timeout, check if we need to stop and continue
+                continue
+            metrics.connection(self.name, 'opera', True)
+            yield opera_stream
+
+    def run(self):
+        try:
+            for upstreams, opera_stream in self.socket_tuples():
+                self.logger.info("Received Opera connection. Starting proxy operation")
+                if self.capture is not None:
+                    self.capture.session()
+                    opera_stream.capture = self.capture.leg(HOTEL)
+                proxy = Proxy(upstreams.old, opera_stream, upstreams.cdr, self.args.default_password, self.cdr_buffer,
+                    stop_event=self.stop_event, site=self.name, pbx_detector=upstreams.detector, rules=self.rules,
+                    keepalive_interval=self.args.local_keepalive)
+                proxy.downstream.restore(opera_stream.unread)
+                try:
+                    proxy.run()
+                except KeyboardInterrupt:
+                    self.logger.warn("Stopped by Ctrl+C / Ctrl+Break")
+                    break
+                except Exception:
+                    self.logger.exception("Caught an exception in the main loop of the proxy")
+                    traceback.print_exc()
+                finally:
+                    # The OLD and CDR connections stay open for the next session
+                    if self.handoff is not None and opera_stream.connected:
+                        opera_stream.flush(SEND_TIMEOUT)
+                        self.handoff.add('opera', os.dup(opera_stream.fileno()), proxy.downstream.unread())
+                    if opera_stream.connected:
+                        opera_stream.close()
+                    upstreams.release(cdr_failed=proxy.replayer.failed)
+                    if self.capture is not None:
+                        self.capture.flush()
+        finally:
+            self.close()
+            self.stopped.set()
+
+    def close(self):
+        self.cdr_buffer.save()
+        if self.capture is not None:
+            self.capture.close()
+        if self.cdr_store is not None:
+            self.cdr_store.close()
+
+    def async_engine(self):
+        from omnipcx.async_proxy import AsyncEngine
+        self.engine = AsyncEngine(self.name, self.args, self.cdr_buffer, DEFAULT_RETRIES, self.capture, self.inherited,
+            self.cdr_store, self.rules)
+        return self.engine
+
+
+class MultiSite(Loggable):
+    """ Serves many sites from one process. Every site runs its sessions on
+        its own thread (or its own tasks with the asyncio engine), so a slow
+        or dead site doesn't stall the others.
+    """
+    def __init__(self, sites, engine):
+        super(MultiSite, self).__init__()
+        self.sites = sites
+        self.engine = engine
+
+    def run(self):
+        if self.engine == 'asyncio':
+            return self.run_async()
+        threads = []
+        for site in self.sites:
+            thread = threading.Thread(target=site.run, name=site.name, daemon=True)
+            thread.start()
+            threads.append(thread)
+        self.logger.info("Serving %d sites" % len(threads))
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(DEFAULT_LISTEN_TIMEOUT)
+        except KeyboardInterrupt:
+            self.logger.warn("Stopped by Ctrl+C / Ctrl+Break")
+            for site in self.sites:
+                site.stop()
+            for thread in threads:
+                thread.join()
+
+    def run_async(self):
+        import asyncio
+        engines = [site.async_engine() for site in self.sites]
+
+        async def serve_all():
+            await asyncio.gather(*[engine.serve() for engine in engines])
+
+        self.logger.info("Serving %d sites" % len(engines))
+        try:
+            asyncio.run(serve_all())
+        except KeyboardInterrupt:
+            self.logger.warn("Stopped by Ctrl+C / Ctrl+Break")
+        finally:
+            for site in self.sites:
+                site.close()
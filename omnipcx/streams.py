@@ -1,13 +1,169 @@
-import socket, signal, os.path, os, errno
+import collections, itertools, socket, select, signal, os.path, os, errno, time
 from omnipcx.logging import Loggable
+from omnipcx.messages.control import XON, XOFF
+from omnipcx.cdr_writer import CDRFileWriter, DURABILITY_FLUSH
+from omnipcx.rotation import CDRRotator
+from omnipcx.metrics import CDRMetrics, DEFAULT_SINK
+from omnipcx import connector
 
+RECV_SIZE = 4096
+# Bytes queued for a peer that reads slowly before send() waits for it, and
+# how many may still be queued when it stops waiting
+HIGH_WATERMARK = 64 * 1024
+LOW_WATERMARK = 16 * 1024
+# Seconds send() waits for a peer that doesn't read anymore
+SEND_TIMEOUT = 5.0
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+# Windows has no sendmsg()
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class OutboundQueue(object):
+    """ The frames waiting to be written to a non-blocking socket.
+
+        write() hands all of them to the socket with one sendmsg() (writev)
+        call, and keeps what the socket didn't take, down to the end of a
+        frame cut in the middle, for the next one. The producer waits in
+        drain() once more than `high` bytes are queued, until the peer read
+        them down to `low`.
+    """
+    def __init__(self, skt, high=HIGH_WATERMARK, low=LOW_WATERMARK):
+        self._socket = skt
+        self._frames = collections.deque()
+        self.high = high
+        self.low = low
+        self.size = 0
+
+    def push(self, data):
+        self._frames.append(data)
+        self.size += len(data)
+
+    def clear(self):
+        """ Drops the queued frames"""
+        self._frames.clear()
+        self.size = 0
+
+    def write(self):
+        """ Writes what the socket takes without blocking. Raises OSError if
+            the connection is broken.
+        """
+        while self._frames:
+            try:
+                if HAS_SENDMSG:
+                    sent = self._socket.sendmsg(itertools.islice(self._frames, IOV_MAX))
+                else:
+                    sent = self._socket.send(b"".join(itertools.islice(self._frames, IOV_MAX)))
+            except (BlockingIOError, InterruptedError):
+                return
+            self.size -= sent
+            while sent:
+                frame = self._frames[0]
+                if sent < len(frame):
+                    self._frames[0] = memoryview(frame)[sent:]
+                    break
+                self._frames.popleft()
+                sent -= len(frame)
+
+    def drain(self, low=0, timeout=SEND_TIMEOUT):
+        """ Waits until at most `low` bytes are queued. Raises socket.timeout
+            if the peer didn't read them in time, OSError if the connection
+            is broken.
+        """
+        deadline = time.monotonic() + timeout
+        self.write()
+        while self.size > low:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([], [self._socket], [], remaining)[1]:
+                raise socket.timeout("%d bytes not read by the peer in %.1f s" % (self.size, timeout))
+            self.write()
+
+
+class OutboundStream(Loggable):
+    """ Sending side of the streams of the poll engine, through an
+        OutboundQueue. Their sockets are non-blocking: send() doesn't wait
+        for the peer unless it lets more than HIGH_WATERMARK bytes pile up,
+        and recv() waits `timeout` for data itself. The CDR stream waits
+        until the collector took the CDRs, since they are acknowledged
+        after that.
+    """
+    __slots__ = ()
+    # no queue before the first connection
+    _output = None
+
+    def _use(self, skt):
+        skt.setblocking(False)
+        self._socket = skt
+        self._output = OutboundQueue(skt)
+
+    @property
+    def output_pending(self):
+        """ Queued bytes the socket didn't take yet"""
+        return self._output.size if self._output is not None else 0
+
+    def send(self, message, flush=True):
+        """ Queues the message and, with `flush`, writes what the socket
+            takes. Without it, the message goes out with the next write.
+        """
+        if not self._connected:
+            self.logger.error("Cannot send to a closed socket")
+            return False
+        data = message.serialize()
+        try:
+            self._output.push(data)
+            if self._output.size > self._output.high:
+                self._output.drain(self._output.low)
+            elif flush:
+                self._output.write()
+        except socket.timeout:
+            self.logger.error("Remote end doesn't read what we send anymore")
+            return False
+        except OSError:
+            self.logger.error("Remote end closed connection")
+            return False
+        if self.capture is not None:
+            self.capture.sent(data)
+        return True
+
+    def flush(self, timeout=0):
+        """ Writes the queued messages, waiting up to `timeout` for the peer
+            to take them. Returns False if some are left.
+        """
+        if not self._connected:
+            return False
+        try:
+            if timeout:
+                self._output.drain(0, timeout)
+            else:
+                self._output.write()
+        except OSError:
+            return False
+        return not self._output.size
+
+    def _wait_readable(self):
+        """ Waits `timeout` for data to read, writing the queued messages
+            meanwhile
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            writers = [self._socket] if self._output.size else []
+            readable, writable, _ = select.select([self._socket], writers, [], max(deadline - time.monotonic(), 0))
+            if writable:
+                self.flush()
+            if readable or not writable:
+                return bool(readable)
+
+
+class ClientStream(OutboundStream):
+    capture = None
 
-class ClientStream(Loggable):
     def __init__(self, address, port, timeout=0.5, ipv6=False):
         super(ClientStream, self).__init__()
         self.port = port
         self.address = address
-        self.ipv6 = socket.AF_INET6 if ipv6 else socket.AF_INET
+        self.ipv6 = ipv6
         self.timeout = timeout
         self._connected = False
 
@@ -19,55 +175,74 @@ class ClientStream(Loggable):
         if self._connected:
             self.logger.warn("Stream is already connected")
             return self._connected
-        try:
-            skt = socket.socket(self.ipv6, socket.SOCK_STREAM)
-            skt.settimeout(self.timeout)
-            self.logger.info("Trying to open a connection to %s:%s" %(self.address, self.port))
-            skt.connect((self.address, self.port),)
-            self._socket = skt
-            self._connected = True
-        except (socket.timeout, ConnectionRefusedError) as e:
+        self.logger.info("Trying to open a connection to %s:%s" %(self.address, self.port))
+        skt = connector.connect(self.address, self.port, prefer_ipv6=self.ipv6)
+        if skt is None:
             self._socket = None
             self._connected = False
+        else:
+            self._use(skt)
+            self._connected = True
         return self._connected
 
-    def send(self, message):
-        if not self._connected:
-            self.logger.error("Cannot send to a closed socket")
-            return
-        try:
-            self._socket.send(message.serialize())
-            return True
-        except BrokenPipeError:
-            self.logger.error("Remote end closed connection")
-            return False
+    def adopt(self, skt):
+        """ Uses a connection opened by the process that handed it over"""
+        self._use(skt)
+        self._connected = True
+
+    def fileno(self):
+        return self._socket.fileno()
 
     def recv(self, size):
         if not self._connected:
             self.logger.error("Cannot recv from a closed socket")
             return
         try:
-            return self._socket.recv(size)
-        except socket.timeout:
+            if not self._wait_readable():
+                return b""
+            data = self._socket.recv(size)
+        except (BlockingIOError, InterruptedError):
             return b""
+        if not data:
+            self.logger.error("Remote end closed connection")
+            self.close()
+        return data
 
     def close(self):
         if not self._connected:
             self.logger.warn("Trying to close a closed socket")
             return
+        # what the peer didn't read yet goes out before the FIN
+        self.flush(self.timeout)
         self._connected = False
         self._socket.close()
 
+    def abort(self):
+        """ Closes the connection without writing what the peer didn't take
+            yet, when it is going to be sent again over the next one
+        """
+        if self._connected:
+            self._output.clear()
+            self.close()
+
 
 class CDRStream(ClientStream):
-    def __init__(self, address, port, filename=None, timeout=0.5, ipv6=False):
+    def __init__(self, address, port, filename=None, timeout=0.5, ipv6=False,
+            flush_records=1, flush_interval=0.0, durability=DURABILITY_FLUSH, site='default', sink=DEFAULT_SINK):
         super(CDRStream, self).__init__(address, port, timeout, ipv6)
+        self.metrics = CDRMetrics(site, sink)
         self._filename = filename
+        self._writer = None
+        self._rotator = None
+        self._paused = False
+        # Gets the CDRs that were sent (see omnipcx.cdr_store)
+        self.store = None
         if self.file_mode:
             self._connected = True
             was_present = self.create_dir_for_file(self._filename)
             if not was_present:
                 self.logger.warn("Created folder for CDR file")
+            self._writer = CDRFileWriter(self.temp_file, flush_records, flush_interval, durability)
         else:
             if address is None or port is None:
                 raise Exception("You need to specify an address and a port")
@@ -78,25 +253,27 @@ class CDRStream(ClientStream):
         return self._filename is not None
 
     @property
-    def temp_file(self):
-        return self._filename
+    def has_socket(self):
+        """ The stream has a connection of its own to the collector"""
+        return self._filename is None
 
     @property
-    def cdr_file(self):
-        return self._filename + ".1"
+    def temp_file(self):
+        return self._filename
 
     def connect(self):
-        if self.cdr_file:
+        if self.file_mode:
             return True
-        else:
-            return super(CDRStream, self).connect()
+        self._paused = False
+        return super(CDRStream, self).connect()
+
+    def adopt(self, skt, paused=False):
+        self._paused = paused
+        super(CDRStream, self).adopt(skt)
 
     def recv(self):
         self.logger.warn("Cannot read from a CDR socket")
-        if self.cdr_file:
-            return b""
-        else:
-            return super(CDRStream, self).recv()
+        return b""
 
     def create_dir_for_file(self, filename):
         directory = os.path.abspath(os.path.dirname(filename))
@@ -112,15 +289,28 @@ class CDRStream(ClientStream):
                 return False
 
     def send(self, message):
+        return self.send_many([message])
+
+    def send_many(self, messages):
+        """ Sends many CDRs with a single write"""
+        started = time.monotonic()
+        ok = self._send_many(messages)
+        self.metrics.done(started, len(messages), ok)
+        if ok and self.store is not None:
+            self.store.add_many(messages)
+        return ok
+
+    def _send_many(self, messages):
         if not self._connected:
             self.logger.error("Cannot send to a closed socket")
             return
+        data = b"".join(message.serialize_cdr() for message in messages)
         if self.file_mode:
             # File case
             try:
-                with open(self.temp_file, "a+") as f:
-                    # TODO: should it be ASCII?
-                    f.write(message.serialize_cdr().decode("utf-8", "strict"))
+                self._writer.write(data, len(messages))
+                if self.capture is not None:
+                    self.capture.sent(data)
                 return True
             except PermissionError:
                 self.logger.error("Failed writing CDR to file '%s': permission denied" % self.temp_file)
@@ -129,68 +319,129 @@ class CDRStream(ClientStream):
                 self.logger.exception("Failed writing CDR to file: " + str(e))
                 return False
         else:
-            # Network case
+            # Network case. The CDRs are acknowledged once we return, so
+            # they have to be out of our queue by then.
             try:
-                self._socket.send(message.serialize_cdr())
+                self._output.push(data)
+                self._output.drain(0, self.timeout)
+                if self.capture is not None:
+                    self.capture.sent(data)
                 return True
+            except socket.timeout:
+                self.logger.error("CDR collector doesn't read what we send anymore")
             except BrokenPipeError:
                 self.logger.error("Remote end closed connection")
-                return False
             except:
                 self.logger.exception("Failed sending CDR to collector")
+            # They go again from the buffer over the next connection, what
+            # is left of them mustn't follow
+            self.abort()
+            return False
+
+    @property
+    def paused(self):
+        """ The collector asked us to stop sending with XOFF"""
+        return self._paused
+
+    def poll_flow(self, timeout=0):
+        """ Reads the XON/XOFF flow control characters sent by the collector,
+            and writes what is left queued for it
+        """
+        if self.file_mode or not self._connected:
+            return
+        try:
+            while select.select([self._socket], [], [], timeout)[0]:
+                data = self._socket.recv(RECV_SIZE)
+                if not data:
+                    self.logger.error("CDR collector closed connection")
+                    return self.close()
+                if self.capture is not None:
+                    self.capture.received(data)
+                xon = data.rfind(XON.get_type())
+                xoff = data.rfind(XOFF.get_type())
+                if xon >= 0 or xoff >= 0:
+                    self._paused = xoff > xon
+                    self.logger.info("CDR collector %s the flow" % ("paused" if self._paused else "resumed"))
+                timeout = 0
+        except (OSError, ValueError):
+            return
+
+    def wait_flow(self, stop_event=None, timeout=0.5):
+        """ Blocks while the collector paused the flow. Returns False if it was stopped"""
+        self.poll_flow()
+        while self._paused and self._connected:
+            if stop_event is not None and stop_event.is_set():
                 return False
+            self.poll_flow(timeout)
+        return True
 
     def close(self):
         if not self.file_mode:
             super(CDRStream, self).close()
+        else:
+            # The file stays open between sessions, just commit what we have
+            self._writer.commit()
 
+    def shutdown(self):
+        """ Closes the CDR file for good"""
+        if self._rotator is not None:
+            self._rotator.stop()
+        if self.file_mode:
+            self._writer.close()
 
-    def rotate(self):
-        if not self.file_mode:
-            return
-        try:
-            can_replace = not os.path.isfile(self.cdr_file) and os.path.isfile(self.temp_file)
-            if can_replace:
-                self.logger.info("Moving CDR file to its place")
-                os.replace(self.temp_file, self.cdr_file)
-            else:
-                self.logger.debug("CDR collecter didn't gather CDRs. Not replacing CDR file yet")
-        except PermissionError as e:
-            self.logger.exception(("Cannot rename CDR temp file %s to CDR file %s: " % (self.temp_file, self.cdr_file) )+ str(e))
-            raise e
+    def start_rotation(self, **options):
+        """ Rotates the CDR file from a background thread. See CDRRotator for the options"""
+        if self.file_mode:
+            self._rotator = CDRRotator(self._writer, **options)
+            self._rotator.start()
 
 
 class ServerStream(Loggable):
-    class SocketWrapper(Loggable):
-        def __init__(self, skt):
+    class SocketWrapper(OutboundStream):
+        capture = None
+        # received by the process that handed the connection over, not handled yet
+        unread = b""
+
+        def __init__(self, skt, timeout=0.5):
             super(ServerStream.SocketWrapper, self).__init__()
             self._connected = True
-            self._socket = skt
+            self.timeout = timeout
+            self._use(skt)
 
-        def send(self, message):
-            try:
-                self._socket.send(message.serialize())
-                return True
-            except BrokenPipeError:
-                self.logger.error("Remote end closed connection")
-                return False
+        @property
+        def connected(self):
+            return self._connected
+
+        def fileno(self):
+            return self._socket.fileno()
 
         def recv(self, size):
+            if not self._connected:
+                return b""
             try:
-                return self._socket.recv(size)
-            except socket.timeout:
+                if not self._wait_readable():
+                    return b""
+                data = self._socket.recv(size)
+            except (BlockingIOError, InterruptedError):
                 return b""
+            if not data:
+                self.logger.error("Remote end closed connection")
+                self.close()
+            return data
 
         def close(self):
             if not self._connected:
                 self.logger.warn("Trying to close a closed socket")
                 return
+            self.flush(self.timeout)
             self._connected = False
             self._socket.close()
 
-    def __init__(self, port, listen_timeout=5, timeout=0.5, ipv6=False, parallel_num=10):
+    def __init__(self, port, listen_timeout=5, timeout=0.5, ipv6=False, parallel_num=10, sock=None):
         super(ServerStream, self).__init__()
         self.port = port
+        # listening socket handed over by the previous process
+        self._server = sock
         self.ipv6 = socket.AF_INET6 if ipv6 else socket.AF_INET
         self.timeout = timeout
         self.listen_timeout = listen_timeout
@@ -201,17 +452,24 @@ class ServerStream(Loggable):
     def listening(self):
         return self._listening
 
+    def fileno(self):
+        return self._server.fileno()
+
     def listen(self):
         bind_fail = False
+        address = "" # socket.gethostname()
+        self.show_waiting_message = True
         try:
-            server = socket.socket(self.ipv6, socket.SOCK_STREAM)
-            address = "" # socket.gethostname()
-            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self._server is not None:
+                server = self._server
+            else:
+                server = socket.socket(self.ipv6, socket.SOCK_STREAM)
+                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                server.bind((address, self.port))
+                server.listen(self.parallel_num)
             server.settimeout(self.listen_timeout)
-            self.show_waiting_message = True
-            server.bind((address, self.port))
+            self._server = server
             self._listening = True
-            server.listen(self.parallel_num)
         except OSError:
             bind_fail = True
         except Exception:
@@ -227,8 +485,7 @@ class ServerStream(Loggable):
                 self.waiting_message = False
             try:
                 skt, address = server.accept()
-                skt.settimeout(self.timeout)
-                yield ServerStream.SocketWrapper(skt)
+                yield ServerStream.SocketWrapper(skt, self.timeout)
                 self.show_waiting_message = True
             except KeyboardInterrupt:
                 self.logger.warn("Stopped by Control+C")
@@ -0,0 +1,363 @@
+""" OLD and CDR connections kept open across the Opera sessions, so that a
+    reconnecting Opera doesn't make the PBX link flap.
+"""
+import os, select, socket, threading, time
+from omnipcx.logging import Loggable
+from omnipcx.messages import MessageDetector
+from omnipcx.messages.base import ControlMessage
+from omnipcx.messages.control import ACK, NACK
+from omnipcx.messages.protocol import SMDR, KeepAlive, TCPConnection
+from omnipcx.cdr_replay import CDRReplayer
+from omnipcx.streams import SEND_TIMEOUT
+from omnipcx import connector, metrics
+
+DEFAULT_HEALTH_CHECK_INTERVAL = 30.0
+# Seconds the PBX has to acknowledge a KeepAlive before we reconnect
+HEALTH_CHECK_TIMEOUT = 5.0
+KEEPALIVE_FRAME = b"\x02$FFFF\x03"
+
+
+def keepalive():
+    return KeepAlive(KEEPALIVE_FRAME)
+
+
+def answer_idle(message, replayer, buf, logger):
+    """ Handles a message the PBX sent while no Opera is connected. Returns
+        the answer to send back to the PBX, or None.
+
+        CDRs go to the collector (or the buffer) and are acknowledged like
+        during a session (the ones the PBX sent twice are only acknowledged),
+        KeepAlives are acknowledged, and the frames meant for Opera are
+        refused so that the PBX sends them again later.
+    """
+    if isinstance(message, ControlMessage):
+        return None
+    if isinstance(message, SMDR):
+        if replayer is not None:
+            if not replayer.deliver(message):
+                buf.put(message)
+        # No replayer while the collector has never been reached
+        elif not buf.is_duplicate(message):
+            buf.put(message)
+        return ACK()
+    if isinstance(message, (KeepAlive, TCPConnection)):
+        return ACK()
+    logger.info("No Opera connected, refusing %s", message.serialize())
+    return NACK()
+
+
+class HealthCheck(object):
+    """ Sends a KeepAlive to the PBX when the link has been quiet for
+        `interval` seconds, and tells when it wasn't acknowledged in time.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_recv = time.monotonic()
+        self.sent = None    # time.monotonic() of the KeepAlive waiting for its ACK
+
+    def reset(self, check_now=False):
+        self.last_recv = time.monotonic() - (self.interval if check_now else 0)
+        self.sent = None
+
+    def received(self, message):
+        self.last_recv = time.monotonic()
+        if isinstance(message, (ACK, NACK)):
+            self.sent = None
+
+    def due(self, now):
+        return bool(self.interval) and self.sent is None and now - self.last_recv >= self.interval
+
+    def failed(self, now):
+        return self.sent is not None and now - self.sent >= HEALTH_CHECK_TIMEOUT
+
+    def next_event(self, now):
+        """ Seconds until due() or failed() may change"""
+        if self.sent is not None:
+            return max(self.sent + HEALTH_CHECK_TIMEOUT - now, 0)
+        if not self.interval:
+            return None
+        return max(self.last_recv + self.interval - now, 0)
+
+
+class Upstreams(Loggable):
+    """ The OLD and CDR connections of a site, opened once and reused by all
+        the Opera sessions.
+
+        Between sessions a thread keeps them warm: it reconnects them when
+        they drop, answers the PBX (see answer_idle) and checks with a
+        KeepAlive that the PBX link is still up. A session takes them over
+        with acquire() and gives them back with release().
+    """
+    def __init__(self, name, args, old_stream, cdr_stream, buf, retries):
+        super(Upstreams, self).__init__()
+        self.name = name
+        self.args = args
+        self.old = old_stream
+        self.cdr = cdr_stream
+        self.buffer = buf
+        self.retries = retries
+        self.detector = None
+        self.health = HealthCheck(args.health_check_interval)
+        self._cond = threading.Condition()
+        self._session = False
+        self._idle = False
+        self._stop = False
+        self._backoff = {
+            'pbx': connector.Backoff(maximum=args.retry_sleep),
+            'cdr': connector.Backoff(maximum=args.retry_sleep),
+        }
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._thread = None
+
+    def start(self, session=False):
+        """ Starts the idle thread. With `session`, a session has the
+            connections already and release() hands them to the thread.
+        """
+        self._session = session
+        self._thread = threading.Thread(target=self.run, name="%s-upstreams" % self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._wakeup()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.old.connected:
+            self.old.close()
+        if self.cdr.connected and self.cdr.has_socket:
+            self.cdr.close()
+        self.cdr.shutdown()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _park(self):
+        """ Waits until the idle thread let go of the connections"""
+        with self._cond:
+            self._session = True
+            self._wakeup()
+            while self._idle:
+                self._cond.wait()
+
+    def acquire(self):
+        """ Takes the connections over for an Opera session. Returns False if
+            they couldn't be opened.
+        """
+        self._park()
+        if self.old.connected and self.detector.invalid:
+            self.old.close()
+        if self.connect():
+            return True
+        self.release()
+        return False
+
+    def release(self, cdr_failed=False):
+        """ The session is over. The PBX link is checked at once, since the
+            session may have ended because of it.
+        """
+        if self.cdr.file_mode:
+            # commits the CDR file
+            self.cdr.close()
+        elif cdr_failed and self.cdr.connected:
+            self.cdr.close()
+        with self._cond:
+            self._session = False
+            self.health.reset(check_now=True)
+            self._cond.notify_all()
+
+    def take_over(self, state):
+        """ Uses the connections handed over by the previous process (see
+            omnipcx.handoff)
+        """
+        skt = state.socket('pbx')
+        if skt is not None:
+            self.old.adopt(skt)
+            metrics.connection(self.name, 'pbx', True)
+            self.detector = MessageDetector(self.old, self.old.capture)
+            self.detector.restore(state.unread('pbx'))
+        skt = state.socket('cdr')
+        if skt is not None and self.cdr.has_socket:
+            self.cdr.adopt(skt, paused=state.info('cdr', 'paused', False))
+            metrics.connection(self.name, 'cdr', True)
+
+    def hand_off(self, state):
+        """ Adds the connections to the SiteState handed over to the next
+            process. Call stop() afterwards.
+        """
+        self._park()
+        if self.old.connected:
+            # what we sent but the socket didn't take yet would be lost
+            self.old.flush(SEND_TIMEOUT)
+            state.add('pbx', os.dup(self.old.fileno()), self.detector.unread())
+        if self.cdr.has_socket and self.cdr.connected:
+            self.cdr.flush(SEND_TIMEOUT)
+            state.add('cdr', os.dup(self.cdr.fileno()), paused=self.cdr.paused)
+
+    def connect_old(self):
+        connected = self.old.connect()
+        metrics.connection(self.name, 'pbx', connected)
+        if connected:
+            self.detector = MessageDetector(self.old, self.old.capture)
+            self.health.reset()
+        return connected
+
+    def connect_cdr(self):
+        connected = self.cdr.connect()
+        if self.cdr.has_socket:
+            metrics.connection(self.name, 'cdr', connected)
+        return connected
+
+    def connect(self):
+        """ Opens the connections that aren't open, both at the same time.
+            Gives up after `retries` times --retry-sleep seconds.
+        """
+        deadline = time.monotonic() + self.retries * self.args.retry_sleep
+        backoff = connector.Backoff(maximum=self.args.retry_sleep)
+        while True:
+            connects = []
+            if not self.cdr.connected:
+                connects.append(self.connect_cdr)
+            if not self.old.connected:
+                connects.append(self.connect_old)
+            connector.connect_all(connects)
+            if self.old.connected and self.cdr.connected:
+                return True
+            delay = backoff.next_delay()
+            if time.monotonic() + delay > deadline:
+                break
+            if not self.old.connected:
+                self.logger.warn("Couldn't open connection to OLD. Waiting ...")
+            else:
+                self.logger.warn("Couldn't open connection to CDR. Waiting ...")
+            time.sleep(delay)
+        if not self.old.connected:
+            self.logger.error("Couldn't connect to OLD. Giving up.")
+        else:
+            self.logger.error("Couldn't connect to CDR collector. Giving up.")
+        return False
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._session and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                self._idle = True
+            failed = False
+            try:
+                self.idle()
+            except Exception:
+                self.logger.exception("Caught an exception while keeping the connections open")
+                failed = True
+            with self._cond:
+                self._idle = False
+                self._cond.notify_all()
+                if failed:
+                    self._cond.wait(self.args.retry_sleep)
+
+    def idle(self):
+        """ Serves the connections until a session takes them over"""
+        replayer = CDRReplayer(self.buffer, self.cdr)
+        if self.cdr.connected:
+            replayer.start()
+        try:
+            while not self._session and not self._stop:
+                if replayer.failed:
+                    if self.cdr.connected:
+                        self.cdr.close()
+                    replayer = CDRReplayer(self.buffer, self.cdr)
+                self.reconnect(replayer)
+                self.serve_pbx(replayer)
+        finally:
+            replayer.stop()
+
+    def reconnect(self, replayer):
+        """ Reopens the dropped connections whose backoff is over, both at
+            the same time
+        """
+        now = time.monotonic()
+        if self.cdr.has_socket:
+            self.cdr.poll_flow()
+        legs = []
+        if not self.cdr.connected and self._backoff['cdr'].ready(now):
+            legs.append(('cdr', self.connect_cdr))
+        if not self.old.connected and self._backoff['pbx'].ready(now):
+            legs.append(('pbx', self.connect_old))
+        results = connector.connect_all([connect for _, connect in legs])
+        for (leg, _), connected in zip(legs, results):
+            if not connected:
+                self._backoff[leg].failed(time.monotonic())
+                continue
+            self._backoff[leg].reset()
+            if leg == 'cdr':
+                self.logger.info("Reconnected to the CDR collector")
+                replayer.start()
+            else:
+                self.logger.info("Reconnected to OLD")
+
+    def serve_pbx(self, replayer):
+        """ Waits for the PBX, a health check or a session, whichever comes first"""
+        now = time.monotonic()
+        timeouts = [self.args.retry_sleep]
+        for leg, stream in (('cdr', self.cdr), ('pbx', self.old)):
+            if not stream.connected:
+                timeouts.append(max(self._backoff[leg].next_attempt - now, 0))
+        readers = [self._wakeup_r]
+        if self.old.connected:
+            readers.append(self.old)
+            if self.detector.pending:
+                timeouts.append(0)
+            next_check = self.health.next_event(now)
+            if next_check is not None:
+                timeouts.append(next_check)
+        writers = [self.old] if self.old.connected and self.old.output_pending else []
+        readable, writable, _ = select.select(readers, writers, [], min(timeouts))
+        if self._wakeup_r in readable:
+            self._wakeup_r.recv(4096)
+        if not self.old.connected:
+            return
+        if writable:
+            self.old.flush()
+        if self.detector.invalid:
+            self.logger.error("Cannot parse what OLD sends anymore. Reconnecting")
+            return self.old.close()
+        if self.old in readable:
+            try:
+                data = self.old.recv(4096)
+            except OSError as e:
+                self.logger.error("Lost the connection to OLD: %s", e)
+                return self.old.close()
+            if not data:
+                # recv() closed it
+                return
+            self.detector.pending.extend(self.detector.feed(data))
+        answered = False
+        while self.detector.pending and not self._session:
+            message = self.detector.pending.popleft()
+            self.health.received(message)
+            answer = answer_idle(message, replayer, self.buffer, self.logger)
+            # the answers to a burst of frames go out together
+            if answer is not None:
+                if not self.old.send(answer, flush=False):
+                    return self.old.close()
+                answered = True
+        if answered:
+            self.old.flush()
+        now = time.monotonic()
+        if self.health.failed(now):
+            self.logger.error("OLD didn't acknowledge the KeepAlive. Reconnecting")
+            self.old.close()
+        elif self.health.due(now):
+            if self.old.send(keepalive()):
+                self.health.sent = now
+            else:
+                self.old.close()
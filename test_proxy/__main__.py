@@ -51,6 +51,24 @@ def simple_client():
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["bench"]:
+        from test_proxy.bench import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ["replay"]:
+        from test_proxy.replay import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ["rules"]:
+        from test_proxy.rules import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ["outbound"]:
+        from test_proxy.outbound import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ["buffer"]:
+        from test_proxy.buffer import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ["detector"]:
+        from test_proxy.detector import main
+        sys.exit(main(sys.argv[2:]))
     if len(sys.argv) < 2:
         print("Missing integer parameter. Please check source code")
         sys.exit(0)
@@ -0,0 +1,190 @@
+""" Load benchmark of the proxy, entirely on localhost.
+
+    Starts a simulated CDR collector and PBX, runs the proxy against them,
+    connects a simulated Opera and drives a traffic mix at a target rate.
+    Reports the sustained messages/sec, the forwarding latency percentiles
+    and the CPU/RSS of the proxy process, e.g.:
+
+        python -m test_proxy bench --scenario mixed --duration 30 --engine asyncio
+        python -m test_proxy bench --scenario cdr-flood --json -- --crc-policy reject
+
+    Arguments after `--` are passed to the proxy.
+"""
+import argparse, json, os, subprocess, sys, tempfile, time
+from test_proxy.simulators import CDRCollector, Endpoint, Mix, OPERA_FRAMES, PBX_FRAMES, PBXEndpoint, \
+    accept_one, connect
+
+DEFAULT_OLD_PORT = 15010
+DEFAULT_OPERA_PORT = 12561
+DEFAULT_CDR_PORT = 16666
+CONNECT_TIMEOUT = 10.0
+
+# scenario -> (PBX mix, Opera mix). Rates are given per side.
+SCENARIOS = {
+    'cdr-flood': ({'smdr': 1}, {}),
+    'checkin-storm': ({}, {'check_in': 8, 'check_out': 1, 'room_status': 1}),
+    'reinit': ({'keepalive': 1}, {'reinit_request': 1}),
+    'keepalive': ({'keepalive': 1, 'tcp_connection': 1}, {}),
+    'mixed': ({'smdr': 8, 'keepalive': 1, 'tcp_connection': 1},
+        {'check_in': 6, 'check_out': 2, 'room_status': 2, 'reinit_request': 0.1}),
+}
+
+
+class ProcessStats(object):
+    """ CPU time and memory of a process, read from /proc"""
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf('SC_CLK_TCK')
+
+    def cpu_seconds(self):
+        with open("/proc/%d/stat" % self.pid) as f:
+            # the command name may contain spaces, the fields start after it
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+    def memory(self):
+        """ (current RSS, peak RSS) in KiB"""
+        values = {}
+        with open("/proc/%d/status" % self.pid) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    values[key] = int(value.split()[0])
+        return values.get("VmRSS", 0), values.get("VmHWM", 0)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(int(fraction * len(values)), len(values) - 1)
+    return values[index]
+
+
+def side_report(endpoint, duration):
+    stats = endpoint.stats
+    with stats.lock:
+        latencies = sorted(stats.latencies)
+        report = {
+            'sent': sum(stats.sent.values()),
+            'sent_by_kind': dict(stats.sent),
+            'acked': stats.acked,
+            'nacked': stats.nacked,
+            'lost': stats.lost,
+            'received': sum(stats.received.values()),
+        }
+    report['msgs_per_sec'] = report['acked'] / duration
+    for name, fraction in [('p50', 0.5), ('p99', 0.99), ('p999', 0.999)]:
+        value = percentile(latencies, fraction)
+        report[name + '_ms'] = None if value is None else value * 1000
+    return report
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m test_proxy bench", description='Proxy load benchmark')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed', help='Traffic mix')
+    parser.add_argument('--pbx-rate', type=float, default=0,
+        help='Frames per second sent by the simulated PBX (0 sends as fast as they are acknowledged)')
+    parser.add_argument('--opera-rate', type=float, default=0,
+        help='Frames per second sent by the simulated Opera (0 sends as fast as they are acknowledged)')
+    parser.add_argument('--duration', type=float, default=10, help='Measured seconds')
+    parser.add_argument('--warmup', type=float, default=2, help='Seconds of traffic before measuring')
+    parser.add_argument('--engine', default='asyncio', help='Proxy engine')
+    parser.add_argument('--window', type=int, default=1,
+        help='Frames the endpoints and the proxy keep unacknowledged in each direction')
+    parser.add_argument('--reinit-size', type=int, default=20, help='Frames the PBX sends back for a reinit request')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the traffic generators')
+    parser.add_argument('--old-port', type=int, default=DEFAULT_OLD_PORT)
+    parser.add_argument('--opera-port', type=int, default=DEFAULT_OPERA_PORT)
+    parser.add_argument('--cdr-port', type=int, default=DEFAULT_CDR_PORT)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    proxy_args = []
+    if '--' in argv:
+        argv, proxy_args = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    args.proxy_args = proxy_args
+    return args
+
+
+def start_proxy(args, workdir):
+    command = [sys.executable, '-m', 'omnipcx', '--engine', args.engine,
+        '--old-address', '127.0.0.1', '--old-port', str(args.old_port), '--opera-port', str(args.opera_port),
+        '--cdr-address', '127.0.0.1', '--cdr-port', str(args.cdr_port),
+        '--cdr-buffer-db-file', os.path.join(workdir, 'cdr_buffer.db'),
+        '--log-level', 'warning', '--retry-sleep', '0.2', '--window', str(args.window)] + args.proxy_args
+    return subprocess.Popen(command, stderr=open(os.path.join(workdir, 'proxy.log'), 'w'))
+
+
+def run(args):
+    pbx_mix, opera_mix = SCENARIOS[args.scenario]
+    collector = CDRCollector(args.cdr_port)
+    collector.start()
+    workdir = tempfile.mkdtemp(prefix="omnipcx-bench-")
+    proxy = start_proxy(args, workdir)
+    endpoints = []
+    try:
+        opera_sock = connect(args.opera_port, CONNECT_TIMEOUT)
+        pbx_sock = accept_one(args.old_port, CONNECT_TIMEOUT)
+        pbx = PBXEndpoint("pbx", pbx_sock, Mix(pbx_mix, PBX_FRAMES, args.seed), args.pbx_rate, args.window,
+            args.reinit_size)
+        opera = Endpoint("opera", opera_sock, Mix(opera_mix, OPERA_FRAMES, args.seed), args.opera_rate, args.window)
+        endpoints = [pbx, opera]
+        for endpoint in endpoints:
+            endpoint.start()
+        time.sleep(args.warmup)
+        process = ProcessStats(proxy.pid)
+        for endpoint in endpoints:
+            endpoint.stats.reset()
+        records = collector.records
+        cpu = process.cpu_seconds()
+        started = time.monotonic()
+        time.sleep(args.duration)
+        duration = time.monotonic() - started
+        cpu = process.cpu_seconds() - cpu
+        rss, peak_rss = process.memory()
+        report = {
+            'scenario': args.scenario,
+            'engine': args.engine,
+            'duration': duration,
+            'pbx': side_report(pbx, duration),
+            'opera': side_report(opera, duration),
+            'cdr_records': collector.records - records,
+            'proxy_cpu_percent': cpu / duration * 100,
+            'proxy_rss_kib': rss,
+            'proxy_peak_rss_kib': peak_rss,
+            'proxy_alive': proxy.poll() is None,
+        }
+        report['msgs_per_sec'] = report['pbx']['msgs_per_sec'] + report['opera']['msgs_per_sec']
+        return report
+    finally:
+        for endpoint in endpoints:
+            endpoint.stop()
+        proxy.terminate()
+        proxy.wait()
+        collector.stop()
+
+
+def _ms(value):
+    return "-" if value is None else "%.3f" % value
+
+
+def print_report(report):
+    print("scenario %s, engine %s, %.1f s" % (report['scenario'], report['engine'], report['duration']))
+    print("%-6s %10s %10s %8s %8s %10s %10s %10s" % ("side", "sent", "msgs/s", "nacked", "lost", "p50 ms",
+        "p99 ms", "p999 ms"))
+    for side in ('pbx', 'opera'):
+        stats = report[side]
+        print("%-6s %10d %10.1f %8d %8d %10s %10s %10s" % (side, stats['sent'], stats['msgs_per_sec'],
+            stats['nacked'], stats['lost'], _ms(stats['p50_ms']), _ms(stats['p99_ms']), _ms(stats['p999_ms'])))
+    print("total %.1f msgs/s, %d CDRs collected" % (report['msgs_per_sec'], report['cdr_records']))
+    print("proxy CPU %.1f%%, RSS %d KiB (peak %d KiB)%s" % (report['proxy_cpu_percent'], report['proxy_rss_kib'],
+        report['proxy_peak_rss_kib'], "" if report['proxy_alive'] else ", EXITED"))
+
+
+def main(argv):
+    args = parse_args(argv)
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0 if report['proxy_alive'] else 1
@@ -0,0 +1,89 @@
+""" Checks of the durable CDR buffer (omnipcx.cdr_buffer), on a database in
+    a temporary directory:
+
+        python -m test_proxy buffer
+
+    The CDRs come out oldest first, the ones not acknowledged come out again
+    after a rewind and after the database is opened again, also when the
+    process died without saving it. The exit status is 1 if a check failed.
+"""
+import logging, os.path, shutil, sqlite3, sys, tempfile
+from omnipcx.logging import Loggable, LogWrapper
+from omnipcx.cdr_buffer import CDRBuffer
+from omnipcx.messages import crc
+from omnipcx.messages.protocol import SMDR
+
+# The CDR of test_proxy.simulators, without its checksum
+BODY = b'J24271640Z000000113112992359 9995912345678           0066989202'
+
+
+def cdr(number):
+    body = BODY[:1] + b'%08d' % number + BODY[9:]
+    return SMDR(body + crc.crc(body), with_ends=False)
+
+
+def numbers(messages):
+    return [int(bytes(message.payload)[1:9]) for message in messages]
+
+
+def get(buf, count=None):
+    """ The CDRs handed out by buf, all of them by default"""
+    messages = []
+    while count is None or len(messages) < count:
+        message = buf.get()
+        if message is None:
+            break
+        messages.append(message)
+    return numbers(messages)
+
+
+def opened(filename, **options):
+    buf = CDRBuffer(filename, **options)
+    buf.load()
+    return buf
+
+
+def main(argv):
+    logger = logging.getLogger("test_proxy")
+    logger.setLevel(logging.CRITICAL)
+    Loggable.set_logger(LogWrapper(logger))
+    workdir = tempfile.mkdtemp(prefix="omnipcx-buffer-")
+    filename = os.path.join(workdir, "buffer.db")
+    checks = []
+    try:
+        buf = opened(filename)
+        buf.put_many([cdr(i) for i in range(3)])
+        buf.put(cdr(3))
+        buf.put(cdr(4))
+        checks.append(("get() hands the CDRs out oldest first", get(buf, 3) == [0, 1, 2] and len(buf) == 5))
+        buf.ack(2)
+        buf.rewind()
+        checks.append(("rewind() hands out again the CDRs not acknowledged", get(buf) == [2, 3, 4] and len(buf) == 3))
+        buf.save()
+        buf = opened(filename)
+        buf.put(cdr(5))
+        checks.append(("the CDRs not acknowledged are kept by save() and load()",
+            len(buf) == 4 and get(buf) == [2, 3, 4, 5]))
+        buf.ack()
+        buf.put_many([cdr(6), cdr(7)])
+        # the process dies: the buffer isn't saved
+        checks.append(("the CDRs put are in the database without save()",
+            get(opened(filename)) == [6, 7] and len(buf) == 2))
+        buf.save()
+        db = sqlite3.connect(filename)
+        with db:
+            db.execute("UPDATE cdr SET payload = ? WHERE payload = ?",
+                (bytes(cdr(6).payload)[:-2] + b"00", bytes(cdr(6).payload)))
+        db.close()
+        buf = opened(filename, verify_crc=True)
+        checks.append(("a CDR with an invalid CRC is set aside on load()", get(buf) == [7] and len(buf) == 1))
+        buf.save()
+    finally:
+        shutil.rmtree(workdir)
+    for name, ok in checks:
+        print("%s: %s" % ("ok" if ok else "FAILED", name))
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
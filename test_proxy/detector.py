@@ -0,0 +1,79 @@
+""" Checks of the incremental frame detector (omnipcx.messages.detector),
+    fed without a socket:
+
+        python -m test_proxy detector
+
+    TCP hands the frames over in pieces of any size: cut anywhere, the
+    stream has to give the same messages as when it arrives in one read.
+    The exit status is 1 if a check failed.
+"""
+import itertools, logging, sys
+from omnipcx.logging import Loggable, LogWrapper
+from omnipcx.messages.detector import MessageDetector
+
+# The frames of test_proxy.simulators, with ACKs in between
+STREAM = b''.join([
+    b'\x02J24271640Z000000113112992359 9995912345678           0066989202161FF\x03',
+    b'\x06',
+    b'\x02A24271640 VldPoenaru          1        039999999.11230 2FF\x03',
+    b'\x06\x15',
+    b'\x02$FFFF\x03',
+    b'\x02@FFFF\x03',
+    b'\x06',
+])
+
+
+class Chunks(object):
+    """ Stands in for the socket of the detector, hands out the data in chunks"""
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
+    def send(self, message):
+        return True
+
+
+def serialized(messages):
+    return [bytes(message.serialize()) for message in messages]
+
+
+def fed(chunks):
+    """ The messages of the chunks fed one after the other"""
+    detector = MessageDetector(None)
+    messages = []
+    for chunk in chunks:
+        messages.extend(detector.feed(chunk))
+    return serialized(messages), detector
+
+
+def main(argv):
+    logger = logging.getLogger("test_proxy")
+    logger.setLevel(logging.CRITICAL)
+    Loggable.set_logger(LogWrapper(logger))
+    expected, _ = fed([STREAM])
+    checks = [("the stream in one read gives its 8 frames", len(expected) == 8 and b"".join(expected) == STREAM)]
+    cuts = [fed([STREAM[:i], STREAM[i:]])[0] for i in range(1, len(STREAM))]
+    checks.append(("the stream cut in two anywhere gives the same frames", all(cut == expected for cut in cuts)))
+    checks.append(("the stream read byte by byte gives the same frames",
+        fed([STREAM[i:i + 1] for i in range(len(STREAM))])[0] == expected))
+    messages, detector = fed([STREAM[:20]])
+    checks.append(("a frame cut in the middle waits for the rest",
+        messages == [] and detector.unread() == STREAM[:20] and not detector.invalid))
+    detector = MessageDetector(Chunks([STREAM[:30], b"", STREAM[30:100], STREAM[100:]]))
+    frames = []
+    # a read without data gives None
+    for message in itertools.islice(detector.messages(), len(expected) + 10):
+        if message is not None:
+            frames.append(message)
+    checks.append(("messages() puts the frames together across reads", serialized(frames) == expected))
+    _, detector = fed([b'\x02J' + b'0' * MessageDetector.max_frame_size])
+    checks.append(("a frame longer than the longest type without ETX is invalid", detector.invalid))
+    for name, ok in checks:
+        print("%s: %s" % ("ok" if ok else "FAILED", name))
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
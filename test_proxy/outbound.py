@@ -0,0 +1,139 @@
+""" Checks of the outbound queues of the polling engine (omnipcx.streams),
+    over local sockets:
+
+        python -m test_proxy outbound
+
+    A peer that reads slowly gets the frames whole and in order, drain()
+    waits for it down to the low watermark and gives up on a peer that
+    doesn't read, and a CDR send that gives up leaves nothing behind to be
+    sent twice. The exit status is 1 if a
+    check failed.
+"""
+import logging, socket, sys, threading, time
+from omnipcx.logging import Loggable, LogWrapper
+from omnipcx.messages.protocol import SMDR
+from omnipcx.streams import OutboundQueue, CDRStream
+
+CDR_PORT = 16702
+# The check-in of test_proxy.simulators
+FRAME = b'\x02A24271640 VldPoenaru          1        039999999.11230 2FF\x03'
+PAYLOAD = b'J24271640Z000000113112992359 9995912345678           0066989202161'
+
+
+def socket_pair():
+    """ A non-blocking writer with small buffers and its reader"""
+    writer, reader = socket.socketpair()
+    writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    reader.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    writer.setblocking(False)
+    return writer, reader
+
+
+def read_all(sock, size, timeout=5.0):
+    data = bytearray()
+    sock.settimeout(timeout)
+    while len(data) < size:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+def check_partial_write():
+    writer, reader = socket_pair()
+    queue = OutboundQueue(writer)
+    frames = [FRAME.replace(b'24271640', b'%08d' % i) for i in range(2000)]
+    for frame in frames:
+        queue.push(frame)
+    queue.write()
+    partial = 0 < queue.size < len(frames) * len(FRAME)
+    result = []
+    reading = threading.Thread(target=lambda: result.append(read_all(reader, len(frames) * len(FRAME))))
+    reading.start()
+    queue.drain(0, 5.0)
+    reading.join()
+    writer.close()
+    reader.close()
+    return [("write() keeps what the socket didn't take", partial),
+        ("a slow reader gets the frames whole and in order", result == [b"".join(frames)] and not queue.size)]
+
+
+def check_watermarks():
+    writer, reader = socket_pair()
+    queue = OutboundQueue(writer, high=32 * 1024, low=8 * 1024)
+    while queue.size <= queue.high:
+        queue.push(FRAME)
+        queue.write()
+    threading.Timer(0.2, lambda: read_all(reader, queue.size - queue.low)).start()
+    started = time.monotonic()
+    queue.drain(queue.low, 5.0)
+    waited = time.monotonic() - started
+    writer.close()
+    reader.close()
+    return [("drain() waits for the reader down to the low watermark", queue.size <= queue.low and waited >= 0.15)]
+
+
+def check_timeout():
+    writer, reader = socket_pair()
+    queue = OutboundQueue(writer)
+    for _ in range(4096):
+        queue.push(FRAME)
+    started = time.monotonic()
+    try:
+        queue.drain(0, 0.3)
+        timed_out = False
+    except socket.timeout:
+        timed_out = True
+    waited = time.monotonic() - started
+    writer.close()
+    reader.close()
+    return [("drain() gives up on a peer that doesn't read", timed_out and 0.3 <= waited < 1.0)]
+
+
+def check_cdr_failed_send():
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", CDR_PORT))
+    server.listen(2)
+    server.settimeout(5.0)
+    stream = CDRStream("127.0.0.1", CDR_PORT, timeout=0.2)
+    try:
+        stream.connect()
+        first, _ = server.accept()
+        batch = [SMDR(PAYLOAD, with_ends=False)] * 2000
+        sends = 0
+        while sends < 1000 and stream.send_many(batch):
+            sends += 1
+        checks = [("a CDR send to a collector that doesn't read fails", sends < 1000),
+            ("the failed send leaves nothing queued", not stream.connected and not stream.output_pending)]
+        first.close()
+        if stream.connected:
+            stream.close()
+        stream.connect()
+        second, _ = server.accept()
+        stream.poll_flow()
+        live = SMDR(PAYLOAD.replace(b'24271640', b'99999999'), with_ends=False)
+        stream.send_many([live])
+        stream.close()
+        data = read_all(second, 1 << 20)
+        second.close()
+        checks.append(("the next connection doesn't get the failed batch", data == live.serialize_cdr()))
+        return checks
+    finally:
+        server.close()
+
+
+def main(argv):
+    logger = logging.getLogger("test_proxy")
+    # the checks provoke the errors the streams log
+    logger.setLevel(logging.CRITICAL)
+    Loggable.set_logger(LogWrapper(logger))
+    checks = check_partial_write() + check_watermarks() + check_timeout() + check_cdr_failed_send()
+    for name, ok in checks:
+        print("%s: %s" % ("ok" if ok else "FAILED", name))
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,199 @@
+""" Replays a capture made with `proxy --capture FILE` through a proxy
+    running against local stand-ins of the PBX, Opera and the CDR collector.
+
+    The stand-ins send what the proxy received during the capture, at the
+    captured pace (--speed 1), N times faster (--speed N) or as fast as
+    possible (--speed 0). Before sending anything they wait for what the
+    proxy sent before it during the capture, so the replay follows the order
+    of the capture.
+    What the proxy sends is compared with the capture at the end, e.g.:
+
+        python -m test_proxy replay incident.cap --speed 0 -- --default-password 8756
+
+    Arguments after `--` are passed to the proxy. The exit status is 1 if
+    the proxy didn't send what it sent during the capture. A capture taken
+    while the session was closing may end between a message and its
+    forwarding; what the proxy sends after the end of the capture is only
+    reported, unless --strict is given.
+"""
+import argparse, os, socket, subprocess, sys, tempfile, threading, time
+from omnipcx.capture import CDR, HOTEL, LEG_NAMES, PBX, RECEIVED, SENT, read_capture, sessions
+from test_proxy.simulators import RECV_SIZE, connect
+
+DEFAULT_OLD_PORT = 15010
+DEFAULT_OPERA_PORT = 12561
+DEFAULT_CDR_PORT = 16666
+CONNECT_TIMEOUT = 10.0
+
+
+class StandIn(object):
+    """ One end of a leg: sends the captured input and collects what the proxy sends"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = bytearray()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._recv_loop, daemon=True)
+        self._thread.start()
+
+    def _recv_loop(self):
+        while True:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except OSError:
+                data = b""
+            with self._cond:
+                if not data:
+                    self._closed = True
+                else:
+                    self.received += data
+                self._cond.notify_all()
+            if not data:
+                return
+
+    def wait_for(self, length, timeout):
+        """ Waits until the proxy sent `length` bytes. Returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self.received) < length and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return len(self.received) >= length
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self._thread.join(1.0)
+
+
+def listener(port):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(1)
+    server.settimeout(CONNECT_TIMEOUT)
+    return server
+
+
+def accept(server):
+    sock, _ = server.accept()
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def first_difference(expected, received):
+    for offset, (a, b) in enumerate(zip(expected, received)):
+        if a != b:
+            return offset
+    return min(len(expected), len(received))
+
+
+def replay_session(records, args, servers):
+    """ Returns a dict leg name -> (expected bytes, received bytes)"""
+    stand_ins = {HOTEL: StandIn(connect(args.opera_port, CONNECT_TIMEOUT))}
+    stand_ins[CDR] = StandIn(accept(servers[CDR]))
+    stand_ins[PBX] = StandIn(accept(servers[PBX]))
+    expected = dict((leg, bytearray()) for leg in stand_ins)
+    try:
+        started = time.monotonic()
+        first = records[0].timestamp
+        for record in records:
+            if record.event == SENT:
+                expected[record.leg] += record.data
+                continue
+            if record.event != RECEIVED:
+                continue
+            for leg, stand_in in stand_ins.items():
+                stand_in.wait_for(len(expected[leg]), args.timeout)
+            if args.speed:
+                delay = started + (record.timestamp - first) / args.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            stand_ins[record.leg].send(record.data)
+        for leg, stand_in in stand_ins.items():
+            stand_in.wait_for(len(expected[leg]), args.timeout)
+        # let the proxy send anything it wasn't supposed to
+        time.sleep(args.settle)
+        return dict((LEG_NAMES[leg], (bytes(expected[leg]), bytes(stand_ins[leg].received))) for leg in stand_ins)
+    finally:
+        for stand_in in stand_ins.values():
+            stand_in.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m test_proxy replay", description='Replay a proxy capture')
+    parser.add_argument('capture', help='Capture file')
+    parser.add_argument('--speed', type=float, default=1.0,
+        help='1 replays at the captured pace, N is N times faster, 0 is as fast as possible')
+    parser.add_argument('--session', type=int, default=None, help='Replay only this session (from 1)')
+    parser.add_argument('--engine', default='asyncio', help='Proxy engine')
+    parser.add_argument('--timeout', type=float, default=2.0,
+        help='Seconds to wait for the proxy to send what it sent during the capture')
+    parser.add_argument('--settle', type=float, default=0.2, help='Seconds to wait at the end of every session')
+    parser.add_argument('--strict', action='store_true',
+        help='Fail if the proxy sends more than it sent during the capture')
+    parser.add_argument('--old-port', type=int, default=DEFAULT_OLD_PORT)
+    parser.add_argument('--opera-port', type=int, default=DEFAULT_OPERA_PORT)
+    parser.add_argument('--cdr-port', type=int, default=DEFAULT_CDR_PORT)
+    proxy_args = []
+    if '--' in argv:
+        argv, proxy_args = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    args.proxy_args = proxy_args
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    captured = list(sessions(read_capture(args.capture)))
+    if args.session is not None:
+        captured = captured[args.session - 1:args.session]
+    if not captured:
+        print("No session to replay")
+        return 1
+    servers = {PBX: listener(args.old_port), CDR: listener(args.cdr_port)}
+    workdir = tempfile.mkdtemp(prefix="omnipcx-replay-")
+    command = [sys.executable, '-m', 'omnipcx', '--engine', args.engine,
+        '--old-address', '127.0.0.1', '--old-port', str(args.old_port), '--opera-port', str(args.opera_port),
+        '--cdr-address', '127.0.0.1', '--cdr-port', str(args.cdr_port),
+        '--cdr-buffer-db-file', os.path.join(workdir, 'cdr_buffer.db'),
+        '--log-level', 'warning', '--retry-sleep', '0.2'] + args.proxy_args
+    proxy = subprocess.Popen(command, stderr=open(os.path.join(workdir, 'proxy.log'), 'w'))
+    failed = False
+    try:
+        for number, records in enumerate(captured, 1):
+            inputs = sum(1 for record in records if record.event == RECEIVED)
+            started = time.monotonic()
+            results = replay_session(records, args, servers)
+            elapsed = time.monotonic() - started
+            print("session %d: %d inputs in %.2f s" % (number, inputs, elapsed))
+            for leg, (expected, received) in sorted(results.items()):
+                if expected == received:
+                    print("  %-5s ok, %d bytes" % (leg, len(received)))
+                    continue
+                if received.startswith(expected) and not args.strict:
+                    print("  %-5s ok, %d bytes, then %d bytes after the end of the capture: %r" % (leg,
+                        len(expected), len(received) - len(expected), received[len(expected):len(expected) + 40]))
+                    continue
+                failed = True
+                offset = first_difference(expected, received)
+                print("  %-5s MISMATCH at byte %d: expected %d bytes, got %d" % (leg, offset, len(expected),
+                    len(received)))
+                print("        expected %r" % expected[offset:offset + 40])
+                print("        got      %r" % received[offset:offset + 40])
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        for server in servers.values():
+            server.close()
+    print("proxy log: %s" % os.path.join(workdir, 'proxy.log'))
+    return 1 if failed else 0
@@ -0,0 +1,63 @@
+""" Checks of the frame rewriting rules (omnipcx.rules), without a proxy:
+
+        python -m test_proxy rules
+
+    The check-ins the PBX sends aren't always the size of their type, the
+    default password has to be set in them all the same. The exit status
+    is 1 if a check failed.
+"""
+import sys
+from omnipcx import rules
+from omnipcx.messages import crc
+from omnipcx.messages.protocol import CheckIn, CheckinSixDigit
+
+DEFAULT_PASSWORD = "8756"
+# The check-in of test_proxy.simulators, one byte shorter than CheckIn.get_size()
+CHECK_IN = b'\x02A24271640 VldPoenaru          1        039999999.11230 2FF\x03'
+
+
+def frame(cls, payload):
+    """ A frame of cls with payload and its checksum"""
+    return cls(b"".join((b'\x02', payload, crc.crc(payload), b'\x03')))
+
+
+def check_in(size, password=None, cls=CheckIn):
+    """ A check-in frame of `size` bytes, with a blank password by default"""
+    payload = bytearray(CHECK_IN[1:-3].ljust(size - 4)[:size - 4])
+    payload[0:1] = cls.get_type()
+    password = password or b" " * cls.PASSWORD_LEN
+    payload[cls.PASSWORD_OFFSET:cls.PASSWORD_OFFSET + len(password)] = password
+    return frame(cls, bytes(payload))
+
+
+def rewritten(table, message):
+    rule = table.opera.get(message.__class__)
+    if rule is not None:
+        rule.rewrite(message)
+    return message
+
+
+def main(argv):
+    table = rules.compile_rules([], default_password=DEFAULT_PASSWORD)
+    expected = DEFAULT_PASSWORD.encode('ascii')
+    checks = []
+    for size in (CheckIn.get_size() - 1, CheckIn.get_size(), CheckIn.get_size() + 2):
+        message = rewritten(table, check_in(size))
+        checks.append(("%d byte check-in gets the default password" % size,
+            message.password == expected and message.crc_valid and len(message.serialize()) == size))
+    message = rewritten(table, check_in(CheckIn.get_size() - 1, b"1234"))
+    checks.append(("check-in with a password keeps it", message.password == b"1234"))
+    short = frame(CheckIn, CHECK_IN[1:CheckIn.PASSWORD_OFFSET + 3])
+    checks.append(("check-in too short for the password is left alone",
+        rewritten(table, short).serialize() == short.serialize()))
+    size = CheckinSixDigit.get_size() - 1
+    message = rewritten(table, check_in(size, cls=CheckinSixDigit))
+    checks.append(("%d byte six digit check-in gets the default password" % size,
+        message.password == expected.rjust(CheckinSixDigit.PASSWORD_LEN) and message.crc_valid))
+    for name, ok in checks:
+        print("%s: %s" % ("ok" if ok else "FAILED", name))
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
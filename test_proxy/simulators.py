@@ -0,0 +1,335 @@
+""" Simulated OLD/PBX, Opera and CDR collector endpoints for the benchmark.
+
+    Every protocol frame gets an ACK back. An endpoint keeps at most
+    `window` frames unacknowledged (1 is the proxy's lockstep protocol). The
+    time between sending a frame and getting its ACK back is the forwarding
+    latency.
+"""
+import collections, itertools, random, socket, threading, time
+from omnipcx.messages import crc
+
+STX = b'\x02'
+ETX = b'\x03'
+ACK = b'\x06'
+NACK = b'\x15'
+XON = b'\x13'
+XOFF = b'\x11'
+RECV_SIZE = 4096
+# An unacknowledged frame is given up after this many seconds
+REPLY_TIMEOUT = 2.0
+
+
+def frame(_type, size, body=b"", with_crc=True):
+    """ A frame of `size` bytes (STX and ETX included), padded with spaces"""
+    payload_len = size - 2
+    payload = (_type + body)[:payload_len - (2 if with_crc else 0)]
+    if with_crc:
+        payload = payload.ljust(payload_len - 2, b" ")
+        return STX + payload + crc.crc(payload) + ETX
+    return STX + payload.ljust(payload_len, b"F") + ETX
+
+
+def smdr(rng, counter):
+    body = b"%08d Z%012d%012d %-26s%06d" % (rng.randrange(10 ** 8), next(counter), rng.randrange(10 ** 12),
+        b"%d" % rng.randrange(10 ** 10), rng.randrange(10 ** 6))
+    return frame(b'J', 74, body)
+
+
+def check_in(rng, counter):
+    # Blank password, the proxy replaces it with the default one
+    body = b"%04d %-20s1    %02d" % (rng.randrange(10 ** 4), b"Guest%d" % next(counter), rng.randrange(100))
+    return frame(b'A', 61, body)
+
+
+def check_out(rng, counter):
+    return frame(b'D', 13, b"%04d" % rng.randrange(10 ** 4))
+
+
+def room_status(rng, counter):
+    return frame(b'C', 17, b"%04d %d" % (rng.randrange(10 ** 4), rng.randrange(10)))
+
+
+def keepalive(rng, counter):
+    return frame(b'$', 7, with_crc=False)
+
+
+def tcp_connection(rng, counter):
+    return frame(b'@', 7, with_crc=False)
+
+
+def reinit_request(rng, counter):
+    return frame(b'Z', 14, b"0")
+
+
+def full_reinit(rng, counter):
+    return frame(b'U', 96, b"%04d %-20s" % (rng.randrange(10 ** 4), b"Guest%d" % next(counter)))
+
+
+# Frames each side can originate
+PBX_FRAMES = {
+    'smdr': smdr,
+    'keepalive': keepalive,
+    'tcp_connection': tcp_connection,
+}
+OPERA_FRAMES = {
+    'check_in': check_in,
+    'check_out': check_out,
+    'room_status': room_status,
+    'reinit_request': reinit_request,
+}
+
+
+class Mix(object):
+    """ Draws frame kinds with the given weights, e.g. {'smdr': 9, 'keepalive': 1}"""
+    def __init__(self, weights, builders, seed=None):
+        unknown = set(weights) - set(builders)
+        if unknown:
+            raise ValueError("Unknown frames: %s" % ", ".join(sorted(unknown)))
+        self.kinds = [kind for kind, weight in weights.items() if weight > 0]
+        self.weights = [weights[kind] for kind in self.kinds]
+        self.builders = builders
+        self.rng = random.Random(seed)
+        self.counter = itertools.count()
+
+    def __bool__(self):
+        return bool(self.kinds)
+
+    def next(self):
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        return kind, self.builders[kind](self.rng, self.counter)
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.sent = collections.Counter()
+        self.acked = 0
+        self.nacked = 0
+        self.lost = 0
+        self.received = collections.Counter()
+
+    def reset(self):
+        with self.lock:
+            self.__init__()
+
+
+class Endpoint(object):
+    """ One end of a proxy leg. It ACKs every frame it receives and, if it
+        has a mix, sends frames at `rate` per second (0 means as fast as the
+        ACKs come back).
+    """
+    def __init__(self, name, sock, mix=None, rate=0.0, window=1):
+        self.name = name
+        self.sock = sock
+        self.mix = mix
+        self.rate = rate
+        self.window = window
+        self.stats = Stats()
+        self.stop_event = threading.Event()
+        self._send_lock = threading.Lock()
+        self._acked = threading.Condition()
+        self._outstanding = collections.deque()    # send times of the unacknowledged frames
+        self._pending = collections.deque()    # frames to send before the next one of the mix
+        self._threads = []
+
+    def start(self):
+        for target, suffix in [(self._recv_loop, "recv"), (self._send_loop, "send")]:
+            if target == self._send_loop and not self.mix:
+                continue
+            thread = threading.Thread(target=target, name="%s-%s" % (self.name, suffix), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        with self._acked:
+            self._acked.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        for thread in self._threads:
+            thread.join(REPLY_TIMEOUT)
+        self.sock.close()
+
+    def _write(self, data):
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def on_frame(self, data):
+        """ A protocol frame was received. Subclasses can queue frames in reaction to it"""
+
+    def _recv_loop(self):
+        buf = bytearray()
+        while not self.stop_event.is_set():
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except OSError:
+                break
+            if not data:
+                break
+            buf += data
+            pos = 0
+            while pos < len(buf):
+                first = buf[pos]
+                if first == STX[0]:
+                    end = buf.find(ETX, pos)
+                    if end < 0:
+                        break
+                    data = bytes(buf[pos:end + 1])
+                    pos = end + 1
+                    with self.stats.lock:
+                        self.stats.received[data[1:2].decode("ascii", "replace")] += 1
+                    try:
+                        self._write(ACK)
+                    except OSError:
+                        return self.stop_event.set()
+                    self.on_frame(data)
+                    continue
+                pos += 1
+                if first == ACK[0] or first == NACK[0]:
+                    self._reply(first == ACK[0])
+            del buf[:pos]
+        self.stop_event.set()
+        with self._acked:
+            self._acked.notify_all()
+
+    def _reply(self, ok):
+        now = time.monotonic()
+        with self._acked:
+            if not self._outstanding:
+                return
+            sent = self._outstanding.popleft()
+            with self.stats.lock:
+                if ok:
+                    self.stats.acked += 1
+                    self.stats.latencies.append(now - sent)
+                else:
+                    self.stats.nacked += 1
+            self._acked.notify_all()
+
+    def _send_loop(self):
+        interval = 1.0 / self.rate if self.rate else 0.0
+        next_send = time.monotonic()
+        while not self.stop_event.is_set():
+            with self._acked:
+                while len(self._outstanding) >= self.window and not self.stop_event.is_set():
+                    remaining = self._outstanding[0] + REPLY_TIMEOUT - time.monotonic()
+                    if remaining <= 0:
+                        with self.stats.lock:
+                            self.stats.lost += 1
+                        self._outstanding.popleft()
+                        continue
+                    self._acked.wait(remaining)
+            if self.stop_event.is_set():
+                return
+            if interval:
+                next_send += interval
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -1.0:
+                    # Too far behind the target rate, don't send a burst to catch up
+                    next_send = time.monotonic()
+            if self._pending:
+                kind, data = self._pending.popleft()
+            else:
+                kind, data = self.mix.next()
+            with self._acked:
+                self._outstanding.append(time.monotonic())
+            try:
+                self._write(data)
+            except OSError:
+                return self.stop_event.set()
+            with self.stats.lock:
+                self.stats.sent[kind] += 1
+
+
+class PBXEndpoint(Endpoint):
+    """ Answers a reinit request from Opera with a burst of reinit frames"""
+    def __init__(self, name, sock, mix=None, rate=0.0, window=1, reinit_size=20):
+        super(PBXEndpoint, self).__init__(name, sock, mix, rate, window)
+        self.reinit_size = reinit_size
+
+    def on_frame(self, data):
+        if data[1:2] == b'Z' and self.mix:
+            counter = self.mix.counter
+            self._pending.extend(('full_reinit', full_reinit(self.mix.rng, counter)) for _ in range(self.reinit_size))
+
+
+class CDRCollector(object):
+    """ Accepts the proxy's CDR connections and counts the records"""
+    def __init__(self, port, address="127.0.0.1"):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((address, port))
+        self.server.listen(5)
+        self.server.settimeout(0.5)
+        self.records = 0
+        self.connections = 0
+        self.stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._accept_loop, name="cdr-collector", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self._thread.join()
+        self.server.close()
+
+    def _accept_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                sock, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            self.connections += 1
+            threading.Thread(target=self._read_loop, args=(sock,), name="cdr-reader", daemon=True).start()
+
+    def _read_loop(self, sock):
+        sock.settimeout(0.5)
+        with sock:
+            while not self.stop_event.is_set():
+                try:
+                    data = sock.recv(RECV_SIZE)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    return
+                if not data:
+                    return
+                self.records += data.count(b"\n")
+
+
+def accept_one(port, timeout, address="127.0.0.1"):
+    """ Waits for the proxy to connect to the simulated PBX"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((address, port))
+    server.listen(1)
+    server.settimeout(timeout)
+    try:
+        sock, _ = server.accept()
+    finally:
+        server.close()
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def connect(port, timeout, address="127.0.0.1"):
+    """ Connects the simulated Opera to the proxy, retrying until it listens"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            sock = socket.create_connection((address, port), timeout=1.0)
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock